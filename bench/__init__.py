@@ -0,0 +1,3 @@
+"""
+Offline benchmarks - local stand-ins for external services and a load generator
+"""
@@ -0,0 +1,441 @@
+"""
+Fake external services for offline load tests: Yandex GPT completions and embeddings
+(gRPC over TLS with a self-signed certificate), Brave Search API and web pages. Every
+fake waits for a random latency and may answer with a rate limit error.
+
+Run standalone:
+
+    python -m bench.fakes --grpc-port 50051 --http-port 8181 --cert-dir ./cache/bench
+"""
+
+from argparse import ArgumentParser
+from asyncio import run, sleep
+from datetime import datetime, timedelta, timezone
+from hashlib import blake2b
+from ipaddress import ip_address
+from logging import getLogger
+from os import makedirs, path
+from random import Random
+from typing import AsyncGenerator, Optional
+
+import numpy as np
+import uvicorn
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse
+from grpc import StatusCode, ssl_server_credentials
+from grpc.aio import Server, ServicerContext
+from grpc.aio import server as grpc_server
+from pydantic import BaseModel
+from yandex.cloud.ai.foundation_models.v1.embedding.embedding_service_pb2 import (
+    TextEmbeddingRequest,
+    TextEmbeddingResponse,
+)
+from yandex.cloud.ai.foundation_models.v1.embedding.embedding_service_pb2_grpc import (
+    EmbeddingsServiceServicer,
+    add_EmbeddingsServiceServicer_to_server,
+)
+from yandex.cloud.ai.foundation_models.v1.text_common_pb2 import (
+    Alternative,
+    ContentUsage,
+    Message,
+)
+from yandex.cloud.ai.foundation_models.v1.text_generation.text_generation_service_pb2 import (
+    CompletionRequest,
+    CompletionResponse,
+)
+from yandex.cloud.ai.foundation_models.v1.text_generation.text_generation_service_pb2_grpc import (
+    TextGenerationServiceServicer,
+    add_TextGenerationServiceServicer_to_server,
+)
+
+from rag.app import configure_logging
+
+logger = getLogger(__name__)
+
+CERT_FILE = "fake-cert.pem"
+KEY_FILE = "fake-key.pem"
+
+WORDS: tuple[str, ...] = (
+    "система",
+    "запрос",
+    "ответ",
+    "данные",
+    "модель",
+    "поиск",
+    "нагрузка",
+    "сервер",
+    "задержка",
+    "индекс",
+    "документ",
+    "кэш",
+)
+
+
+class Latency:
+    """
+    Random delay in seconds. Spec is a number (fixed delay) or "<distribution>:<params>":
+    fixed:S, uniform:MIN,MAX, normal:MEAN,SD, lognormal:MEDIAN,SIGMA, exp:MEAN.
+    """
+
+    def __init__(self, spec: str = "0", random: Optional[Random] = None):
+        self.spec: str = spec
+        self._random: Random = random or Random()
+
+        name, _, params = spec.partition(":") if ":" in spec else ("fixed", "", spec)
+        self._name: str = name
+        self._params: list[float] = [float(p) for p in params.split(",") if p]
+
+        if self._name not in ("fixed", "uniform", "normal", "lognormal", "exp"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        """Get a delay"""
+        p: list[float] = self._params
+
+        if self._name == "fixed":
+            value: float = p[0]
+        elif self._name == "uniform":
+            value = self._random.uniform(p[0], p[1])
+        elif self._name == "normal":
+            value = self._random.gauss(p[0], p[1])
+        elif self._name == "lognormal":
+            value = p[0] * self._random.lognormvariate(0, p[1])
+        else:
+            value = self._random.expovariate(1 / p[0])
+
+        return max(value, 0)
+
+
+class Endpoint:
+    """Latency and error rate of a fake endpoint"""
+
+    def __init__(self, latency: str, error_rate: float, random: Random):
+        self.latency: Latency = Latency(latency, random)
+        self.error_rate: float = error_rate
+        self._random: Random = random
+
+    def fails(self) -> bool:
+        """Whether the current call should fail"""
+        return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    async def adelay(self):
+        """Wait for the endpoint's latency"""
+        await sleep(self.latency.sample())
+
+
+class FakeSettings(BaseModel):
+    """Behaviour of fake services"""
+
+    llm_latency: str = "lognormal:0.8,0.4"
+    # delay between streamed chunks
+    llm_token_interval: float = 0.02
+    llm_rate_limit: float = 0
+    embedding_latency: str = "lognormal:0.05,0.3"
+    embedding_rate_limit: float = 0
+    embedding_dim: int = 256
+    brave_latency: str = "lognormal:0.3,0.3"
+    brave_rate_limit: float = 0
+    page_latency: str = "lognormal:0.2,0.5"
+    page_error_rate: float = 0
+    # share of queries routed to internet search by the fake LLM
+    internet_share: float = 0.3
+    answer_words: int = 80
+    page_words: int = 400
+    seed: int = 0
+
+
+def _hash(text: str) -> int:
+    return int.from_bytes(blake2b(text.encode(), digest_size=8).digest(), "big")
+
+
+def _text(seed: int, words: int) -> str:
+    """Deterministic filler text"""
+    random: Random = Random(seed)
+
+    return " ".join(random.choice(WORDS) for _ in range(words))
+
+
+def embed(text: str, dim: int = 256) -> list[float]:
+    """Deterministic unit vector of the text"""
+    vector: np.ndarray = np.random.default_rng(_hash(text)).standard_normal(dim)
+
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def reply(prompt: str, settings: FakeSettings) -> str:
+    """Answer of the fake LLM: guard score, tool name or filler text"""
+    if prompt.rstrip().endswith("Оценка опасности:"):
+        return "0.0"
+
+    if prompt.rstrip().endswith("Инструмент:"):
+        if _hash(prompt) % 1000 < settings.internet_share * 1000:
+            return "internet_search_tool"
+
+        return "database_search_tool"
+
+    return _text(_hash(prompt), settings.answer_words)
+
+
+class FakeTextGeneration(TextGenerationServiceServicer):
+    """Yandex GPT completion API"""
+
+    def __init__(self, settings: FakeSettings, random: Random):
+        self.settings: FakeSettings = settings
+        self.endpoint: Endpoint = Endpoint(
+            settings.llm_latency, settings.llm_rate_limit, random
+        )
+
+    async def Completion(
+        self, request: CompletionRequest, context: ServicerContext
+    ) -> AsyncGenerator[CompletionResponse, None]:
+        if self.endpoint.fails():
+            await context.abort(StatusCode.RESOURCE_EXHAUSTED, "Rate limit exceeded")
+
+        await self.endpoint.adelay()
+
+        prompt: str = "\n".join(m.text for m in request.messages)
+        words: list[str] = reply(prompt, self.settings).split(" ")
+        usage: ContentUsage = ContentUsage(
+            input_text_tokens=len(prompt.split()),
+            completion_tokens=len(words),
+            total_tokens=len(prompt.split()) + len(words),
+        )
+
+        # a chunk of 4 words per streamed response, non-streaming calls get one
+        step: int = 4 if request.completion_options.stream else len(words)
+
+        for end in range(step, len(words) + step, step):
+            if end > step:
+                await sleep(self.settings.llm_token_interval)
+
+            final: bool = end >= len(words)
+            yield CompletionResponse(
+                alternatives=[
+                    Alternative(
+                        message=Message(role="assistant", text=" ".join(words[:end])),
+                        status=(
+                            Alternative.ALTERNATIVE_STATUS_FINAL
+                            if final
+                            else Alternative.ALTERNATIVE_STATUS_PARTIAL
+                        ),
+                    )
+                ],
+                usage=usage,
+                model_version="fake",
+            )
+
+
+class FakeEmbeddings(EmbeddingsServiceServicer):
+    """Yandex embeddings API"""
+
+    def __init__(self, settings: FakeSettings, random: Random):
+        self.settings: FakeSettings = settings
+        self.endpoint: Endpoint = Endpoint(
+            settings.embedding_latency, settings.embedding_rate_limit, random
+        )
+
+    async def TextEmbedding(
+        self, request: TextEmbeddingRequest, context: ServicerContext
+    ) -> TextEmbeddingResponse:
+        if self.endpoint.fails():
+            await context.abort(StatusCode.RESOURCE_EXHAUSTED, "Rate limit exceeded")
+
+        await self.endpoint.adelay()
+
+        return TextEmbeddingResponse(
+            embedding=embed(request.text, self.settings.embedding_dim),
+            num_tokens=len(request.text.split()),
+            model_version="fake",
+        )
+
+
+def create_web_app(settings: FakeSettings, random: Random) -> FastAPI:
+    """Brave Search API and web pages its results point to"""
+    app: FastAPI = FastAPI()
+    brave: Endpoint = Endpoint(
+        settings.brave_latency, settings.brave_rate_limit, random
+    )
+    pages: Endpoint = Endpoint(settings.page_latency, settings.page_error_rate, random)
+
+    @app.get("/health")
+    async def health() -> dict:
+        return {"status": "ok"}
+
+    @app.get("/res/v1/web/search")
+    async def search(request: Request, q: str, count: int = 5):
+        if brave.fails():
+            return JSONResponse(
+                status_code=429,
+                content={"type": "ErrorResponse", "error": {"code": "RATE_LIMITED"}},
+            )
+
+        await brave.adelay()
+        base_url: str = str(request.base_url).rstrip("/")
+        key: str = f"{_hash(q):x}"
+
+        return {
+            "type": "search",
+            "query": {"original": q},
+            "web": {
+                "type": "search",
+                "results": [
+                    {
+                        "title": f"{q} - {index}",
+                        "url": f"{base_url}/pages/{key}-{index}",
+                        "description": _text(_hash(key) + index, 20),
+                    }
+                    for index in range(count)
+                ],
+            },
+        }
+
+    @app.get("/pages/{page_id}")
+    async def page(page_id: str):
+        if pages.fails():
+            return HTMLResponse(status_code=503, content="Service Unavailable")
+
+        await pages.adelay()
+        paragraphs: list[str] = [
+            f"<p>{_text(_hash(page_id) + index, 50)}</p>"
+            for index in range(max(settings.page_words // 50, 1))
+        ]
+
+        return HTMLResponse(
+            f"<html><head><title>{page_id}</title></head>"
+            f"<body>{''.join(paragraphs)}</body></html>"
+        )
+
+    return app
+
+
+def make_certificate(cert_dir: str) -> tuple[str, str]:
+    """
+    Make a self-signed certificate for localhost, clients trust it via
+    GRPC_DEFAULT_SSL_ROOTS_FILE_PATH
+
+    Returns:
+        tuple[str, str]: certificate and key paths
+    """
+    makedirs(cert_dir, exist_ok=True)
+    cert_path: str = path.join(cert_dir, CERT_FILE)
+    key_path: str = path.join(cert_dir, KEY_FILE)
+
+    key: ec.EllipticCurvePrivateKey = ec.generate_private_key(ec.SECP256R1())
+    name: x509.Name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now: datetime = datetime.now(timezone.utc)
+    certificate: x509.Certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=30))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.DNSName("localhost"), x509.IPAddress(ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    with open(key_path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+
+    return cert_path, key_path
+
+
+def api_env(grpc_port: int, http_port: int, cert_dir: str) -> dict[str, str]:
+    """Environment pointing the API to the fake services"""
+    return {
+        "YANDEX_API_URL": f"localhost:{grpc_port}",
+        "YANDEX_API_KEY": "fake",
+        "YANDEX_FOLDER_ID": "fake",
+        "GRPC_DEFAULT_SSL_ROOTS_FILE_PATH": path.abspath(
+            path.join(cert_dir, CERT_FILE)
+        ),
+        "BRAVE_SEARCH_URL": f"http://127.0.0.1:{http_port}/res/v1/web/search",
+        "BRAVE_SEARCH_API_KEY": "fake",
+    }
+
+
+async def aserve(settings: FakeSettings, grpc_port: int, http_port: int, cert_dir: str):
+    """Serve fake services until interrupted"""
+    random: Random = Random(settings.seed)
+    cert_path, key_path = make_certificate(cert_dir)
+
+    with open(cert_path, "rb") as f:
+        certificate: bytes = f.read()
+
+    with open(key_path, "rb") as f:
+        key: bytes = f.read()
+
+    server: Server = grpc_server()
+    add_TextGenerationServiceServicer_to_server(
+        FakeTextGeneration(settings, random), server
+    )
+    add_EmbeddingsServiceServicer_to_server(FakeEmbeddings(settings, random), server)
+    server.add_secure_port(
+        f"localhost:{grpc_port}", ssl_server_credentials([(key, certificate)])
+    )
+    await server.start()
+    logger.info("aserve, gRPC on %s, HTTP on %s", grpc_port, http_port)
+
+    web: uvicorn.Server = uvicorn.Server(
+        uvicorn.Config(
+            create_web_app(settings, random),
+            host="127.0.0.1",
+            port=http_port,
+            log_level="warning",
+        )
+    )
+
+    try:
+        await web.serve()
+    finally:
+        await server.stop(1)
+
+
+def add_arguments(parser: ArgumentParser):
+    """Add fake service settings to command line arguments"""
+    for name, field in FakeSettings.model_fields.items():
+        parser.add_argument(
+            "--" + name.replace("_", "-"),
+            type=field.annotation,
+            default=field.default,
+            help=f"default: {field.default}",
+        )
+
+
+def get_settings(args) -> FakeSettings:
+    """Get fake service settings from parsed arguments"""
+    return FakeSettings(
+        **{name: getattr(args, name) for name in FakeSettings.model_fields}
+    )
+
+
+if __name__ == "__main__":
+    parser: ArgumentParser = ArgumentParser(description=__doc__)
+    parser.add_argument("--grpc-port", type=int, default=50051)
+    parser.add_argument("--http-port", type=int, default=8181)
+    parser.add_argument("--cert-dir", default="./cache/bench")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    configure_logging()
+    run(aserve(get_settings(args), args.grpc_port, args.http_port, args.cert_dir))
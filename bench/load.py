@@ -0,0 +1,148 @@
+"""
+Load generator - virtual users create a chat and send several messages to it, until the
+given number of messages is sent. Latency of every request is recorded. Questions of a
+chat depend on its number only, so runs with any concurrency send the same
+conversations.
+"""
+
+from asyncio import gather
+from logging import getLogger
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+import numpy as np
+from httpx import AsyncClient, HTTPError, Limits, Response, Timeout
+
+logger = getLogger(__name__)
+
+CREATE_CHAT = "POST /chat"
+CREATE_MESSAGE = "POST /chat/{chat_id}/messages"
+
+
+class Sample(NamedTuple):
+    """Request result, status is 0 if no response was received"""
+
+    endpoint: str
+    latency: float
+    status: int
+
+
+async def _arequest(
+    client: AsyncClient,
+    samples: list[Sample],
+    endpoint: str,
+    url: str,
+    payload: dict,
+) -> Optional[dict]:
+    """Send a request and record its latency, returns the response body on success"""
+    started: float = perf_counter()
+
+    try:
+        response: Response = await client.post(url, json=payload)
+    except HTTPError as e:
+        logger.debug("_arequest, url=%s, error=%s", url, e)
+        samples.append(Sample(endpoint, perf_counter() - started, 0))
+        return None
+
+    samples.append(Sample(endpoint, perf_counter() - started, response.status_code))
+
+    return response.json() if response.is_success else None
+
+
+async def arun(
+    base_url: str,
+    concurrency: int,
+    requests: int,
+    questions: list[str],
+    messages_per_chat: int = 3,
+    timeout: float = 300,
+) -> tuple[list[Sample], float]:
+    """
+    Send `requests` messages with `concurrency` virtual users.
+
+    Returns:
+        tuple[list[Sample], float]: request results and wall time in seconds
+    """
+    samples: list[Sample] = []
+    sent: int = 0
+    chats: int = 0
+
+    async def auser(client: AsyncClient):
+        nonlocal sent, chats
+
+        while sent < requests:
+            chat: Optional[dict] = await _arequest(
+                client, samples, CREATE_CHAT, "/chat", {}
+            )
+
+            if chat is None:
+                # count the failure against the budget, so a broken API ends the run
+                sent += 1
+                continue
+
+            chat_number: int = chats
+            chats += 1
+
+            for message_number in range(messages_per_chat):
+                if sent >= requests:
+                    break
+
+                question: str = questions[
+                    (chat_number * messages_per_chat + message_number) % len(questions)
+                ]
+                sent += 1
+                await _arequest(
+                    client,
+                    samples,
+                    CREATE_MESSAGE,
+                    f"/chat/{chat['id']}/messages",
+                    {"message": question},
+                )
+
+    async with AsyncClient(
+        base_url=base_url,
+        timeout=Timeout(timeout),
+        limits=Limits(
+            max_connections=concurrency, max_keepalive_connections=concurrency
+        ),
+    ) as client:
+        started: float = perf_counter()
+        await gather(*[auser(client) for _ in range(concurrency)])
+
+        return samples, perf_counter() - started
+
+
+def summarize(samples: list[Sample], duration: float) -> dict[str, dict]:
+    """
+    Get throughput, latency percentiles of successful requests and error rate by
+    endpoint
+    """
+    summary: dict[str, dict] = {}
+
+    for endpoint in sorted({s.endpoint for s in samples}):
+        results: list[Sample] = [s for s in samples if s.endpoint == endpoint]
+        latencies: np.ndarray = np.asarray(
+            [s.latency for s in results if 200 <= s.status < 400]
+        )
+        statuses: dict[str, int] = {}
+
+        for sample in results:
+            statuses[str(sample.status)] = statuses.get(str(sample.status), 0) + 1
+
+        errors: int = len(results) - len(latencies)
+        summary[endpoint] = {
+            "requests": len(results),
+            "errors": errors,
+            "error_rate": errors / len(results),
+            "throughput": len(latencies) / duration if duration else 0,
+            "statuses": statuses,
+        }
+
+        for name, q in (("p50", 50), ("p95", 95), ("p99", 99)):
+            summary[endpoint][name] = (
+                float(np.percentile(latencies, q)) if len(latencies) else None
+            )
+
+        summary[endpoint]["mean"] = float(latencies.mean()) if len(latencies) else None
+
+    return summary
@@ -0,0 +1,304 @@
+"""
+Retrieval sweep - indexes DATA_PATH into throwaway collections for every chunk size and
+overlap, then measures retrieval quality, prompt size and latency for every hybrid
+search alpha and top k on a labelled question set.
+
+A retrieved chunk is relevant if it comes from the question's "source" file, if the
+set has one, otherwise if it contains enough words of the reference answer.
+
+    python -m bench.retrieval --chunk-size 512,1024 --alpha 0.25,0.5,0.75 --top-k 2,4
+"""
+
+import re
+from argparse import ArgumentParser, Namespace
+from asyncio import run, to_thread
+from datetime import datetime
+from itertools import product
+from json import dump, loads
+from logging import getLogger
+from os import makedirs, path
+from time import perf_counter
+from typing import Optional
+
+import numpy as np
+from llama_index.core import (
+    Document,
+    QueryBundle,
+    SimpleDirectoryReader,
+    VectorStoreIndex,
+)
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore
+from llama_index.vector_stores.weaviate import WeaviateVectorStore
+from llama_index.vector_stores.weaviate.utils import create_default_schema
+from pydantic import BaseModel
+
+from rag.app import configure_logging
+from rag.config import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    DATA_PATH,
+    HYBRID_ALPHA,
+    INDEX_NAME,
+    WEAVIATE_SEARCH_TOP_K,
+)
+from rag.db.embedding import CachedEmbedding
+from rag.db.vector import get_embedding_model, get_vector_store
+from rag.modules.budget import TokenBudget
+from rag.modules.embedder import BatchEmbedder
+
+logger = getLogger(__name__)
+
+
+class Question(BaseModel):
+    """Labelled question"""
+
+    question: str
+    answer: str
+    # file name the answer comes from
+    source: Optional[str] = None
+
+
+class SweepResult(BaseModel):
+    """Retrieval metrics of one configuration"""
+
+    chunk_size: int
+    chunk_overlap: int
+    alpha: float
+    top_k: int
+    chunks: int
+    # share of questions with a relevant chunk in top k
+    recall: float
+    mrr: float
+    prompt_tokens: float
+    latency_p50: float
+    latency_p95: float
+
+
+def load_questions(questions_path: str) -> list[Question]:
+    """Load questions from JSONL file with "question", "answer" and "source" fields"""
+    with open(questions_path, encoding="utf-8") as f:
+        return [Question(**loads(line)) for line in f if line.strip()]
+
+
+def _words(text: str) -> set[str]:
+    return set(re.findall(r"\w{4,}", text.lower()))
+
+
+def is_relevant(node: BaseNode, question: Question, min_overlap: float) -> bool:
+    """Check if the chunk answers the question"""
+    if question.source:
+        file_path: str = node.metadata.get("file_path", "")
+        return path.basename(file_path) == path.basename(question.source)
+
+    answer_words: set[str] = _words(question.answer)
+
+    if not answer_words:
+        return False
+
+    overlap: int = len(answer_words & _words(node.get_content()))
+
+    return overlap / len(answer_words) >= min_overlap
+
+
+def _collection_name(chunk_size: int, chunk_overlap: int) -> str:
+    return f"{INDEX_NAME}Sweep{chunk_size}x{chunk_overlap}"
+
+
+async def abuild_collection(
+    documents: list[Document], chunk_size: int, chunk_overlap: int
+) -> tuple[WeaviateVectorStore, int]:
+    """
+    Chunk documents and index them into a new collection, document embeddings are
+    cached, so only new chunks are embedded
+
+    Returns:
+        tuple[WeaviateVectorStore, int]: the collection and the number of chunks
+    """
+    name: str = _collection_name(chunk_size, chunk_overlap)
+    vector_store: WeaviateVectorStore = WeaviateVectorStore(
+        get_vector_store().client, index_name=name
+    )
+    vector_store.clear()
+    create_default_schema(vector_store.client, name)
+
+    nodes: list[BaseNode] = SentenceSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )(documents)
+    logger.info("abuild_collection, name=%s, chunks=%s", name, len(nodes))
+
+    async def write(batch: list[BaseNode]):
+        await to_thread(vector_store.add, batch)
+
+    async def aiter_nodes():
+        for node in nodes:
+            yield node
+
+    failed: list[BaseNode] = await BatchEmbedder(get_embedding_model()).arun(
+        aiter_nodes(), write
+    )
+
+    if failed:
+        logger.warning("abuild_collection, name=%s, failed=%s", name, len(failed))
+
+    return vector_store, len(nodes) - len(failed)
+
+
+def evaluate(
+    retriever: BaseRetriever,
+    questions: list[Question],
+    budget: TokenBudget,
+    min_overlap: float,
+) -> dict:
+    """Retrieve chunks for every question and score them"""
+    ranks: list[Optional[int]] = []
+    tokens: list[int] = []
+    latencies: list[float] = []
+
+    for question in questions:
+        started: float = perf_counter()
+        nodes: list[NodeWithScore] = retriever.retrieve(QueryBundle(question.question))
+        latencies.append(perf_counter() - started)
+
+        ranks.append(
+            next(
+                (
+                    rank
+                    for rank, node in enumerate(nodes, 1)
+                    if is_relevant(node.node, question, min_overlap)
+                ),
+                None,
+            )
+        )
+        context: str = "\n\n".join(
+            n.node.get_content(metadata_mode=MetadataMode.LLM) for n in nodes
+        )
+        tokens.append(
+            budget.count(
+                DEFAULT_TEXT_QA_PROMPT.format(
+                    context_str=context, query_str=question.question
+                )
+            )
+        )
+
+    return {
+        "recall": sum(rank is not None for rank in ranks) / len(ranks),
+        "mrr": sum(1 / rank for rank in ranks if rank is not None) / len(ranks),
+        "prompt_tokens": float(np.mean(tokens)),
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p95": float(np.percentile(latencies, 95)),
+    }
+
+
+async def asweep(args: Namespace) -> list[SweepResult]:
+    """Run every configuration"""
+    questions: list[Question] = load_questions(args.questions)
+    documents: list[Document] = SimpleDirectoryReader(
+        DATA_PATH, recursive=True, exclude=["weaviate"], filename_as_id=True
+    ).load_data()
+    budget: TokenBudget = TokenBudget()
+    embed_model: CachedEmbedding = get_embedding_model()
+    results: list[SweepResult] = []
+
+    # embed questions up front, so latency doesn't depend on the configuration order
+    for question in questions:
+        await embed_model.aget_query_embedding(question.question)
+
+    for chunk_size, chunk_overlap in product(args.chunk_size, args.chunk_overlap):
+        if chunk_overlap >= chunk_size:
+            continue
+
+        vector_store, chunks = await abuild_collection(
+            documents, chunk_size, chunk_overlap
+        )
+        index: VectorStoreIndex = VectorStoreIndex.from_vector_store(
+            vector_store=vector_store, embed_model=embed_model
+        )
+
+        try:
+            for alpha, top_k in product(args.alpha, args.top_k):
+                retriever: BaseRetriever = index.as_retriever(
+                    vector_store_query_mode="hybrid",
+                    similarity_top_k=top_k,
+                    alpha=alpha,
+                )
+                result: SweepResult = SweepResult(
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                    alpha=alpha,
+                    top_k=top_k,
+                    chunks=chunks,
+                    **await to_thread(
+                        evaluate, retriever, questions, budget, args.min_overlap
+                    ),
+                )
+                logger.info("asweep, %s", result)
+                results.append(result)
+        finally:
+            if not args.keep:
+                vector_store.clear()
+
+    return results
+
+
+def print_table(results: list[SweepResult], min_recall: float):
+    """Print results, fastest first, marking the fastest one meeting min_recall"""
+    results = sorted(results, key=lambda r: (r.latency_p50, r.prompt_tokens))
+    best: Optional[SweepResult] = next(
+        (r for r in results if r.recall >= min_recall), None
+    )
+
+    print(
+        f"  {'chunk':>6} {'overlap':>7} {'alpha':>5} {'top_k':>5} {'chunks':>6} "
+        f"{'recall':>6} {'mrr':>5} {'tokens':>7} {'p50':>7} {'p95':>7}"
+    )
+
+    for r in results:
+        print(
+            f"{'*' if r is best else ' '} {r.chunk_size:>6} {r.chunk_overlap:>7} "
+            f"{r.alpha:>5.2f} {r.top_k:>5} {r.chunks:>6} {r.recall:>6.2f} "
+            f"{r.mrr:>5.2f} {r.prompt_tokens:>7.0f} {r.latency_p50 * 1000:>5.0f}ms "
+            f"{r.latency_p95 * 1000:>5.0f}ms"
+        )
+
+    if best is None:
+        print(f"No configuration reaches recall {min_recall}")
+
+
+def _list(item_type: type):
+    return lambda value: [item_type(item) for item in value.split(",") if item]
+
+
+if __name__ == "__main__":
+    parser: ArgumentParser = ArgumentParser(description=__doc__)
+    parser.add_argument("--chunk-size", type=_list(int), default=[CHUNK_SIZE])
+    parser.add_argument("--chunk-overlap", type=_list(int), default=[CHUNK_OVERLAP])
+    parser.add_argument("--alpha", type=_list(float), default=[HYBRID_ALPHA])
+    parser.add_argument("--top-k", type=_list(int), default=[WEAVIATE_SEARCH_TOP_K])
+    parser.add_argument("--questions", default="./tests/question-answers.jsonl")
+    parser.add_argument(
+        "--min-overlap",
+        type=float,
+        default=0.5,
+        help="share of answer words a chunk must contain to be relevant",
+    )
+    parser.add_argument(
+        "--min-recall", type=float, default=0.8, help="quality bar for the best pick"
+    )
+    parser.add_argument("--keep", action="store_true", help="keep sweep collections")
+    parser.add_argument("--output", default="./cache/bench")
+    args: Namespace = parser.parse_args()
+
+    configure_logging()
+    sweep_results: list[SweepResult] = run(asweep(args))
+    print_table(sweep_results, args.min_recall)
+
+    makedirs(args.output, exist_ok=True)
+    output_path: str = path.join(
+        args.output, f"retrieval-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        dump([r.model_dump() for r in sweep_results], f, ensure_ascii=False, indent=2)
@@ -0,0 +1,346 @@
+"""
+Offline load test - runs the API against fake Yandex GPT, Brave Search and web pages,
+sends chat and message requests at several concurrency levels for every API_WORKERS
+value and reports throughput, latency percentiles and error rates. PostgreSQL and
+Weaviate from DATABASE_* and WEAVIATE_* settings are used as is.
+
+With --record the API calls the real services configured in the environment and
+records the calls to a cassette, with --replay the calls are served from the cassette,
+so orchestration overhead is measured on the same responses every run.
+"""
+
+import sys
+from argparse import ArgumentParser, Namespace
+from asyncio import run
+from datetime import datetime
+from json import dump, load, loads
+from logging import getLogger
+from os import environ, makedirs, path
+from signal import SIGTERM
+from socket import socket
+from subprocess import DEVNULL, CalledProcessError, Popen, TimeoutExpired, check_output
+from subprocess import run as run_process
+from time import monotonic, sleep
+from typing import Optional
+
+from httpx import HTTPError, get
+
+from bench import fakes
+from bench import load as load_test
+from rag.app import configure_logging
+
+configure_logging()
+logger = getLogger(__name__)
+
+
+def _free_port() -> int:
+    with socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(url: str, process: Popen, timeout: float):
+    """Wait until the URL responds with 2xx"""
+    deadline: float = monotonic() + timeout
+
+    while monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode}")
+
+        try:
+            if get(url, timeout=5).is_success:
+                return
+        except HTTPError:
+            pass
+
+        sleep(0.5)
+
+    raise TimeoutError(f"{url} isn't ready after {timeout} seconds")
+
+
+def _stop(process: Popen):
+    """Stop the process gracefully, kill it if it hangs"""
+    if process.poll() is not None:
+        return
+
+    process.send_signal(SIGTERM)
+
+    try:
+        process.wait(30)
+    except TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def start_fakes(args: Namespace, work_dir: str) -> tuple[Popen, dict[str, str]]:
+    """
+    Start fake services in a separate process
+
+    Returns:
+        tuple[Popen, dict[str, str]]: the process and environment for the API
+    """
+    grpc_port: int = _free_port()
+    http_port: int = _free_port()
+    command: list[str] = [
+        sys.executable,
+        "-m",
+        "bench.fakes",
+        "--grpc-port",
+        str(grpc_port),
+        "--http-port",
+        str(http_port),
+        "--cert-dir",
+        work_dir,
+    ]
+
+    for name in fakes.FakeSettings.model_fields:
+        command += ["--" + name.replace("_", "-"), str(getattr(args, name))]
+
+    process: Popen = Popen(command)
+    _wait_ready(f"http://127.0.0.1:{http_port}/health", process, 60)
+
+    return process, fakes.api_env(grpc_port, http_port, work_dir)
+
+
+def get_api_env(args: Namespace, fake_env: dict[str, str], work_dir: str) -> dict:
+    """Environment of the API and the indexer"""
+    env: dict[str, str] = {
+        **environ,
+        **fake_env,
+        "INDEX_NAME": args.index_name,
+        "INDEX_VERSION_PATH": path.join(work_dir, "index.version"),
+        "INDEX_MANIFEST_PATH": path.join(work_dir, "index.manifest.json"),
+        "METRICS_DIR": path.join(work_dir, "metrics"),
+        "LOG_LEVEL": args.log_level,
+    }
+
+    if args.record or args.replay:
+        env.update(
+            {
+                "CASSETTE_MODE": "record" if args.record else "replay",
+                "CASSETTE_PATH": path.abspath(args.record or args.replay),
+                "CASSETTE_LATENCY": args.cassette_latency,
+            }
+        )
+
+    if not args.caches:
+        env.update(
+            {
+                "ANSWER_CACHE_ENABLED": "false",
+                "EMBEDDING_CACHE_PATH": "",
+                "INTERNET_CACHE_PATH": "",
+            }
+        )
+
+    return env
+
+
+def load_questions(questions_path: str) -> list[str]:
+    """Load questions from JSONL file with "question" field"""
+    with open(questions_path, encoding="utf-8") as f:
+        return [loads(line)["question"] for line in f if line.strip()]
+
+
+def bench_workers(
+    args: Namespace, env: dict[str, str], workers: int, questions: list[str]
+) -> list[dict]:
+    """Start the API with the number of workers and run every concurrency level"""
+    port: int = _free_port()
+    base_url: str = f"http://127.0.0.1:{port}"
+    logger.info("bench_workers, workers=%s, port=%s", workers, port)
+
+    process: Popen = Popen(
+        [sys.executable, "main.py"],
+        env={**env, "API_WORKERS": str(workers), "API_PORT": str(port)},
+        stdout=None if args.api_output else DEVNULL,
+        stderr=None if args.api_output else DEVNULL,
+    )
+    runs: list[dict] = []
+
+    try:
+        _wait_ready(f"{base_url}/chat?limit=1", process, args.startup_timeout)
+
+        if args.warmup > 0:
+            run(
+                load_test.arun(
+                    base_url, 1, args.warmup, questions, args.messages_per_chat
+                )
+            )
+
+        for concurrency in args.concurrency:
+            samples, duration = run(
+                load_test.arun(
+                    base_url,
+                    concurrency,
+                    args.requests,
+                    questions,
+                    args.messages_per_chat,
+                    args.timeout,
+                )
+            )
+            runs.append(
+                {
+                    "workers": workers,
+                    "concurrency": concurrency,
+                    "duration": duration,
+                    "endpoints": load_test.summarize(samples, duration),
+                }
+            )
+            logger.info(
+                "bench_workers, workers=%s, concurrency=%s, duration=%.1f",
+                workers,
+                concurrency,
+                duration,
+            )
+    finally:
+        _stop(process)
+
+    return runs
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}ms"
+
+
+def _delta(value: Optional[float], baseline: Optional[float]) -> str:
+    if value is None or not baseline:
+        return ""
+
+    return f" ({(value - baseline) / baseline * 100:+.0f}%)"
+
+
+def print_report(results: dict, baseline: Optional[dict] = None):
+    """Print results, with changes relative to the baseline results if given"""
+    previous: dict[tuple, dict] = {}
+
+    for item in (baseline or {}).get("runs", []):
+        for endpoint, stats in item["endpoints"].items():
+            previous[(item["workers"], item["concurrency"], endpoint)] = stats
+
+    print(
+        f"{'workers':>7} {'conc':>5} {'endpoint':<30} {'req/s':>14} "
+        f"{'p50':>8} {'p95':>16} {'p99':>8} {'errors':>7}"
+    )
+
+    for item in results["runs"]:
+        for endpoint, stats in item["endpoints"].items():
+            old: dict = previous.get(
+                (item["workers"], item["concurrency"], endpoint), {}
+            )
+            throughput: str = f"{stats['throughput']:.2f}" + _delta(
+                stats["throughput"], old.get("throughput")
+            )
+            p95: str = _format_seconds(stats["p95"]) + _delta(
+                stats["p95"], old.get("p95")
+            )
+            print(
+                f"{item['workers']:>7} {item['concurrency']:>5} {endpoint:<30} "
+                f"{throughput:>14} {_format_seconds(stats['p50']):>8} {p95:>16} "
+                f"{_format_seconds(stats['p99']):>8} {stats['error_rate']:>7.1%}"
+            )
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def benchmark(args: Namespace) -> dict:
+    """Run the benchmark and save results to the work directory"""
+    work_dir: str = path.abspath(args.work_dir)
+    makedirs(work_dir, exist_ok=True)
+    questions: list[str] = load_questions(args.questions)
+    fakes_process: Optional[Popen] = None
+    fake_env: dict[str, str] = {}
+
+    if not (args.record or args.replay):
+        fakes_process, fake_env = start_fakes(args, work_dir)
+
+    results: dict = {
+        "started_at": datetime.now().isoformat(),
+        "commit": _git_commit(),
+        "settings": {k: v for k, v in vars(args).items() if k != "compare"},
+        "runs": [],
+    }
+
+    try:
+        env: dict[str, str] = get_api_env(args, fake_env, work_dir)
+
+        if args.index:
+            run_process([sys.executable, "indexer.py", "--full"], env=env, check=True)
+
+        for workers in args.workers:
+            results["runs"] += bench_workers(args, env, workers, questions)
+    finally:
+        if fakes_process is not None:
+            _stop(fakes_process)
+
+    results_path: str = path.join(
+        work_dir, f"results-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+
+    with open(results_path, "w", encoding="utf-8") as f:
+        dump(results, f, ensure_ascii=False, indent=2)
+
+    logger.info("benchmark, results saved to %s", results_path)
+
+    return results
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+if __name__ == "__main__":
+    parser: ArgumentParser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--workers", type=_int_list, default=[1, 2, 4], help="API_WORKERS values"
+    )
+    parser.add_argument(
+        "--concurrency", type=_int_list, default=[1, 8, 32], help="virtual users"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="messages per concurrency level"
+    )
+    parser.add_argument("--messages-per-chat", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=5, help="messages before runs")
+    parser.add_argument("--timeout", type=float, default=300, help="request timeout")
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--questions", default="./tests/question-answers.jsonl")
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="index DATA_PATH into INDEX_NAME with fake embeddings first",
+    )
+    parser.add_argument("--index-name", default="Benchmark")
+    parser.add_argument(
+        "--caches", action="store_true", help="keep answer, embedding and page caches"
+    )
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument(
+        "--record", help="cassette to record calls to the real services to"
+    )
+    cassette.add_argument(
+        "--replay", help="cassette to replay calls from instead of fake services"
+    )
+    parser.add_argument(
+        "--cassette-latency",
+        default="recorded",
+        help="replay latency: recorded, zero or a multiplier of recorded latency",
+    )
+    parser.add_argument("--log-level", default="WARNING", help="API log level")
+    parser.add_argument("--api-output", action="store_true", help="show API output")
+    parser.add_argument("--work-dir", default="./cache/bench")
+    parser.add_argument("--compare", help="results file to compare with")
+    fakes.add_arguments(parser)
+    args: Namespace = parser.parse_args()
+
+    baseline: Optional[dict] = None
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = load(f)
+
+    print_report(benchmark(args), baseline)
@@ -1,35 +1,94 @@
-import json
-from logging import getLogger
+"""
+Evaluate answers to labelled questions with an LLM judge. Questions are processed
+concurrently, answers and scores are cached, so re-runs only evaluate what has changed.
+"""
 
-from llama_index.core.evaluation import CorrectnessEvaluator, EvaluationResult
+from argparse import ArgumentParser
+from asyncio import run
+from json import loads
+from logging import getLogger
+from os import makedirs, path
 
 from rag.app import configure_logging
-from rag.llm import get_llm
-from rag.llm.yandex import YandexLLM
-from rag.modules import router
+from rag.config import EVALUATION_CACHE_PATH, EVALUATION_CONCURRENCY
+from rag.db import vector
+from rag.modules import fetcher
+from rag.modules.evaluation import EvaluationReport, Evaluator
+from rag.modules.pipeline import Pipeline, PipelineRegistry
 
 configure_logging()
-dataset = []
 logger = getLogger(__name__)
 
-with open("tests/question-answers.jsonl", encoding="utf-8") as f:
-    for line in f:
-        data = json.loads(line)
-        dataset.append(data)
-
-logger.debug("dataset=%s", dataset)
-llm: YandexLLM = get_llm()
-evaluator = CorrectnessEvaluator(llm)
-avg_score: float = 0
-
-for data in dataset:
-    logger.debug("> %s", data["question"])
-    result: EvaluationResult = evaluator.evaluate(
-        query=data["question"],
-        response=router.run(data["question"]),
-        reference=data["answer"],
+
+def load_dataset(dataset_path: str) -> list[dict]:
+    """Load questions from JSONL file with "question" and "answer" fields"""
+    with open(dataset_path, encoding="utf-8") as f:
+        return [loads(line) for line in f if line.strip()]
+
+
+async def aevaluate(
+    dataset_path: str, concurrency: int, cache_path: str
+) -> EvaluationReport:
+    """Evaluate the dataset with the current pipeline configuration"""
+    dataset: list[dict] = load_dataset(dataset_path)
+    logger.debug("aevaluate, questions=%s", len(dataset))
+    pipeline: Pipeline = await PipelineRegistry().start()
+
+    try:
+        return await Evaluator(pipeline, concurrency, cache_path).arun(dataset)
+    finally:
+        await vector.astop()
+        await fetcher.aclose()
+
+
+def print_report(report: EvaluationReport):
+    """Print per-question results and totals"""
+    print(f"{'score':>5} {'latency':>8} {'tokens':>7} {'cached':>6}  question")
+
+    for item in report.items:
+        score: str = "-" if item.score is None else f"{item.score:.1f}"
+        latency: str = "-" if item.latency is None else f"{item.latency:.1f}s"
+        cached: str = ("a" if item.answer_cached else "") + (
+            "s" if item.score_cached else ""
+        )
+        tokens: int = item.input_tokens + item.completion_tokens
+        print(f"{score:>5} {latency:>8} {tokens:>7} {cached:>6}  {item.question}")
+
+        if item.error:
+            print(f"{'':>30}error: {item.error}")
+
+    print(
+        f"avg_score={report.avg_score:.3f}, passing_rate={report.passing_rate:.3f}, "
+        f"scored={report.scored}/{report.questions}, failed={report.failed}, "
+        f"elapsed={report.elapsed:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser: ArgumentParser = ArgumentParser(description=__doc__)
+    parser.add_argument("--dataset", default="tests/question-answers.jsonl")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=EVALUATION_CONCURRENCY,
+        help="questions processed at once",
+    )
+    parser.add_argument(
+        "--cache-path", default=EVALUATION_CACHE_PATH, help="answer and score cache"
     )
-    logger.debug("result.score=%s, result.passing=%s", result.score, result.passing)
-    avg_score += result.score
+    parser.add_argument(
+        "--report",
+        default="./cache/evaluation-report.json",
+        help="per-question report path",
+    )
+    args = parser.parse_args()
+
+    evaluation_report: EvaluationReport = run(
+        aevaluate(args.dataset, args.concurrency, args.cache_path)
+    )
+    makedirs(path.dirname(args.report) or ".", exist_ok=True)
+
+    with open(args.report, "w", encoding="utf-8") as f:
+        f.write(evaluation_report.model_dump_json(indent=2))
 
-logger.debug("avg_score=%s", avg_score / len(dataset))
+    print_report(evaluation_report)
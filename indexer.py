@@ -2,6 +2,7 @@
 Indexer module
 """
 
+from argparse import ArgumentParser
 from logging import getLogger
 
 from rag.app import configure_logging
@@ -11,11 +12,16 @@ configure_logging()
 logger = getLogger(__name__)
 
 
-def index():
+def index(full: bool = False):
     """Index data from data folder."""
-    logger.debug("index")
-    indexer.run()
+    logger.debug("index, full=%s", full)
+    report: indexer.IndexReport = indexer.run(full)
+    print(report.model_dump_json(indent=2))
 
 
 if __name__ == "__main__":
-    index()
+    parser: ArgumentParser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--full", action="store_true", help="re-index all files from scratch"
+    )
+    index(parser.parse_args().full)
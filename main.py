@@ -2,7 +2,8 @@
 Main app entry point
 """
 
-from contextlib import asynccontextmanager
+from asyncio import CancelledError, Task, create_task
+from contextlib import asynccontextmanager, suppress
 from logging import getLogger
 from os import environ
 
@@ -10,15 +11,28 @@ import uvicorn
 from fastapi import FastAPI
 from fastapi.openapi.docs import get_swagger_ui_html
 
+from rag import metrics
+from rag.api import metrics as metrics_api
 from rag.api.chat import router
-from rag.app import configure_database, configure_logging
+from rag.app import collect_pool_metrics, configure_database, configure_logging
+from rag.config import (
+    JOB_MODE,
+    METRICS_ENABLED,
+    PIPELINE_RELOAD_INTERVAL,
+    PIPELINE_WARMUP,
+)
+from rag.db import vector
+from rag.modules import fetcher
+from rag.modules.pipeline import Pipeline, PipelineRegistry
+from rag.service import writer
+from rag.service.jobs import JobQueue
 
 configure_logging()
 logger = getLogger(__name__)
 
 
 @asynccontextmanager
-async def lifespan(_: FastAPI):
+async def lifespan(app: FastAPI):
     """
     Lifespan event handler
 
@@ -27,10 +41,54 @@ async def lifespan(_: FastAPI):
     """
     logger.info("lifespan, starting up")
     await configure_database()
+
+    app.state.pipelines = PipelineRegistry()
+    pipeline: Pipeline = await app.state.pipelines.start()
+
+    if PIPELINE_WARMUP:
+        try:
+            await pipeline.warm_up()
+        except Exception:
+            logger.exception("lifespan, pipeline warm up failed")
+
+    tasks: list[Task] = []
+
+    if JOB_MODE:
+        app.state.jobs = JobQueue()
+        app.state.jobs.start()
+
+    if PIPELINE_RELOAD_INTERVAL > 0:
+        tasks.append(create_task(app.state.pipelines.watch(PIPELINE_RELOAD_INTERVAL)))
+
+    if METRICS_ENABLED:
+        metrics.register_collector(collect_pool_metrics)
+        metrics.register_collector(lambda: app.state.pipelines.get().collect_metrics())
+
+        if JOB_MODE:
+            metrics.register_collector(app.state.jobs.collect_metrics)
+        tasks.append(create_task(metrics.awatch()))
+
     yield
 
     logger.info("lifespan, shutting down")
 
+    if JOB_MODE:
+        # answers of queued jobs are saved before the writer and pipeline are closed
+        await app.state.jobs.aclose()
+
+    for task in tasks:
+        task.cancel()
+
+        with suppress(CancelledError):
+            await task
+
+    if METRICS_ENABLED:
+        metrics.remove_snapshot()
+
+    await writer.aclose()
+    await vector.astop()
+    await fetcher.aclose()
+
 
 app: FastAPI = FastAPI(
     title="SHL24",
@@ -40,6 +98,10 @@ app: FastAPI = FastAPI(
 )
 app.include_router(router, prefix="/chat", tags=["chat"])
 
+if METRICS_ENABLED:
+    app.include_router(metrics_api.router, tags=["metrics"])
+    app.middleware("http")(metrics_api.measure_requests)
+
 
 @app.get("/docs", include_in_schema=False)
 async def custom_swagger_ui_html():
@@ -0,0 +1,18 @@
+"""
+Database migration - adds columns and indexes introduced after the tables were created.
+Run once after updating, before starting the API.
+"""
+
+from argparse import ArgumentParser
+from asyncio import run
+from logging import getLogger
+
+from rag.app import configure_logging, migrate_database
+
+configure_logging()
+logger = getLogger(__name__)
+
+
+if __name__ == "__main__":
+    ArgumentParser(description=__doc__).parse_args()
+    run(migrate_database())
@@ -1,26 +1,125 @@
+from asyncio import sleep
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+from json import dumps
 from logging import getLogger
+from time import monotonic
+from typing import Any, AsyncGenerator, Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from rag.db.sql.connection import get_db
+from rag import tracing
+from rag.config import (
+    API_MAX_PAGE_SIZE,
+    API_PAGE_SIZE,
+    JOB_MAX_WAIT,
+    JOB_MODE,
+    JOB_POLL_INTERVAL,
+)
+from rag.db.sql.connection import async_session, get_db
 from rag.db.sql.models import Chat, Message
-from rag.dto import ChatResponse, CreateMessagePayload, MessageResponse
+from rag.dto import (
+    ChatPage,
+    ChatResponse,
+    CreateMessagePayload,
+    MessagePage,
+    MessageResponse,
+    TracedMessageResponse,
+)
+from rag.modules.pipeline import Pipeline, get_pipeline
 from rag.service import chat
-from rag.service.handler import process_user_message
+from rag.service.handler import (
+    PENDING,
+    create_pending_answer,
+    process_user_message,
+    stream_user_message,
+)
+from rag.service.jobs import Job, JobQueue, QueueFull, get_jobs
 
 router: APIRouter = APIRouter()
 logger = getLogger(__name__)
 
 
-@router.get("", response_model=list[ChatResponse])
-async def get_chats(db: AsyncSession = Depends(get_db)) -> list[Chat]:
+def _encode_cursor(cursor: Optional[chat.Cursor]) -> Optional[str]:
+    """Encode page cursor as an opaque string"""
+    if cursor is None:
+        return None
+
+    created_at, item_id = cursor
+
+    return urlsafe_b64encode(f"{created_at.isoformat()}|{item_id}".encode()).decode()
+
+
+def _decode_cursor(value: Optional[str]) -> Optional[chat.Cursor]:
+    """Decode page cursor from request parameter"""
+    if value is None:
+        return None
+
+    try:
+        created_at, item_id = urlsafe_b64decode(value.encode()).decode().split("|")
+
+        return datetime.fromisoformat(created_at), UUID(item_id)
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _get_cursors(
+    before: Optional[str], after: Optional[str]
+) -> tuple[Optional[chat.Cursor], Optional[chat.Cursor]]:
+    """Decode "before" and "after" request parameters"""
+    if before is not None and after is not None:
+        raise HTTPException(
+            status_code=400, detail="Only one of before and after can be set"
+        )
+
+    return _decode_cursor(before), _decode_cursor(after)
+
+
+@router.get("", response_model=ChatPage)
+async def get_chats(
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+) -> ChatPage:
+    """
+    Get chats, newest first. Pass next_cursor of the response as "before" to get older
+    chats and prev_cursor as "after" to get newer ones.
+    """
+    logger.debug("get_chats, limit=%s, before=%s, after=%s", limit, before, after)
+    page: chat.Page = await chat.get_chats(db, limit, *_get_cursors(before, after))
+
+    return ChatPage(
+        items=[
+            ChatResponse.model_validate(c, from_attributes=True) for c in page.items
+        ],
+        next_cursor=_encode_cursor(page.next_cursor),
+        prev_cursor=_encode_cursor(page.prev_cursor),
+    )
+
+
+async def _ndjson_stream(chat_id: Optional[UUID] = None) -> AsyncGenerator[str, None]:
+    """Stream messages as NDJSON, one message per line"""
+    # request's session is closed once streaming starts, so a new one is used
+    async with async_session() as db:
+        async for message in chat.stream_messages(db, chat_id):
+            yield MessageResponse.model_validate(
+                message, from_attributes=True
+            ).model_dump_json() + "\n"
+
+
+@router.get("/export")
+async def export_messages() -> StreamingResponse:
     """
-    Get chats
+    Export messages of all chats as NDJSON, grouped by chat, oldest first
     """
-    logger.debug("get_chats")
-    return await chat.get_chats(db)
+    logger.debug("export_messages")
+
+    return StreamingResponse(_ndjson_stream(), media_type="application/x-ndjson")
 
 
 @router.post("", response_model=ChatResponse)
@@ -34,37 +133,270 @@ async def create_chat(
     return await chat.create_chat(db)
 
 
-@router.post("/{chat_id}/messages", response_model=MessageResponse)
+@router.post(
+    "/{chat_id}/messages",
+    response_model=TracedMessageResponse,
+    response_model_exclude_none=True,
+)
 async def create_message(
     chat_id: UUID,
     payload: CreateMessagePayload,
+    request: Request,
+    response: Response,
     db: AsyncSession = Depends(get_db),
-) -> Message:
+    pipeline: Pipeline = Depends(get_pipeline),
+    jobs: Optional[JobQueue] = Depends(get_jobs),
+) -> TracedMessageResponse:
     """
-    Create a new message
+    Create a new message. With "X-Debug-Trace: 1" header the response includes the
+    request trace in the "debug" field.
+
+    In job mode the answer is generated in the background: the response is 202 with
+    the pending answer, poll GET /chat/{chat_id}/messages/{id} for the result.
     """
     logger.debug("create_message, chat_id=%s, payload=%s", chat_id, payload)
+    trace: Optional[tracing.Trace] = tracing.start("create_message", request.headers)
+
+    if JOB_MODE and jobs is not None:
+        return await _create_job(
+            chat_id, payload.message, response, db, pipeline, jobs, trace
+        )
+
+    try:
+        with tracing.use(trace):
+            if not await chat.chat_exists(db, chat_id):
+                raise HTTPException(status_code=404, detail="Chat not found")
+
+            message: Message = await process_user_message(
+                db, chat_id, payload.message, pipeline
+            )
+    finally:
+        await tracing.afinish(trace)
+
+    result: TracedMessageResponse = TracedMessageResponse.model_validate(
+        message, from_attributes=True
+    )
+
+    if trace is not None:
+        response.headers["X-Trace-Id"] = trace.id
+        response.headers["Server-Timing"] = trace.server_timing()
+
+        if trace.debug:
+            result.debug = {"trace": trace.to_dict()}
+
+    return result
+
+
+async def _create_job(
+    chat_id: UUID,
+    message: str,
+    response: Response,
+    db: AsyncSession,
+    pipeline: Pipeline,
+    jobs: JobQueue,
+    trace: Optional[tracing.Trace],
+) -> TracedMessageResponse:
+    """Save the message with a pending answer and queue the answer generation"""
+    answer: Optional[Message] = None
+
+    async def make_job() -> Job:
+        nonlocal answer
+
+        with tracing.use(trace):
+            if not await chat.chat_exists(db, chat_id):
+                raise HTTPException(status_code=404, detail="Chat not found")
+
+            answer = await create_pending_answer(db, chat_id, message)
+
+        return Job(answer.id, message, pipeline, trace)
+
+    try:
+        await jobs.asubmit(make_job)
+    except QueueFull:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many pending messages",
+            headers={"Retry-After": "1"},
+        )
+    finally:
+        # the trace of a queued job is finished by the worker
+        if answer is None:
+            await tracing.afinish(trace)
+
+    response.status_code = 202
+    response.headers["Location"] = f"/chat/{chat_id}/messages/{answer.id}"
+
+    if trace is not None:
+        response.headers["X-Trace-Id"] = trace.id
+
+    return TracedMessageResponse.model_validate(answer, from_attributes=True)
+
+
+def _to_sse(event: str, data: Any) -> str:
+    """Format a Server-Sent Event"""
+    if event == "message":
+        payload: dict = MessageResponse.model_validate(
+            data, from_attributes=True
+        ).model_dump(mode="json")
+    elif event == "token":
+        payload = {"text": data}
+    else:
+        payload = {event: data}
 
+    return f"event: {event}\ndata: {dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def _sse_stream(
+    events: AsyncGenerator[tuple[str, Any], None],
+    trace: Optional[tracing.Trace] = None,
+) -> AsyncGenerator[str, None]:
+    """
+    Convert handler events to Server-Sent Events, the final "trace" event is sent if
+    the client requested it
+    """
+    try:
+        with tracing.use(trace):
+            async for event, data in events:
+                yield _to_sse(event, data)
+    except Exception:
+        logger.exception("_sse_stream, failed to process message")
+        yield _to_sse("error", "Internal server error")
+    finally:
+        await tracing.afinish(trace)
+
+    if trace is not None and trace.debug:
+        yield _to_sse("trace", trace.to_dict())
+
+
+@router.post("/{chat_id}/messages/stream")
+async def create_message_stream(
+    chat_id: UUID,
+    payload: CreateMessagePayload,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    pipeline: Pipeline = Depends(get_pipeline),
+) -> StreamingResponse:
+    """
+    Create a new message and stream the answer as Server-Sent Events: "stage" events
+    while the message is processed, "token" events with parts of the answer and the
+    final "message" event with the saved answer. With "X-Debug-Trace: 1" header the
+    request trace is sent as the last "trace" event.
+    """
+    logger.debug("create_message_stream, chat_id=%s, payload=%s", chat_id, payload)
+    trace: Optional[tracing.Trace] = tracing.start(
+        "create_message_stream", request.headers
+    )
+
+    with tracing.use(trace):
+        if not await chat.chat_exists(db, chat_id):
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+        events: AsyncGenerator[tuple[str, Any], None] = await stream_user_message(
+            db, chat_id, payload.message, pipeline
+        )
+
+    headers: dict[str, str] = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    if trace is not None:
+        headers["X-Trace-Id"] = trace.id
+
+    return StreamingResponse(
+        _sse_stream(events, trace),
+        media_type="text/event-stream",
+        headers=headers,
+    )
+
+
+@router.get("/{chat_id}/messages", response_model=MessagePage)
+async def get_messages(
+    chat_id: UUID,
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+) -> MessagePage:
+    """
+    Get chat messages, newest first. Pass next_cursor of the response as "before" to
+    get older messages and prev_cursor as "after" to get newer ones.
+    """
+    logger.debug(
+        "get_messages, chat_id=%s, limit=%s, before=%s, after=%s",
+        chat_id,
+        limit,
+        before,
+        after,
+    )
+    cursors: tuple = _get_cursors(before, after)
     existing_chat: Chat = await chat.get_chat(db, chat_id)
 
     if not existing_chat:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    return await process_user_message(db, chat_id, payload.message)
+    page: chat.Page = await chat.get_messages(db, chat_id, limit, *cursors)
 
+    return MessagePage(
+        items=[
+            MessageResponse.model_validate(m, from_attributes=True) for m in page.items
+        ],
+        next_cursor=_encode_cursor(page.next_cursor),
+        prev_cursor=_encode_cursor(page.prev_cursor),
+    )
 
-@router.get("/{chat_id}/messages", response_model=list[MessageResponse])
-async def get_messages(
+
+@router.get("/{chat_id}/messages/export")
+async def export_chat_messages(
     chat_id: UUID, db: AsyncSession = Depends(get_db)
-) -> list[Message]:
+) -> StreamingResponse:
     """
-    Get chat messages
+    Export chat messages as NDJSON, oldest first
     """
-    logger.debug("get_messages, chat_id=%s", chat_id)
+    logger.debug("export_chat_messages, chat_id=%s", chat_id)
 
     existing_chat: Chat = await chat.get_chat(db, chat_id)
 
     if not existing_chat:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    return await chat.get_messages(db, chat_id)
+    return StreamingResponse(_ndjson_stream(chat_id), media_type="application/x-ndjson")
+
+
+@router.get("/{chat_id}/messages/{message_id}", response_model=MessageResponse)
+async def get_message(
+    chat_id: UUID,
+    message_id: UUID,
+    response: Response,
+    wait: float = Query(0, ge=0, le=JOB_MAX_WAIT),
+    db: AsyncSession = Depends(get_db),
+    jobs: Optional[JobQueue] = Depends(get_jobs),
+) -> Message:
+    """
+    Get a chat message. If the answer is still "pending", wait up to "wait" seconds
+    until it's ready (long polling).
+    """
+    logger.debug(
+        "get_message, chat_id=%s, message_id=%s, wait=%s", chat_id, message_id, wait
+    )
+    deadline: float = monotonic() + wait
+
+    while True:
+        message: Optional[Message] = await chat.get_message(db, chat_id, message_id)
+
+        if message is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+
+        remaining: float = deadline - monotonic()
+
+        if message.status != PENDING or remaining <= 0:
+            break
+
+        # return the connection to the pool while waiting
+        await db.close()
+
+        # the job may be processed by another API worker, then the database is polled
+        if jobs is None or not await jobs.await_done(message_id, remaining):
+            await sleep(min(JOB_POLL_INTERVAL, remaining))
+
+    if message.status == PENDING:
+        response.headers["Retry-After"] = "1"
+
+    return message
@@ -0,0 +1,51 @@
+from asyncio import to_thread
+from logging import getLogger
+from time import perf_counter
+from typing import Awaitable, Callable
+
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import PlainTextResponse
+
+from rag import metrics
+
+router: APIRouter = APIRouter()
+logger = getLogger(__name__)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """
+    Get metrics of all workers in Prometheus text format
+    """
+    return PlainTextResponse(
+        await to_thread(metrics.render),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+async def measure_requests(
+    request: Request, call_next: Callable[[Request], Awaitable[Response]]
+) -> Response:
+    """
+    Count requests in flight and measure request duration. For streaming responses
+    the duration is measured until the response headers are sent.
+    """
+    metrics.add("rag_http_requests_in_flight", 1)
+    started: float = perf_counter()
+    status: int = 500
+
+    try:
+        response: Response = await call_next(request)
+        status = response.status_code
+
+        return response
+    finally:
+        metrics.add("rag_http_requests_in_flight", -1)
+        route = request.scope.get("route")
+        metrics.observe(
+            "rag_http_request_seconds",
+            perf_counter() - started,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status,
+        )
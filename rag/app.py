@@ -5,7 +5,8 @@ Application configuration and setup.
 from logging import getLogger
 from logging.config import dictConfig
 
-from sqlalchemy import text
+from sqlalchemy import Connection, Pool, inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection
 
 from rag.config import LogConfig
 from rag.db.sql.connection import engine
@@ -36,3 +37,97 @@ async def configure_database():
 
         if not exists:
             await db.run_sync(Base.metadata.create_all)
+        else:
+            missing: list[str] = await db.run_sync(_get_missing_columns)
+
+            if missing:
+                # inserts would fail on every request, so the API doesn't start
+                raise RuntimeError(
+                    f"Missing columns {', '.join(missing)}, run migrate.py"
+                )
+
+
+def _get_missing_columns(connection: Connection) -> list[str]:
+    """Get columns of the models missing in existing tables"""
+    missing: list[str] = []
+
+    for table in Base.metadata.sorted_tables:
+        existing: set[str] = {
+            column["name"] for column in inspect(connection).get_columns(table.name)
+        }
+        missing += [
+            f"{table.name}.{c.name}" for c in table.columns if c.name not in existing
+        ]
+
+    return missing
+
+
+async def migrate_database():
+    """
+    Create missing tables and add columns and indexes created after the tables were.
+    Run once per deployment from a single process: indexes are built concurrently, so
+    writes aren't blocked, and every statement is idempotent.
+    """
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    async with engine.connect() as connection:
+        db: AsyncConnection = await connection.execution_options(
+            isolation_level="AUTOCOMMIT"
+        )
+        await db.run_sync(Base.metadata.create_all)
+
+        for table in Base.metadata.sorted_tables:
+            for column in table.columns:
+                if not column.nullable or column.primary_key:
+                    continue
+
+                column_type: str = column.type.compile(dialect=engine.dialect)
+                logger.info("migrate_database, column %s.%s", table.name, column.name)
+                await db.execute(
+                    text(
+                        f'ALTER TABLE "{table.name}" '
+                        f'ADD COLUMN IF NOT EXISTS "{column.name}" {column_type}'
+                    )
+                )
+
+            for index in table.indexes:
+                columns: str = ", ".join(f'"{c.name}"' for c in index.columns)
+                logger.info("migrate_database, index %s", index.name)
+
+                # an interrupted concurrent build leaves an invalid index behind,
+                # which IF NOT EXISTS would skip
+                if await _is_invalid_index(db, index.name):
+                    logger.warning("migrate_database, rebuilding index %s", index.name)
+                    await db.execute(
+                        text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"')
+                    )
+
+                await db.execute(
+                    text(
+                        f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{index.name}" '
+                        f'ON "{table.name}" ({columns})'
+                    )
+                )
+
+
+async def _is_invalid_index(db: AsyncConnection, name: str) -> bool:
+    """Check if the index exists but its build failed"""
+    result = await db.execute(
+        text(
+            "SELECT NOT i.indisvalid FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+        ),
+        {"name": name},
+    )
+
+    return bool(result.scalar())
+
+
+def collect_pool_metrics() -> list[tuple[str, dict, float]]:
+    """Get SQLAlchemy connection pool usage as metric samples"""
+    pool: Pool = engine.pool
+
+    return [
+        ("rag_db_pool_connections", {"state": "checked_out"}, pool.checkedout()),
+        ("rag_db_pool_connections", {"state": "idle"}, pool.checkedin()),
+        ("rag_db_pool_connections", {"state": "overflow"}, max(pool.overflow(), 0)),
+    ]
@@ -0,0 +1,440 @@
+"""
+Cassette - records calls to external services (Yandex GPT, embeddings, Brave Search,
+web pages) with their timings to a JSONL file and serves them back, so orchestration
+overhead can be benchmarked offline and reproducibly. Calls are matched by kind and
+request, identical calls are replayed in recorded order.
+"""
+
+from asyncio import sleep, to_thread
+from hashlib import sha256
+from json import dumps, loads
+from logging import getLogger
+from os import O_APPEND, O_CREAT, O_WRONLY, close, makedirs, path, write
+from os import open as open_fd
+from threading import Lock
+from time import perf_counter
+from time import sleep as sync_sleep
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+from rag.config import CASSETTE_LATENCY, CASSETTE_MODE, CASSETTE_PATH
+
+logger = getLogger(__name__)
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+class CassetteMiss(LookupError):
+    """No recorded call matches the request"""
+
+
+def _same(value: Any) -> Any:
+    return value
+
+
+def latency_scale(value: str) -> float:
+    """Parse CASSETTE_LATENCY: "recorded", "zero" or a multiplier of recorded latency"""
+    if value == "recorded":
+        return 1.0
+
+    if value == "zero":
+        return 0.0
+
+    return float(value)
+
+
+class Cassette:
+    """Recorded calls of one JSONL file"""
+
+    def __init__(self, mode: str, cassette_path: str, scale: float = 1.0):
+        self.mode: str = mode
+        self.path: str = cassette_path
+        self.scale: float = scale
+
+        self._lock: Lock = Lock()
+        self._entries: dict[str, list[dict]] = {}
+        self._played: dict[str, int] = {}
+
+        if mode == REPLAY:
+            self._load()
+        else:
+            makedirs(path.dirname(cassette_path) or ".", exist_ok=True)
+
+    @staticmethod
+    def key(kind: str, request: Any) -> str:
+        """Hash of call kind and request"""
+        return sha256(
+            dumps([kind, request], sort_keys=True, ensure_ascii=False).encode()
+        ).hexdigest()
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry: dict = loads(line)
+                    self._entries.setdefault(entry["key"], []).append(entry)
+
+        logger.info(
+            "_load, path=%s, calls=%s",
+            self.path,
+            sum(len(entries) for entries in self._entries.values()),
+        )
+
+    def _save(self, kind: str, request: Any, duration: float, **data: Any):
+        """
+        Append the call to the file. A line is written with one append, so several API
+        workers can record to the same file.
+        """
+        entry: dict = {
+            "kind": kind,
+            "key": self.key(kind, request),
+            "request": request,
+            "duration": duration,
+            **data,
+        }
+        fd: int = open_fd(self.path, O_WRONLY | O_APPEND | O_CREAT, 0o644)
+
+        try:
+            write(fd, (dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+        finally:
+            close(fd)
+
+    def _next(self, kind: str, request: Any) -> dict:
+        """Get the next recorded call, the last one is repeated when all are played"""
+        key: str = self.key(kind, request)
+
+        with self._lock:
+            entries: Optional[list[dict]] = self._entries.get(key)
+
+            if not entries:
+                raise CassetteMiss(
+                    f"No recorded {kind} call for {dumps(request)[:200]}"
+                )
+
+            played: int = self._played.get(key, 0)
+            self._played[key] = played + 1
+
+        return entries[min(played, len(entries) - 1)]
+
+    def _delay(self, started: float, offset: float) -> float:
+        return started + offset * self.scale - perf_counter()
+
+    async def acall(
+        self,
+        kind: str,
+        request: Any,
+        call: Callable[[], Awaitable[Any]],
+        encode: Callable[[Any], Any] = _same,
+        decode: Callable[[Any], Any] = _same,
+    ) -> Any:
+        """Record or replay an async call, encode converts the result to JSON"""
+        started: float = perf_counter()
+
+        if self.mode == REPLAY:
+            entry: dict = self._next(kind, request)
+            delay: float = self._delay(started, entry["duration"])
+
+            if delay > 0:
+                await sleep(delay)
+
+            return decode(entry["response"])
+
+        result: Any = await call()
+        await to_thread(
+            self._save, kind, request, perf_counter() - started, response=encode(result)
+        )
+
+        return result
+
+    def call(
+        self,
+        kind: str,
+        request: Any,
+        call: Callable[[], Any],
+        encode: Callable[[Any], Any] = _same,
+        decode: Callable[[Any], Any] = _same,
+    ) -> Any:
+        """Record or replay a call, sync version"""
+        started: float = perf_counter()
+
+        if self.mode == REPLAY:
+            entry: dict = self._next(kind, request)
+            delay: float = self._delay(started, entry["duration"])
+
+            if delay > 0:
+                sync_sleep(delay)
+
+            return decode(entry["response"])
+
+        result: Any = call()
+        self._save(kind, request, perf_counter() - started, response=encode(result))
+
+        return result
+
+    def _replay_batch(self, kind: str, requests: list) -> tuple[list[dict], float]:
+        """Get recorded calls of the items and the duration of the slowest one"""
+        entries: list[dict] = [self._next(kind, request) for request in requests]
+
+        return entries, max((entry["duration"] for entry in entries), default=0)
+
+    def _save_batch(self, kind: str, requests: list, duration: float, results: list):
+        for request, result in zip(requests, results):
+            self._save(kind, request, duration, response=result)
+
+    async def acall_batch(
+        self,
+        kind: str,
+        requests: list,
+        call: Callable[[], Awaitable[list]],
+        encode: Callable[[Any], Any] = _same,
+        decode: Callable[[Any], Any] = _same,
+    ) -> list:
+        """
+        Record or replay a batch call item by item, so batches may be split
+        differently when replayed. A replayed batch takes as long as its slowest item.
+        """
+        started: float = perf_counter()
+
+        if self.mode == REPLAY:
+            entries, duration = self._replay_batch(kind, requests)
+            delay: float = self._delay(started, duration)
+
+            if delay > 0:
+                await sleep(delay)
+
+            return [decode(entry["response"]) for entry in entries]
+
+        results: list = await call()
+        await to_thread(
+            self._save_batch,
+            kind,
+            requests,
+            perf_counter() - started,
+            [encode(result) for result in results],
+        )
+
+        return results
+
+    def call_batch(
+        self,
+        kind: str,
+        requests: list,
+        call: Callable[[], list],
+        encode: Callable[[Any], Any] = _same,
+        decode: Callable[[Any], Any] = _same,
+    ) -> list:
+        """Record or replay a batch call item by item, sync version"""
+        started: float = perf_counter()
+
+        if self.mode == REPLAY:
+            entries, duration = self._replay_batch(kind, requests)
+            delay: float = self._delay(started, duration)
+
+            if delay > 0:
+                sync_sleep(delay)
+
+            return [decode(entry["response"]) for entry in entries]
+
+        results: list = call()
+        self._save_batch(
+            kind,
+            requests,
+            perf_counter() - started,
+            [encode(result) for result in results],
+        )
+
+        return results
+
+    async def astream(
+        self,
+        kind: str,
+        request: Any,
+        stream: Callable[[], AsyncIterator[Any]],
+        encode: Callable[[Any], Any] = _same,
+        decode: Callable[[Any], Any] = _same,
+    ) -> AsyncIterator[Any]:
+        """
+        Record or replay a streaming call, every item is replayed at its recorded
+        offset from the start of the call
+        """
+        started: float = perf_counter()
+
+        if self.mode == REPLAY:
+            entry: dict = self._next(kind, request)
+
+            for offset, item in entry["chunks"]:
+                delay: float = self._delay(started, offset)
+
+                if delay > 0:
+                    await sleep(delay)
+
+                yield decode(item)
+
+            return
+
+        chunks: list[list] = []
+        failed: bool = False
+
+        try:
+            async for item in stream():
+                chunks.append([perf_counter() - started, encode(item)])
+                yield item
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # a stream closed by the consumer is recorded as far as it was read
+            if not failed:
+                await to_thread(
+                    self._save, kind, request, perf_counter() - started, chunks=chunks
+                )
+
+    def stream(
+        self,
+        kind: str,
+        request: Any,
+        stream: Callable[[], Iterator[Any]],
+        encode: Callable[[Any], Any] = _same,
+        decode: Callable[[Any], Any] = _same,
+    ) -> Iterator[Any]:
+        """Record or replay a streaming call, sync version"""
+        started: float = perf_counter()
+
+        if self.mode == REPLAY:
+            entry: dict = self._next(kind, request)
+
+            for offset, item in entry["chunks"]:
+                delay: float = self._delay(started, offset)
+
+                if delay > 0:
+                    sync_sleep(delay)
+
+                yield decode(item)
+
+            return
+
+        chunks: list[list] = []
+        failed: bool = False
+
+        try:
+            for item in stream():
+                chunks.append([perf_counter() - started, encode(item)])
+                yield item
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if not failed:
+                self._save(kind, request, perf_counter() - started, chunks=chunks)
+
+
+_cassette: Optional[Cassette] = None
+
+
+def get_cassette() -> Optional[Cassette]:
+    """Get the cassette configured with CASSETTE_MODE, None if it's off"""
+    global _cassette
+
+    if _cassette is None and CASSETTE_MODE in (RECORD, REPLAY):
+        logger.info("get_cassette, mode=%s, path=%s", CASSETTE_MODE, CASSETTE_PATH)
+        _cassette = Cassette(
+            CASSETTE_MODE, CASSETTE_PATH, latency_scale(CASSETTE_LATENCY)
+        )
+
+    return _cassette
+
+
+async def acall(
+    kind: str,
+    request: Any,
+    call: Callable[[], Awaitable[Any]],
+    encode: Callable[[Any], Any] = _same,
+    decode: Callable[[Any], Any] = _same,
+) -> Any:
+    """Make an async call through the cassette, if it's on"""
+    cassette: Optional[Cassette] = get_cassette()
+
+    if cassette is None:
+        return await call()
+
+    return await cassette.acall(kind, request, call, encode, decode)
+
+
+def call(
+    kind: str,
+    request: Any,
+    call: Callable[[], Any],
+    encode: Callable[[Any], Any] = _same,
+    decode: Callable[[Any], Any] = _same,
+) -> Any:
+    """Make a call through the cassette, if it's on"""
+    cassette: Optional[Cassette] = get_cassette()
+
+    if cassette is None:
+        return call()
+
+    return cassette.call(kind, request, call, encode, decode)
+
+
+async def acall_batch(
+    kind: str,
+    requests: list,
+    call: Callable[[], Awaitable[list]],
+    encode: Callable[[Any], Any] = _same,
+    decode: Callable[[Any], Any] = _same,
+) -> list:
+    """Make an async batch call through the cassette, if it's on"""
+    cassette: Optional[Cassette] = get_cassette()
+
+    if cassette is None:
+        return await call()
+
+    return await cassette.acall_batch(kind, requests, call, encode, decode)
+
+
+def call_batch(
+    kind: str,
+    requests: list,
+    call: Callable[[], list],
+    encode: Callable[[Any], Any] = _same,
+    decode: Callable[[Any], Any] = _same,
+) -> list:
+    """Make a batch call through the cassette, if it's on"""
+    cassette: Optional[Cassette] = get_cassette()
+
+    if cassette is None:
+        return call()
+
+    return cassette.call_batch(kind, requests, call, encode, decode)
+
+
+def astream(
+    kind: str,
+    request: Any,
+    stream: Callable[[], AsyncIterator[Any]],
+    encode: Callable[[Any], Any] = _same,
+    decode: Callable[[Any], Any] = _same,
+) -> AsyncIterator[Any]:
+    """Make a streaming call through the cassette, if it's on"""
+    cassette: Optional[Cassette] = get_cassette()
+
+    if cassette is None:
+        return stream()
+
+    return cassette.astream(kind, request, stream, encode, decode)
+
+
+def stream(
+    kind: str,
+    request: Any,
+    stream: Callable[[], Iterator[Any]],
+    encode: Callable[[Any], Any] = _same,
+    decode: Callable[[Any], Any] = _same,
+) -> Iterator[Any]:
+    """Make a streaming call through the cassette, sync version"""
+    cassette: Optional[Cassette] = get_cassette()
+
+    if cassette is None:
+        return iter(stream())
+
+    return cassette.stream(kind, request, stream, encode, decode)
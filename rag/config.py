@@ -27,10 +27,122 @@ WEAVIATE_SEARCH_TOP_K = int(environ.get("WEAVIATE_SEARCH_TOP_K", 2))
 CHUNK_SIZE = int(environ.get("CHUNK_SIZE", 1024))
 CHUNK_OVERLAP = int(environ.get("CHUNK_OVERLAP", 20))
 BRAVE_SEARCH_API_KEY = environ.get("BRAVE_SEARCH_API_KEY", "")
+BRAVE_SEARCH_URL = environ.get(
+    "BRAVE_SEARCH_URL", "https://api.search.brave.com/res/v1/web/search"
+)
+BRAVE_SEARCH_TIMEOUT = float(environ.get("BRAVE_SEARCH_TIMEOUT", 5))
+INTERNET_FETCH_PAGES = int(environ.get("INTERNET_FETCH_PAGES", 4))
+INTERNET_USE_PAGES = int(environ.get("INTERNET_USE_PAGES", 2))
+INTERNET_FETCH_TIMEOUT = float(environ.get("INTERNET_FETCH_TIMEOUT", 5))
+INTERNET_PAGE_TIMEOUT = float(environ.get("INTERNET_PAGE_TIMEOUT", 5))
+INTERNET_PAGE_MAX_BYTES = int(environ.get("INTERNET_PAGE_MAX_BYTES", 512 * 1024))
+INTERNET_MAX_CONNECTIONS = int(environ.get("INTERNET_MAX_CONNECTIONS", 50))
+INTERNET_MAX_CONNECTIONS_PER_HOST = int(
+    environ.get("INTERNET_MAX_CONNECTIONS_PER_HOST", 4)
+)
+INTERNET_CACHE_PATH = environ.get("INTERNET_CACHE_PATH", "./cache/internet.sqlite3")
+INTERNET_CACHE_SIZE = int(environ.get("INTERNET_CACHE_SIZE", 10000))
+INTERNET_SEARCH_CACHE_TTL = float(environ.get("INTERNET_SEARCH_CACHE_TTL", 3600))
+INTERNET_PAGE_CACHE_TTL = float(environ.get("INTERNET_PAGE_CACHE_TTL", 86400))
 LOG_LEVEL = environ.get("LOG_LEVEL", "DEBUG")
 
 YANDEX_API_KEY = environ.get("YANDEX_API_KEY", "")
 YANDEX_FOLDER_ID = environ.get("YANDEX_FOLDER_ID", "")
+YANDEX_API_URL = environ.get("YANDEX_API_URL", "llm.api.cloud.yandex.net:443")
+
+EMBEDDING_CACHE_PATH = environ.get("EMBEDDING_CACHE_PATH", "./cache/embeddings.sqlite3")
+EMBEDDING_CACHE_MEMORY_SIZE = int(environ.get("EMBEDDING_CACHE_MEMORY_SIZE", 10000))
+EMBEDDING_CACHE_SIZE = int(environ.get("EMBEDDING_CACHE_SIZE", 1000000))
+EMBEDDING_BATCH_SIZE = int(environ.get("EMBEDDING_BATCH_SIZE", 50))
+EMBEDDING_CONCURRENCY = int(environ.get("EMBEDDING_CONCURRENCY", 4))
+EMBEDDING_RETRIES = int(environ.get("EMBEDDING_RETRIES", 3))
+EMBEDDING_MAX_BACKOFF = float(environ.get("EMBEDDING_MAX_BACKOFF", 60))
+INDEXER_WORKERS = int(environ.get("INDEXER_WORKERS", 0))
+INDEXER_QUEUE_SIZE = int(environ.get("INDEXER_QUEUE_SIZE", 8))
+
+ANSWER_CACHE_ENABLED = environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIZE = int(environ.get("ANSWER_CACHE_SIZE", 1000))
+ANSWER_CACHE_TTL = float(environ.get("ANSWER_CACHE_TTL", 3600))
+ANSWER_CACHE_SIMILARITY = float(environ.get("ANSWER_CACHE_SIMILARITY", 0.95))
+INDEX_VERSION_PATH = environ.get("INDEX_VERSION_PATH", "./weaviate/index.version")
+INDEX_MANIFEST_PATH = environ.get(
+    "INDEX_MANIFEST_PATH", "./weaviate/index.manifest.json"
+)
+
+GUARD_EXAMPLES_PATH = environ.get("GUARD_EXAMPLES_PATH", "./tests/guard-examples.jsonl")
+GUARD_BENIGN_THRESHOLD = float(environ.get("GUARD_BENIGN_THRESHOLD", 0.35))
+GUARD_ATTACK_THRESHOLD = float(environ.get("GUARD_ATTACK_THRESHOLD", 0.8))
+GUARD_CACHE_SIZE = int(environ.get("GUARD_CACHE_SIZE", 10000))
+
+# LLM context window is 8000 tokens, 2000 of them are reserved for the answer
+AGENT_CONTEXT_BUDGET = int(environ.get("AGENT_CONTEXT_BUDGET", 6000))
+AGENT_TOOL_OUTPUT_TOKENS = int(environ.get("AGENT_TOOL_OUTPUT_TOKENS", 1000))
+
+ROUTER_MODE = environ.get("ROUTER_MODE", "llm")
+ROUTER_EXAMPLES_PATH = environ.get(
+    "ROUTER_EXAMPLES_PATH", "./tests/router-examples.jsonl"
+)
+ROUTER_MIN_SCORE = float(environ.get("ROUTER_MIN_SCORE", 0.5))
+ROUTER_MARGIN = float(environ.get("ROUTER_MARGIN", 0.05))
+ROUTER_DECISIONS_PATH = environ.get("ROUTER_DECISIONS_PATH", "")
+ROUTER_SPECULATIVE = environ.get("ROUTER_SPECULATIVE", "false").lower() == "true"
+ROUTER_SPECULATION_LIMITS = {
+    name.strip(): int(limit)
+    for name, limit in (
+        item.split("=")
+        for item in environ.get(
+            "ROUTER_SPECULATION_LIMITS", "database_search_tool=32"
+        ).split(",")
+        if item.strip()
+    )
+}
+
+PIPELINE_WARMUP = environ.get("PIPELINE_WARMUP", "true").lower() == "true"
+PIPELINE_RELOAD_INTERVAL = float(environ.get("PIPELINE_RELOAD_INTERVAL", 0))
+API_PAGE_SIZE = int(environ.get("API_PAGE_SIZE", 50))
+API_MAX_PAGE_SIZE = int(environ.get("API_MAX_PAGE_SIZE", 500))
+EXPORT_FETCH_SIZE = int(environ.get("EXPORT_FETCH_SIZE", 1000))
+MESSAGE_WRITE_DELAY = float(environ.get("MESSAGE_WRITE_DELAY", 0))
+MESSAGE_WRITE_BATCH_SIZE = int(environ.get("MESSAGE_WRITE_BATCH_SIZE", 100))
+METRICS_ENABLED = environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_DIR = environ.get("METRICS_DIR", "./cache/metrics")
+METRICS_INTERVAL = float(environ.get("METRICS_INTERVAL", 5))
+TRACE_ENABLED = environ.get("TRACE_ENABLED", "true").lower() == "true"
+TRACE_SAMPLE_RATE = float(environ.get("TRACE_SAMPLE_RATE", 0))
+TRACE_PERSIST = environ.get("TRACE_PERSIST", "false").lower() == "true"
+TRACE_DIR = environ.get("TRACE_DIR", "")
+EVALUATION_CONCURRENCY = int(environ.get("EVALUATION_CONCURRENCY", 4))
+EVALUATION_CACHE_PATH = environ.get(
+    "EVALUATION_CACHE_PATH", "./cache/evaluation.sqlite3"
+)
+CASSETTE_MODE = environ.get("CASSETTE_MODE", "")
+CASSETTE_PATH = environ.get("CASSETTE_PATH", "./cache/cassette.jsonl")
+CASSETTE_LATENCY = environ.get("CASSETTE_LATENCY", "recorded")
+JOB_MODE = environ.get("JOB_MODE", "false").lower() == "true"
+JOB_WORKERS = int(environ.get("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(environ.get("JOB_QUEUE_SIZE", 100))
+JOB_MAX_WAIT = float(environ.get("JOB_MAX_WAIT", 30))
+JOB_POLL_INTERVAL = float(environ.get("JOB_POLL_INTERVAL", 0.5))
+JOB_DRAIN_TIMEOUT = float(environ.get("JOB_DRAIN_TIMEOUT", 60))
+
+
+class PipelineConfig(BaseModel):
+    """Query pipeline configuration, can be re-read at runtime"""
+
+    hybrid_alpha: float = HYBRID_ALPHA
+    search_top_k: int = WEAVIATE_SEARCH_TOP_K
+    brave_search_api_key: str = BRAVE_SEARCH_API_KEY
+
+    @classmethod
+    def from_env(cls) -> "PipelineConfig":
+        """Re-read configuration from environment and .env file"""
+        load_dotenv(override=True)
+
+        return cls(
+            hybrid_alpha=float(environ.get("HYBRID_ALPHA", 0.5)),
+            search_top_k=int(environ.get("WEAVIATE_SEARCH_TOP_K", 2)),
+            brave_search_api_key=environ.get("BRAVE_SEARCH_API_KEY", ""),
+        )
 
 
 class LogConfig(BaseModel):
@@ -0,0 +1,151 @@
+"""
+Local on-disk key-value cache backed by SQLite.
+"""
+
+import sqlite3
+from logging import getLogger
+from os import makedirs, path
+from threading import Lock
+from time import time
+from typing import Iterable, Optional
+
+logger = getLogger(__name__)
+
+# SQLite limits the number of variables in one statement
+BATCH_SIZE = 500
+# share of max_items a cache may grow over before it's evicted
+EVICT_SLACK = 0.1
+
+
+class DiskCache:
+    """
+    Key-value cache in a SQLite table. Values are bytes, every entry keeps its creation
+    and last access time for TTL checks and LRU eviction. Safe to use from several
+    threads and processes.
+    """
+
+    def __init__(self, db_path: str, table: str):
+        logger.debug("__init__, db_path=%s, table=%s", db_path, table)
+        makedirs(path.dirname(db_path) or ".", exist_ok=True)
+
+        self.table: str = table
+        self._lock: Lock = Lock()
+        self._db: sqlite3.Connection = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._db.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)"
+        )
+        # upper estimate of the number of entries, replaced keys are counted as new
+        self._count: int = self._count_entries()
+
+    def _count_entries(self) -> int:
+        return self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def get_many(
+        self, keys: Iterable[str], max_age: Optional[float] = None
+    ) -> dict[str, bytes]:
+        """
+        Get values by keys, missing and expired keys are not included in the result.
+
+        Args:
+            keys (Iterable[str]): keys to look up
+            max_age (float): max entry age in seconds, no limit by default
+        """
+        keys = list(keys)
+        result: dict[str, bytes] = {}
+        min_created_at: float = time() - max_age if max_age is not None else 0
+
+        with self._lock:
+            for start in range(0, len(keys), BATCH_SIZE):
+                batch: list[str] = keys[start : start + BATCH_SIZE]
+                placeholders: str = ",".join("?" * len(batch))
+                rows: list[tuple[str, bytes]] = self._db.execute(
+                    f"SELECT key, value FROM {self.table} "
+                    f"WHERE key IN ({placeholders}) AND created_at >= ?",
+                    [*batch, min_created_at],
+                ).fetchall()
+                result.update(rows)
+
+            if result:
+                now: float = time()
+                self._db.executemany(
+                    f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?",
+                    [(now, key) for key in result],
+                )
+
+        return result
+
+    def get(self, key: str, max_age: Optional[float] = None) -> Optional[bytes]:
+        """Get value by key"""
+        return self.get_many([key], max_age).get(key)
+
+    def set_many(self, items: dict[str, bytes]):
+        """Save values"""
+        now: float = time()
+
+        with self._lock:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO {self.table} "
+                "(key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, value, now, now) for key, value in items.items()],
+            )
+            self._count += len(items)
+
+    def set(self, key: str, value: bytes):
+        """Save value"""
+        self.set_many({key: value})
+
+    def evict(self, max_items: int, slack: float = EVICT_SLACK) -> int:
+        """
+        Remove least recently used entries down to max_items, once there are more than
+        max_items * (1 + slack) of them, so entries are removed in bulk, not on every
+        save. Entries are counted only when the estimate kept in memory is over the
+        limit, entries saved by other processes are found then.
+
+        Returns:
+            int: number of removed entries
+        """
+        with self._lock:
+            if self._count - max_items <= max_items * slack:
+                return 0
+
+            self._count = self._count_entries()
+            excess: int = self._count - max_items
+
+            if excess <= max_items * slack:
+                return 0
+
+            # the oldest entries are read from the accessed_at index, without sorting
+            cursor: sqlite3.Cursor = self._db.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)",
+                [excess],
+            )
+
+            self._count -= cursor.rowcount
+
+        logger.debug("evict, table=%s, removed=%s", self.table, cursor.rowcount)
+
+        return cursor.rowcount
+
+    def count(self) -> int:
+        """Get number of entries"""
+        with self._lock:
+            self._count = self._count_entries()
+
+            return self._count
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._db.execute(f"DELETE FROM {self.table}")
+            self._count = 0
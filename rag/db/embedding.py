@@ -0,0 +1,194 @@
+"""
+Caching embedding model - content-addressed embedding cache shared by the indexer and
+the query path. Embeddings are looked up in memory, then on disk, only misses are
+sent to the embedding API.
+"""
+
+from asyncio import to_thread
+from collections import OrderedDict
+from hashlib import sha256
+from logging import getLogger
+from threading import Lock
+from typing import Any, Awaitable, Callable, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from rag import cassette
+from rag.db.cache import DiskCache
+
+logger = getLogger(__name__)
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model wrapper with in-memory LRU and on-disk cache tiers"""
+
+    model: BaseEmbedding
+    query_model_name: str
+    doc_model_name: str
+    memory_size: int = 10000
+    disk_size: int = 1000000
+
+    _disk: Optional[DiskCache] = PrivateAttr(default=None)
+    _memory: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _lock: Lock = PrivateAttr(default_factory=Lock)
+    _hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+
+    def __init__(self, disk: Optional[DiskCache] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._disk = disk
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _key(self, model_name: str, text: str) -> str:
+        """Cache key - hash of model name and text"""
+        return sha256(f"{model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: list[str]) -> dict[str, Embedding]:
+        """Look up embeddings in memory, then on disk"""
+        result: dict[str, Embedding] = {}
+
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    result[key] = self._memory[key]
+
+        missing: list[str] = [key for key in keys if key not in result]
+
+        if missing and self._disk is not None:
+            for key, value in self._disk.get_many(missing).items():
+                result[key] = np.frombuffer(value, dtype=np.float32).tolist()
+
+            self._remember({k: v for k, v in result.items() if k in missing})
+
+        with self._lock:
+            self._hits += len(result)
+            self._misses += len(keys) - len(result)
+
+        return result
+
+    def _remember(self, embeddings: dict[str, Embedding]):
+        """Put embeddings to the memory tier"""
+        with self._lock:
+            for key, embedding in embeddings.items():
+                self._memory[key] = embedding
+                self._memory.move_to_end(key)
+
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _store(self, embeddings: dict[str, Embedding]):
+        """Save new embeddings to both tiers, evicting old ones from disk"""
+        self._remember(embeddings)
+
+        if self._disk is not None:
+            self._disk.set_many(
+                {
+                    key: np.asarray(embedding, dtype=np.float32).tobytes()
+                    for key, embedding in embeddings.items()
+                }
+            )
+            self._disk.evict(self.disk_size)
+
+    def _embed(
+        self,
+        model_name: str,
+        texts: list[str],
+        embed: Callable[[list[str]], list[Embedding]],
+    ) -> list[Embedding]:
+        """Get embeddings, calling the model for cache misses only"""
+        if cassette.get_cassette() is not None:
+            # cache state would change which texts are requested, so it's bypassed
+            return cassette.call_batch(
+                "embedding",
+                [{"model": model_name, "text": text} for text in texts],
+                lambda: embed(texts),
+            )
+
+        keys: list[str] = [self._key(model_name, text) for text in texts]
+        found: dict[str, Embedding] = self._lookup(keys)
+        missing: dict[str, str] = {
+            key: text for key, text in zip(keys, texts) if key not in found
+        }
+
+        if missing:
+            logger.debug("_embed, cache misses=%s of %s", len(missing), len(texts))
+            embeddings: list[Embedding] = embed(list(missing.values()))
+            new: dict[str, Embedding] = dict(zip(missing.keys(), embeddings))
+            self._store(new)
+            found.update(new)
+
+        return [found[key] for key in keys]
+
+    async def _aembed(
+        self,
+        model_name: str,
+        texts: list[str],
+        embed: Callable[[list[str]], Awaitable[list[Embedding]]],
+    ) -> list[Embedding]:
+        """Get embeddings, calling the model for cache misses only, async version"""
+        if cassette.get_cassette() is not None:
+            return await cassette.acall_batch(
+                "embedding",
+                [{"model": model_name, "text": text} for text in texts],
+                lambda: embed(texts),
+            )
+
+        keys: list[str] = [self._key(model_name, text) for text in texts]
+        found: dict[str, Embedding] = await to_thread(self._lookup, keys)
+        missing: dict[str, str] = {
+            key: text for key, text in zip(keys, texts) if key not in found
+        }
+
+        if missing:
+            logger.debug("_aembed, cache misses=%s of %s", len(missing), len(texts))
+            embeddings: list[Embedding] = await embed(list(missing.values()))
+            new: dict[str, Embedding] = dict(zip(missing.keys(), embeddings))
+            await to_thread(self._store, new)
+            found.update(new)
+
+        return [found[key] for key in keys]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed(
+            self.query_model_name,
+            [query],
+            lambda texts: [self.model.get_query_embedding(texts[0])],
+        )[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        async def embed(texts: list[str]) -> list[Embedding]:
+            return [await self.model.aget_query_embedding(texts[0])]
+
+        return (await self._aembed(self.query_model_name, [query], embed))[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: list[str]) -> list[Embedding]:
+        return self._embed(
+            self.doc_model_name,
+            texts,
+            lambda missing: self.model.get_text_embedding_batch(missing),
+        )
+
+    async def _aget_text_embeddings(self, texts: list[str]) -> list[Embedding]:
+        return await self._aembed(
+            self.doc_model_name, texts, self.model.aget_text_embedding_batch
+        )
+
+    def stats(self) -> dict:
+        """Get cache counters"""
+        return {
+            "memory_size": len(self._memory),
+            "hits": self._hits,
+            "misses": self._misses,
+        }
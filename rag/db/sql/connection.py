@@ -12,10 +12,12 @@ from sqlalchemy.ext.asyncio import (
 )
 from sqlalchemy.orm import DeclarativeBase
 
+from rag import tracing
 from rag.config import DATABASE_URL
 
 engine = create_async_engine(DATABASE_URL)
 async_session = async_sessionmaker(autocommit=False, autoflush=False, bind=engine)
+tracing.instrument_engine(engine.sync_engine)
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -3,10 +3,10 @@ SQL models
 """
 
 from datetime import UTC, datetime
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .connection import Base
@@ -18,6 +18,8 @@ class Chat(Base):
     """
 
     __tablename__ = "chat"
+    # keyset pagination of chats by (created_at, id)
+    __table_args__ = (Index("ix_chat_created_at", "created_at", "id"),)
 
     id: Mapped[UUID] = mapped_column(primary_key=True)
 
@@ -36,11 +38,20 @@ class Message(Base):
     """
 
     __tablename__ = "message"
+    # keyset pagination of chat messages by (created_at, id)
+    __table_args__ = (
+        Index("ix_message_chat_id_created_at", "chat_id", "created_at", "id"),
+    )
 
     id: Mapped[UUID] = mapped_column(primary_key=True)
     chat_id: Mapped[UUID] = mapped_column(ForeignKey("chat.id"))
     is_system: Mapped[bool] = mapped_column(nullable=False)
     message: Mapped[str] = mapped_column(nullable=False)
+    # request trace of system messages, JSON, saved if TRACE_PERSIST is set
+    trace: Mapped[Optional[str]] = mapped_column(nullable=True)
+    # answer status in job mode: "pending" until it's ready, "failed" if processing
+    # failed, empty for complete messages
+    status: Mapped[Optional[str]] = mapped_column(nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(
         nullable=False, default=datetime.utcnow
@@ -6,21 +6,36 @@ from logging import getLogger
 from typing import Optional
 
 from langchain_community.embeddings.yandex import YandexGPTEmbeddings
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.embeddings.langchain import LangchainEmbedding
 from llama_index.vector_stores.weaviate import WeaviateVectorStore
 
+from rag import tracing
 from rag.config import (
+    EMBEDDING_CACHE_MEMORY_SIZE,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_SIZE,
     INDEX_NAME,
     WEAVIATE_HOST,
     WEAVIATE_PORT,
     YANDEX_API_KEY,
+    YANDEX_API_URL,
     YANDEX_FOLDER_ID,
 )
-from weaviate import WeaviateClient, connect_to_local
+from rag.db.cache import DiskCache
+from rag.db.embedding import CachedEmbedding
+from weaviate import (
+    WeaviateAsyncClient,
+    WeaviateClient,
+    connect_to_local,
+    use_async_with_local,
+)
 
 _client: Optional[WeaviateClient] = None
 _store: Optional[WeaviateVectorStore] = None
-_model: Optional[LangchainEmbedding] = None
+_async_client: Optional[WeaviateAsyncClient] = None
+_async_store: Optional[WeaviateVectorStore] = None
+_model: Optional[CachedEmbedding] = None
 
 logger = getLogger(__name__)
 
@@ -41,9 +56,29 @@ def get_vector_store() -> WeaviateVectorStore:
     return _store
 
 
-def get_embedding_model() -> LangchainEmbedding:
+async def get_async_vector_store() -> WeaviateVectorStore:
+    """
+    Get the Weaviate vector store backed by an async client, it supports only async
+    methods (aquery, async_add, ...).
+    """
+    global _async_client
+    global _async_store
+
+    if _async_store is not None:
+        return _async_store
+
+    if _async_client is None:
+        _async_client = use_async_with_local(host=WEAVIATE_HOST, port=WEAVIATE_PORT)
+        await _async_client.connect()
+
+    _async_store = WeaviateVectorStore(_async_client, index_name=INDEX_NAME)
+
+    return _async_store
+
+
+def get_embedding_model() -> CachedEmbedding:
     """
-    Get embedding model
+    Get embedding model, wrapped with embedding cache
     """
     global _model
 
@@ -51,13 +86,36 @@ def get_embedding_model() -> LangchainEmbedding:
         return _model
 
     logger.debug("get_embedding_model, loading model")
-    _model = LangchainEmbedding(
-        YandexGPTEmbeddings(api_key=YANDEX_API_KEY, folder_id=YANDEX_FOLDER_ID)
+    embeddings: YandexGPTEmbeddings = YandexGPTEmbeddings(
+        api_key=YANDEX_API_KEY, folder_id=YANDEX_FOLDER_ID, url=YANDEX_API_URL
+    )
+    model: BaseEmbedding = LangchainEmbedding(embeddings)
+
+    _model = CachedEmbedding(
+        model=model,
+        query_model_name=embeddings.model_uri,
+        doc_model_name=embeddings.doc_model_uri,
+        memory_size=EMBEDDING_CACHE_MEMORY_SIZE,
+        disk_size=EMBEDDING_CACHE_SIZE,
+        embed_batch_size=100,
+        disk=(
+            DiskCache(EMBEDDING_CACHE_PATH, "embedding")
+            if EMBEDDING_CACHE_PATH
+            else None
+        ),
     )
+    tracing.instrument(_model.callback_manager)
 
     return _model
 
 
+async def is_ready() -> bool:
+    """Connect to Weaviate with an async client and check that it's ready"""
+    await get_async_vector_store()
+
+    return await _async_client.is_ready()
+
+
 def stop():
     """Stop weaviate"""
     global _client
@@ -65,3 +123,14 @@ def stop():
     if _client is not None:
         del _client
         _client = None
+
+
+async def astop():
+    """Close async weaviate client"""
+    global _async_client
+    global _async_store
+
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+        _async_store = None
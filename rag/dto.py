@@ -3,6 +3,7 @@ Data transfer objects for chat and message
 """
 
 from datetime import datetime
+from typing import Optional
 from uuid import UUID
 
 from pydantic import BaseModel
@@ -35,3 +36,37 @@ class MessageResponse(BaseModel):
     message: str
     created_at: datetime
     is_system: bool
+    # "pending" or "failed" for answers processed in job mode
+    status: Optional[str] = None
+
+
+class TracedMessageResponse(MessageResponse):
+    """
+    Message response with the request trace, if requested with X-Debug-Trace header
+    """
+
+    debug: Optional[dict] = None
+
+
+class ChatPage(BaseModel):
+    """
+    Page of chats, newest first
+    """
+
+    items: list[ChatResponse]
+    # cursor of older chats, pass as "before" to get the next page
+    next_cursor: Optional[str] = None
+    # cursor of newer chats, pass as "after" to get the previous page
+    prev_cursor: Optional[str] = None
+
+
+class MessagePage(BaseModel):
+    """
+    Page of chat messages, newest first
+    """
+
+    items: list[MessageResponse]
+    # cursor of older messages, pass as "before" to get the next page
+    next_cursor: Optional[str] = None
+    # cursor of newer messages, pass as "after" to get the previous page
+    prev_cursor: Optional[str] = None
@@ -7,7 +7,8 @@ from typing import Optional
 
 from langchain_community.chat_models import ChatYandexGPT
 
-from rag.config import YANDEX_API_KEY, YANDEX_FOLDER_ID
+from rag import tracing
+from rag.config import YANDEX_API_KEY, YANDEX_API_URL, YANDEX_FOLDER_ID
 from rag.llm.yandex import YandexLLM
 
 _model: Optional[YandexLLM] = None
@@ -29,7 +30,9 @@ def get_llm() -> YandexLLM:
             folder_id=YANDEX_FOLDER_ID,
             model_name="yandexgpt",
             temperature=0.01,
+            url=YANDEX_API_URL,
         )
     )
+    tracing.instrument(_model.callback_manager)
 
     return _model
@@ -2,12 +2,21 @@
 Yandex GPT LLM for LlamaIndex
 """
 
-from logging import getLogger
-from typing import Any, Generator, Sequence
+from asyncio import AbstractEventLoop, get_running_loop
+from contextlib import contextmanager
+from logging import WARNING, getLogger
+from typing import Any, AsyncGenerator, Generator, Iterator, Optional, Sequence
 
+from google.protobuf.json_format import MessageToDict, ParseDict
+from google.protobuf.wrappers_pb2 import DoubleValue, Int64Value
+from grpc import Channel as SyncChannel
+from grpc import secure_channel as sync_secure_channel
+from grpc import ssl_channel_credentials
+from grpc.aio import AioRpcError, Channel, secure_channel
 from langchain_community.chat_models.yandex import ChatYandexGPT
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
 from llama_index.core.base.llms.types import CompletionResponse
+from llama_index.core.bridge.pydantic import PrivateAttr
 from llama_index.core.llms import (
     LLM,
     ChatMessage,
@@ -19,9 +28,66 @@ from llama_index.core.llms import (
     MessageRole,
 )
 from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from tenacity import (
+    AsyncRetrying,
+    before_sleep_log,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+from yandex.cloud.ai.foundation_models.v1.text_common_pb2 import (
+    CompletionOptions,
+    Message,
+)
+from yandex.cloud.ai.foundation_models.v1.text_generation.text_generation_service_pb2 import (
+    CompletionRequest,
+)
+from yandex.cloud.ai.foundation_models.v1.text_generation.text_generation_service_pb2 import (
+    CompletionResponse as YandexCompletionResponse,
+)
+from yandex.cloud.ai.foundation_models.v1.text_generation.text_generation_service_pb2_grpc import (
+    TextGenerationServiceStub,
+)
+
+from rag import cassette, metrics
 
 logger = getLogger(__name__)
 
+ROLES: dict[MessageRole, str] = {
+    MessageRole.USER: "user",
+    MessageRole.SYSTEM: "system",
+    MessageRole.ASSISTANT: "assistant",
+}
+
+
+@contextmanager
+def _measure(method: str) -> Iterator[None]:
+    """Count LLM call by status and measure its duration"""
+    status: str = "error"
+
+    try:
+        with metrics.timer("rag_llm_request_seconds", method=method):
+            yield
+
+        status = "ok"
+    finally:
+        metrics.inc("rag_llm_requests_total", method=method, status=status)
+
+
+def _count_tokens(response: Optional[YandexCompletionResponse]):
+    """Count tokens reported in the response"""
+    if response is not None and response.HasField("usage"):
+        metrics.inc(
+            "rag_llm_tokens_total", response.usage.input_text_tokens, kind="input"
+        )
+        metrics.inc(
+            "rag_llm_tokens_total", response.usage.completion_tokens, kind="completion"
+        )
+
+
+def _response_from_dict(data: dict) -> YandexCompletionResponse:
+    return ParseDict(data, YandexCompletionResponse())
+
 
 class YandexLLM(LLM):
     """
@@ -30,6 +96,10 @@ class YandexLLM(LLM):
 
     yandex_gpt: ChatYandexGPT
 
+    _channel: Optional[Channel] = PrivateAttr(default=None)
+    _channel_loop: Optional[AbstractEventLoop] = PrivateAttr(default=None)
+    _sync_channel: Optional[SyncChannel] = PrivateAttr(default=None)
+
     @property
     def metadata(self) -> LLMMetadata:
         """
@@ -46,6 +116,157 @@ class YandexLLM(LLM):
             is_function_calling_model=False,
         )
 
+    def _get_channel(self) -> Channel:
+        """
+        Get a shared gRPC channel, so async calls reuse one HTTP/2 connection instead of
+        opening a new one per call. A channel is bound to an event loop, so it's
+        recreated if the loop has changed.
+        """
+        loop: AbstractEventLoop = get_running_loop()
+
+        if self._channel is None or self._channel_loop is not loop:
+            logger.debug("_get_channel, opening channel to %s", self.yandex_gpt.url)
+            self._channel = secure_channel(
+                self.yandex_gpt.url, ssl_channel_credentials()
+            )
+            self._channel_loop = loop
+
+        return self._channel
+
+    def _get_sync_channel(self) -> SyncChannel:
+        """Get a shared gRPC channel for sync streaming calls"""
+        if self._sync_channel is None:
+            self._sync_channel = sync_secure_channel(
+                self.yandex_gpt.url, ssl_channel_credentials()
+            )
+
+        return self._sync_channel
+
+    async def aconnect(self):
+        """Open the shared channel and wait until it's connected"""
+        await self._get_channel().channel_ready()
+
+    def _build_request(
+        self, messages: Sequence[ChatMessage], stream: bool = False
+    ) -> CompletionRequest:
+        """Build a Yandex GPT completion request"""
+        return CompletionRequest(
+            model_uri=self.yandex_gpt.model_uri,
+            completion_options=CompletionOptions(
+                stream=stream,
+                temperature=DoubleValue(value=self.yandex_gpt.temperature),
+                max_tokens=Int64Value(value=self.yandex_gpt.max_tokens),
+            ),
+            messages=[
+                Message(role=ROLES[message.role], text=message.content)
+                for message in messages
+                if message.role in ROLES
+            ],
+        )
+
+    async def _acomplete(self, request: CompletionRequest) -> YandexCompletionResponse:
+        """Call completion API, retrying on errors"""
+        stub: TextGenerationServiceStub = TextGenerationServiceStub(self._get_channel())
+        result: Optional[YandexCompletionResponse] = None
+
+        async for attempt in AsyncRetrying(
+            reraise=True,
+            stop=stop_after_attempt(self.yandex_gpt.max_retries),
+            wait=wait_exponential(
+                multiplier=1, min=self.yandex_gpt.sleep_interval, max=60
+            ),
+            retry=retry_if_exception_type(AioRpcError),
+            before_sleep=before_sleep_log(logger, WARNING),
+        ):
+            with attempt:
+                async for response in stub.Completion(
+                    request, metadata=self.yandex_gpt.grpc_metadata
+                ):
+                    result = response
+
+        return result
+
+    async def _arequest(
+        self, messages: Sequence[ChatMessage]
+    ) -> YandexCompletionResponse:
+        """
+        Call synchronous completion API over the async channel. Unlike the async
+        completion API used by LangChain, it doesn't need operation status polling.
+        """
+        request: CompletionRequest = self._build_request(messages)
+
+        with _measure("completion"):
+            result: YandexCompletionResponse = await cassette.acall(
+                "llm",
+                MessageToDict(request),
+                lambda: self._acomplete(request),
+                MessageToDict,
+                _response_from_dict,
+            )
+
+        _count_tokens(result)
+
+        return result
+
+    async def _astream_request(
+        self, messages: Sequence[ChatMessage]
+    ) -> AsyncGenerator[tuple[str, str, YandexCompletionResponse], None]:
+        """
+        Stream a completion. Each partial response contains the whole text generated
+        so far, yields the text, its new part and the raw response.
+        """
+        stub: TextGenerationServiceStub = TextGenerationServiceStub(self._get_channel())
+        request: CompletionRequest = self._build_request(messages, stream=True)
+        text: str = ""
+        response: Optional[YandexCompletionResponse] = None
+
+        with _measure("stream"):
+            async for response in cassette.astream(
+                "llm",
+                MessageToDict(request),
+                lambda: stub.Completion(
+                    request, metadata=self.yandex_gpt.grpc_metadata
+                ),
+                MessageToDict,
+                _response_from_dict,
+            ):
+                new_text: str = response.alternatives[0].message.text
+                delta: str = new_text[len(text) :]
+                text = new_text
+
+                yield text, delta, response
+
+        _count_tokens(response)
+
+    def _stream_request(
+        self, messages: Sequence[ChatMessage]
+    ) -> Generator[tuple[str, str, YandexCompletionResponse], None, None]:
+        """Stream a completion, sync version"""
+        stub: TextGenerationServiceStub = TextGenerationServiceStub(
+            self._get_sync_channel()
+        )
+        request: CompletionRequest = self._build_request(messages, stream=True)
+        text: str = ""
+        response: Optional[YandexCompletionResponse] = None
+
+        with _measure("stream"):
+            for response in cassette.stream(
+                "llm",
+                MessageToDict(request),
+                lambda: stub.Completion(
+                    request, metadata=self.yandex_gpt.grpc_metadata
+                ),
+                MessageToDict,
+                _response_from_dict,
+            ):
+                new_text: str = response.alternatives[0].message.text
+                delta: str = new_text[len(text) :]
+                text = new_text
+
+                yield text, delta, response
+
+        _count_tokens(response)
+
     @llm_chat_callback()
     async def achat(
         self,
@@ -53,7 +274,15 @@ class YandexLLM(LLM):
         **kwargs: Any,
     ) -> ChatResponse:
         logger.debug("achat, messages=%s", messages)
-        return self.chat(messages=messages)
+        response: YandexCompletionResponse = await self._arequest(messages)
+
+        return ChatResponse(
+            message=ChatMessage(
+                role=MessageRole.ASSISTANT,
+                content=response.alternatives[0].message.text,
+            ),
+            raw=response,
+        )
 
     @llm_chat_callback()
     async def astream_chat(
@@ -64,14 +293,12 @@ class YandexLLM(LLM):
         logger.debug("astream_chat, messages=%s", messages)
 
         async def gen() -> ChatResponseAsyncGen:
-            for message in [
-                ChatResponse(
-                    message=ChatMessage(
-                        role=MessageRole.ASSISTANT, content="Hello, I am Yandex GPT!"
-                    )
+            async for text, delta, response in self._astream_request(messages):
+                yield ChatResponse(
+                    message=ChatMessage(role=MessageRole.ASSISTANT, content=text),
+                    delta=delta,
+                    raw=response,
                 )
-            ]:
-                yield message
 
         return gen()
 
@@ -80,14 +307,28 @@ class YandexLLM(LLM):
         self, prompt: str, formatted: bool = False, **kwargs: Any
     ) -> CompletionResponse:
         logger.debug("acomplete, prompt=%s, formatted=%s", prompt, formatted)
-        return await super().acomplete(prompt, formatted, **kwargs)
+        response: YandexCompletionResponse = await self._arequest(
+            [ChatMessage(role=MessageRole.USER, content=prompt)]
+        )
+
+        return CompletionResponse(
+            text=response.alternatives[0].message.text, raw=response
+        )
 
     @llm_completion_callback()
     async def astream_complete(
         self, prompt: str, formatted: bool = False, **kwargs: Any
     ) -> CompletionResponseAsyncGen:
         logger.debug("astream_complete, prompt=%s, formatted=%s", prompt, formatted)
-        return await super().astream_complete(prompt, formatted, **kwargs)
+        messages: list[ChatMessage] = [
+            ChatMessage(role=MessageRole.USER, content=prompt)
+        ]
+
+        async def gen() -> CompletionResponseAsyncGen:
+            async for text, delta, response in self._astream_request(messages):
+                yield CompletionResponse(text=text, delta=delta, raw=response)
+
+        return gen()
 
     @llm_chat_callback()
     def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
@@ -102,12 +343,15 @@ class YandexLLM(LLM):
             elif message.role == MessageRole.ASSISTANT:
                 converted_messages.append(AIMessage(content=message.content))
 
-        result_message: BaseMessage = self.yandex_gpt.invoke(converted_messages)
+        with _measure("langchain"):
+            content: str = cassette.call(
+                "llm",
+                {"messages": [[m.type, m.content] for m in converted_messages]},
+                lambda: self.yandex_gpt.invoke(converted_messages).content,
+            )
 
         return ChatResponse(
-            message=ChatMessage(
-                role=MessageRole.ASSISTANT, content=result_message.content
-            )
+            message=ChatMessage(role=MessageRole.ASSISTANT, content=content)
         )
 
     @llm_chat_callback()
@@ -115,22 +359,45 @@ class YandexLLM(LLM):
         self, messages: Sequence[ChatMessage], **kwargs: Any
     ) -> Generator[ChatResponse, None, None]:
         logger.debug("stream_chat, messages=%s", messages)
-        return super().stream_chat(messages, **kwargs)
+
+        def gen() -> Generator[ChatResponse, None, None]:
+            for text, delta, response in self._stream_request(messages):
+                yield ChatResponse(
+                    message=ChatMessage(role=MessageRole.ASSISTANT, content=text),
+                    delta=delta,
+                    raw=response,
+                )
+
+        return gen()
 
     @llm_completion_callback()
     def complete(
         self, prompt: str, formatted: bool = False, **kwargs: Any
     ) -> CompletionResponse:
         logger.debug("complete, prompt=%s, formatted=%s", prompt, formatted)
-        result: BaseMessage = self.yandex_gpt.invoke(prompt)
-        return CompletionResponse(text=result.content)
+        with _measure("langchain"):
+            text: str = cassette.call(
+                "llm",
+                {"prompt": prompt},
+                lambda: self.yandex_gpt.invoke(prompt).content,
+            )
+
+        return CompletionResponse(text=text)
 
     @llm_completion_callback()
     def stream_complete(
         self, prompt: str, formatted: bool = False, **kwargs: Any
     ) -> CompletionResponseGen:
         logger.debug("stream_complete, prompt=%s, formatted=%s", prompt, formatted)
-        return super().stream_complete(prompt, formatted, **kwargs)
+        messages: list[ChatMessage] = [
+            ChatMessage(role=MessageRole.USER, content=prompt)
+        ]
+
+        def gen() -> CompletionResponseGen:
+            for text, delta, response in self._stream_request(messages):
+                yield CompletionResponse(text=text, delta=delta, raw=response)
+
+        return gen()
 
     @classmethod
     def class_name(cls) -> str:
@@ -0,0 +1,311 @@
+"""
+Metrics - in-process counters, gauges and histograms rendered in Prometheus text
+format. Every API worker periodically saves a snapshot of its metrics to METRICS_DIR,
+the worker serving /metrics merges them, so scrapes cover all workers.
+"""
+
+from asyncio import sleep, to_thread
+from bisect import bisect_left
+from contextlib import contextmanager, suppress
+from functools import wraps
+from glob import glob
+from json import dump, load
+from logging import getLogger
+from os import getpid, makedirs, path, remove, replace
+from time import perf_counter, time
+from typing import Any, Callable, Iterator
+
+from rag import tracing
+from rag.config import METRICS_DIR, METRICS_INTERVAL
+
+logger = getLogger(__name__)
+
+# histogram buckets, seconds
+BUCKETS: tuple[float, ...] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+# type and help of every metric
+METRICS: dict[str, tuple[str, str]] = {
+    "rag_http_requests_in_flight": ("gauge", "HTTP requests being processed"),
+    "rag_http_request_seconds": ("histogram", "HTTP request duration"),
+    "rag_stage_seconds": ("histogram", "Query processing stage duration"),
+    "rag_llm_requests_total": ("counter", "LLM calls by method and status"),
+    "rag_llm_request_seconds": ("histogram", "LLM call duration"),
+    "rag_llm_tokens_total": ("counter", "Tokens reported by LLM API"),
+    "rag_agent_prompt_tokens_total": ("counter", "Tokens sent to LLM by agent stage"),
+    "rag_db_seconds": ("histogram", "Database operation duration"),
+    "rag_db_pool_connections": ("gauge", "SQLAlchemy pool connections by state"),
+    "rag_cache_hits_total": ("counter", "Cache hits"),
+    "rag_cache_misses_total": ("counter", "Cache misses"),
+    "rag_cache_entries": ("gauge", "Cache size"),
+    "rag_cache_hit_ratio": ("gauge", "Cache hits to lookups ratio"),
+    "rag_guard_verdicts_total": ("counter", "Prompt injection verdicts by source"),
+    "rag_router_speculations_total": ("counter", "Speculative tool runs by outcome"),
+    "rag_job_queue": ("gauge", "Background jobs by state"),
+    "rag_jobs_total": ("counter", "Background jobs by outcome"),
+    "rag_job_seconds": ("histogram", "Background job duration"),
+}
+
+# series are keyed by name and formatted labels: 'name{a="x",b="y"}'
+_counters: dict[str, float] = {}
+_gauges: dict[str, float] = {}
+# bucket counts including +Inf, then sum and count
+_histograms: dict[str, list[float]] = {}
+_collectors: list[Callable[[], list[tuple[str, dict, float]]]] = []
+
+
+def _key(name: str, labels: dict) -> str:
+    """Format series key"""
+    if not labels:
+        return name
+
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def inc(name: str, value: float = 1, **labels: Any):
+    """Increase counter"""
+    key: str = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def add(name: str, value: float, **labels: Any):
+    """Change gauge by value"""
+    key: str = _key(name, labels)
+    _gauges[key] = _gauges.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels: Any):
+    """Add value to histogram"""
+    key: str = _key(name, labels)
+
+    if key not in _histograms:
+        _histograms[key] = [0] * (len(BUCKETS) + 3)
+
+    histogram: list[float] = _histograms[key]
+    histogram[bisect_left(BUCKETS, value)] += 1
+    histogram[-2] += value
+    histogram[-1] += 1
+
+
+@contextmanager
+def timer(name: str = "rag_stage_seconds", **labels: Any) -> Iterator[None]:
+    """Measure duration of the block, failed blocks are measured too"""
+    started: float = perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - started, **labels)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Measure duration of a query processing stage and record it as a trace span"""
+    with tracing.span(name, "stage"), timer("rag_stage_seconds", stage=name):
+        yield
+
+
+def timed(name: str, **labels: Any) -> Callable:
+    """Measure duration of coroutine function calls"""
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def register_collector(collector: Callable[[], list[tuple[str, dict, float]]]):
+    """
+    Register a function returning (name, labels, value) samples of counters and gauges
+    kept elsewhere, it's called on every snapshot
+    """
+    _collectors.append(collector)
+
+
+def snapshot() -> dict:
+    """Get current metrics of the worker"""
+    counters: dict[str, float] = dict(_counters)
+    gauges: dict[str, float] = dict(_gauges)
+
+    for collector in _collectors:
+        try:
+            samples: list[tuple[str, dict, float]] = collector()
+        except Exception:
+            logger.exception("snapshot, collector failed")
+            continue
+
+        for name, labels, value in samples:
+            target: dict = counters if METRICS[name][0] == "counter" else gauges
+            key: str = _key(name, labels)
+            target[key] = target.get(key, 0) + value
+
+    return {
+        "time": time(),
+        "counters": counters,
+        "gauges": gauges,
+        "histograms": {k: list(v) for k, v in dict(_histograms).items()},
+    }
+
+
+def _snapshot_path(pid: int) -> str:
+    return path.join(METRICS_DIR, f"metrics-{pid}.json")
+
+
+def save_snapshot():
+    """Save worker's snapshot for other workers"""
+    if not METRICS_DIR:
+        return
+
+    makedirs(METRICS_DIR, exist_ok=True)
+    snapshot_path: str = _snapshot_path(getpid())
+
+    with open(snapshot_path + ".tmp", "w", encoding="utf-8") as f:
+        dump(snapshot(), f)
+
+    replace(snapshot_path + ".tmp", snapshot_path)
+
+
+def remove_snapshot():
+    """Remove worker's snapshot on shutdown"""
+    if METRICS_DIR:
+        with suppress(FileNotFoundError):
+            remove(_snapshot_path(getpid()))
+
+
+def _load_snapshots() -> list[dict]:
+    """Load fresh snapshots of other workers"""
+    if not METRICS_DIR:
+        return []
+
+    snapshots: list[dict] = []
+    own_path: str = _snapshot_path(getpid())
+    # snapshots of stopped workers are dropped
+    max_age: float = max(METRICS_INTERVAL * 3, 30)
+
+    for snapshot_path in glob(path.join(METRICS_DIR, "metrics-*.json")):
+        if snapshot_path == own_path:
+            continue
+
+        try:
+            with open(snapshot_path, encoding="utf-8") as f:
+                data: dict = load(f)
+        except (OSError, ValueError):
+            continue
+
+        if time() - data.get("time", 0) <= max_age:
+            snapshots.append(data)
+
+    return snapshots
+
+
+def _merge(snapshots: list[dict]) -> dict:
+    """Sum metrics of all workers"""
+    merged: dict = {"counters": {}, "gauges": {}, "histograms": {}}
+
+    for data in snapshots:
+        for kind in ("counters", "gauges"):
+            for key, value in data[kind].items():
+                merged[kind][key] = merged[kind].get(key, 0) + value
+
+        for key, values in data["histograms"].items():
+            if key not in merged["histograms"]:
+                merged["histograms"][key] = [0] * len(values)
+
+            for index, value in enumerate(values):
+                merged["histograms"][key][index] += value
+
+    return merged
+
+
+def _add_hit_ratios(merged: dict):
+    """Calculate cache hit ratios from merged counters"""
+    counters: dict[str, float] = merged["counters"]
+
+    for key, hits in list(counters.items()):
+        if _split(key)[0] != "rag_cache_hits_total":
+            continue
+
+        labels: str = key[len("rag_cache_hits_total") :]
+        lookups: float = hits + counters.get("rag_cache_misses_total" + labels, 0)
+        merged["gauges"]["rag_cache_hit_ratio" + labels] = (
+            hits / lookups if lookups else 0
+        )
+
+
+def _split(key: str) -> tuple[str, str]:
+    """Split series key into name and labels"""
+    if "{" not in key:
+        return key, ""
+
+    name, labels = key.split("{", 1)
+
+    return name, labels[:-1]
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render() -> str:
+    """Render metrics of all workers in Prometheus text format"""
+    merged: dict = _merge([snapshot(), *_load_snapshots()])
+    _add_hit_ratios(merged)
+    lines: dict[str, list[str]] = {}
+
+    for kind in ("counters", "gauges"):
+        for key, value in sorted(merged[kind].items()):
+            lines.setdefault(_split(key)[0], []).append(f"{key} {_format(value)}")
+
+    for key, values in sorted(merged["histograms"].items()):
+        name, labels = _split(key)
+        prefix: str = labels + "," if labels else ""
+        series: list[str] = lines.setdefault(name, [])
+        cumulative: float = 0
+
+        for bound, count in zip([*BUCKETS, "+Inf"], values[:-2]):
+            cumulative += count
+            le: str = bound if bound == "+Inf" else _format(bound)
+            series.append(f'{name}_bucket{{{prefix}le="{le}"}} {_format(cumulative)}')
+
+        suffix: str = "{" + labels + "}" if labels else ""
+        series.append(f"{name}_sum{suffix} {_format(values[-2])}")
+        series.append(f"{name}_count{suffix} {_format(values[-1])}")
+
+    output: list[str] = []
+
+    for name, series in lines.items():
+        kind, description = METRICS.get(name, ("untyped", name))
+        output.append(f"# HELP {name} {description}")
+        output.append(f"# TYPE {name} {kind}")
+        output.extend(series)
+
+    return "\n".join(output) + "\n"
+
+
+async def awatch(interval: float = METRICS_INTERVAL):
+    """Save worker's snapshot periodically"""
+    while True:
+        try:
+            await to_thread(save_snapshot)
+        except Exception:
+            logger.exception("awatch, failed to save metrics snapshot")
+
+        await sleep(interval)
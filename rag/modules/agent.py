@@ -1,20 +1,30 @@
 """
-Query router - determines user's intent and either sends request to Weaviate, or to
-internet search module.
+Agent - answers user's query by calling document search and internet search tools
+and summarizing their responses. Agent plans several tool calls per step, independent
+calls are executed concurrently, a failed call is reported back to the agent as the
+call result.
 """
 
+import re
+from asyncio import gather
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from json import loads
 from logging import getLogger
-from typing import Optional
+from typing import Any, Optional
 
 from llama_index.core import PromptTemplate, Response
+from llama_index.core.bridge.pydantic import PrivateAttr
 from llama_index.core.llms import ChatMessage, ChatResponse, MessageRole
 from llama_index.core.query_engine import CustomQueryEngine
-from llama_index.core.tools import QueryEngineTool
+from llama_index.core.tools import QueryEngineTool, ToolOutput
 
+from rag import metrics, tracing
 from rag.llm import get_llm
 from rag.llm.yandex import YandexLLM
 from rag.modules import internet, search
-from rag.modules.guard import is_prompt_injection
+from rag.modules.budget import TokenBudget, TokenUsage
+from rag.modules.guard import ais_prompt_injection, is_prompt_injection
 
 logger = getLogger(__name__)
 
@@ -30,15 +40,17 @@ Cписок инструментов, их параметры и описани
 ---------------------
 {tools_str}
 
-stop: Ответ был найден ранее и присутствует в контексте, остановить обработку запроса и дальнейшие вызовы инструментов.
 ---------------------
 
-Твоя задача - ответить на запрос пользователя, используя наиболее подходящий инструмент из списка.
+Твоя задача - ответить на запрос пользователя, используя наиболее подходящие инструменты из списка.
 Не вызывай один и тот же инструмент несколько раз с одинаковыми параметрами.
-Если ответ на запрос присутствует в истории, используй инструмент 'stop' для завершения обработки запроса и возврата ответа.
 
-Если запрос состоит из нескольких частей, разбей его на несколько вопросов и используй несколько инструментов последовательно для обработки запроса.
-Ответ должен содержать только имя инструмента и параметры для его вызова."""
+Если запрос состоит из нескольких частей, разбей его на несколько вопросов и вызови инструмент для каждого из них.
+Независимые вызовы перечисли в одном ответе, они будут выполнены параллельно.
+Если ответ на запрос присутствует в истории, верни пустой список вызовов для завершения обработки запроса.
+
+Ответ должен содержать только JSON без пояснений, в формате:
+{{"calls": [{{"tool": "имя инструмента", "query": "запрос"}}]}}"""
     )
 
     SUMMARIZE_PROMPT: PromptTemplate = PromptTemplate(
@@ -59,22 +71,216 @@ stop: Ответ был найден ранее и присутствует в 
     llm: YandexLLM
     tools: list[QueryEngineTool]
 
-    def summarize(self, query: str, tool_history: dict) -> str:
-        """
-        Summarize the query using the tool history and the query itself.
-        """
-        logger.debug("summarize, query=%s, tool_history=%s", query, tool_history)
+    _system_prompt: str = PrivateAttr(default="")
+    _budget: TokenBudget = PrivateAttr(default_factory=TokenBudget)
+    _token_usage: TokenUsage = PrivateAttr(default_factory=TokenUsage)
 
+    def model_post_init(self, __context: Any) -> None:
+        """Build the system prompt with a tool list once per engine"""
+        tools: list[str] = [
+            f"{tool.metadata.name}(query): {tool.metadata.description}"
+            for tool in self.tools
+        ]
+        self._system_prompt = self.SYSTEM_PROMPT.format(tools_str="\n\n".join(tools))
+
+    def _get_summarize_prompt(
+        self, query: str, tool_history: dict, usage: Optional[TokenUsage] = None
+    ) -> str:
+        """Get a prompt to summarize tool responses, fitted into the token budget"""
+        reserved: int = self._budget.count(
+            self.SUMMARIZE_PROMPT.format(query_str=query, tool_history_str="")
+        )
+        tool_history = self._budget.fit_outputs(tool_history, reserved)
         prompt: str = self.SUMMARIZE_PROMPT.format(
             query_str=query,
             tool_history_str="\n\n".join(
                 [f"{k}\n{v}" for k, v in tool_history.items()]
             ),
         )
-        logger.debug("summarize, prompt=%s", prompt)
+        logger.debug("_get_summarize_prompt, prompt=%s", prompt)
+
+        if usage is not None:
+            usage.add("summarize", self._budget.count(prompt))
+
+        return prompt
+
+    def summarize(
+        self, query: str, tool_history: dict, usage: Optional[TokenUsage] = None
+    ) -> str:
+        """
+        Summarize the query using the tool history and the query itself.
+        """
+        logger.debug("summarize, query=%s, tool_history=%s", query, tool_history)
+        prompt: str = self._get_summarize_prompt(query, tool_history, usage)
 
         return str(self.llm.complete(prompt)).strip()
 
+    async def asummarize(
+        self, query: str, tool_history: dict, usage: Optional[TokenUsage] = None
+    ) -> str:
+        """
+        Summarize the query using the tool history and the query itself, async version.
+        """
+        logger.debug("asummarize, query=%s, tool_history=%s", query, tool_history)
+        prompt: str = self._get_summarize_prompt(query, tool_history, usage)
+
+        return str(await self.llm.acomplete(prompt)).strip()
+
+    def _fit_messages(
+        self, messages: list[ChatMessage], usage: TokenUsage
+    ) -> list[ChatMessage]:
+        """Fit chat history into the token budget before sending it to LLM"""
+        messages = self._budget.fit_messages(messages)
+        usage.add("plan", self._budget.count_messages(messages))
+
+        return messages
+
+    def _report_usage(self, usage: TokenUsage):
+        """Log tokens sent to LLM by stage"""
+        self._token_usage.merge(usage)
+
+        for stage, tokens in usage.stages.items():
+            metrics.inc("rag_agent_prompt_tokens_total", tokens, stage=stage)
+
+        logger.info("_report_usage, tokens=%s, stages=%s", usage.total(), usage.stages)
+
+    def token_usage(self) -> dict[str, int]:
+        """Get total tokens sent to LLM by stage"""
+        return dict(self._token_usage.stages)
+
+    def _get_messages(self, query_str: str) -> list[ChatMessage]:
+        """Get initial chat history"""
+        return [
+            ChatMessage(role=MessageRole.SYSTEM, content=self._system_prompt),
+            ChatMessage(role=MessageRole.USER, content=query_str),
+        ]
+
+    def _parse_tool_call(self, selected_tool: str) -> tuple[str, str]:
+        """Parse LLM's reply into a tool name and its parameters"""
+        selected_tool = selected_tool.strip()
+        logger.debug("_parse_tool_call, selected_tool=%s", selected_tool)
+
+        tool_name: str = selected_tool.split("(", maxsplit=1)[0].strip()
+        tool_params: str = selected_tool[
+            selected_tool.find("(") + 1 : selected_tool.find(")")
+        ].strip()
+
+        if tool_params.startswith('"') and tool_params.endswith('"'):
+            tool_params = tool_params[1:-1]
+
+        logger.debug(
+            "_parse_tool_call, tool_name=%s, tool_params=%s", tool_name, tool_params
+        )
+
+        return tool_name, tool_params
+
+    def _parse_plan(self, reply: str) -> list[tuple[str, str]]:
+        """
+        Parse LLM's reply into a list of tool calls. Replies in the legacy
+        tool_name(params) format are parsed as a single call.
+
+        Returns:
+            list[tuple[str, str]]: tool names and queries
+        """
+        logger.debug("_parse_plan, reply=%s", reply)
+        match: Optional[re.Match] = re.search(r"[\[{].*[\]}]", reply, re.DOTALL)
+        plan: Any = None
+
+        if match is not None:
+            try:
+                plan = loads(match.group(0))
+            except ValueError:
+                logger.warning("_parse_plan, invalid JSON=%s", match.group(0))
+
+        if isinstance(plan, dict):
+            plan = plan.get("calls", [])
+
+        if isinstance(plan, list):
+            return [
+                (str(call.get("tool", "")).strip(), str(call.get("query", "")).strip())
+                for call in plan
+                if isinstance(call, dict)
+            ]
+
+        tool_name, tool_params = self._parse_tool_call(reply)
+
+        return [(tool_name, tool_params)] if tool_name else []
+
+    def _get_new_calls(
+        self, plan: list[tuple[str, str]], tool_history: dict
+    ) -> list[tuple[str, QueryEngineTool, str]]:
+        """
+        Get calls from the plan which were not made yet, limited by MAX_CALLS.
+
+        Returns:
+            list[tuple[str, QueryEngineTool, str]]: call keys, tools and queries
+        """
+        calls: list[tuple[str, QueryEngineTool, str]] = []
+        keys: set[str] = set()
+
+        for tool_name, tool_params in plan:
+            key: str = f'{tool_name}("{tool_params}")'
+
+            if tool_name == "stop":
+                break
+
+            if key in tool_history or key in keys:
+                logger.warning("_get_new_calls, %s already called", key)
+                continue
+
+            tool_obj: Optional[QueryEngineTool] = self._find_tool(tool_name)
+
+            if tool_obj is not None:
+                calls.append((key, tool_obj, tool_params))
+                keys.add(key)
+
+        return calls[: self.MAX_CALLS - len(tool_history)]
+
+    def _find_tool(self, tool_name: str) -> Optional[QueryEngineTool]:
+        """Find a tool by name"""
+        for tool in self.tools:
+            if tool_name == tool.metadata.name:
+                return tool
+
+        logger.error("_find_tool, unknown tool=%s", tool_name)
+
+        return None
+
+    @staticmethod
+    def _get_error_response(tool_params: str, error: BaseException) -> str:
+        """Get a tool response describing a failed call"""
+        logger.error("tool call failed, query=%s", tool_params, exc_info=error)
+
+        return f"Ошибка вызова инструмента: {error!r}"
+
+    def _call_tool(self, tool_obj: QueryEngineTool, tool_params: str) -> str:
+        """Call the tool, recording the call as a trace span"""
+        try:
+            with tracing.span(tool_obj.metadata.name, "tool", query=tool_params):
+                return tool_obj.call(tool_params).content
+        except Exception as e:
+            return self._get_error_response(tool_params, e)
+
+    @staticmethod
+    async def _acall_tool(tool_obj: QueryEngineTool, tool_params: str) -> ToolOutput:
+        """Call the tool, recording the call as a trace span"""
+        with tracing.span(tool_obj.metadata.name, "tool", query=tool_params):
+            return await tool_obj.acall(tool_params)
+
+    def _add_tool_responses(
+        self, messages: list[ChatMessage], tool_history: dict, responses: dict
+    ):
+        """Save tool responses to the history"""
+        tool_history.update(responses)
+        messages.append(
+            ChatMessage(
+                role=MessageRole.USER,
+                content="Результаты вызовов:\n\n"
+                + "\n\n".join([f"{k}\n{v}" for k, v in responses.items()])
+                + "\n\nСледующие вызовы",
+            )
+        )
+
     def custom_query(self, query_str: str) -> str:
         """Custom query handler"""
         logger.debug("custom_query, query_str=%s", query_str)
@@ -85,81 +291,110 @@ stop: Ответ был найден ранее и присутствует в 
 
         current_response: str = ""
         tool_history = {}
+        messages: list[ChatMessage] = self._get_messages(query_str)
+        usage: TokenUsage = TokenUsage()
 
-        # buiding a tool list for an LLM
-        tools = []
+        with ThreadPoolExecutor(max_workers=self.MAX_CALLS) as executor:
+            while len(tool_history) < self.MAX_CALLS:
+                logger.debug("custom_query, calls=%s", len(tool_history))
 
-        for tool in self.tools:
-            tools.append(f"{tool.metadata.name}(query): {tool.metadata.description}")
+                with metrics.stage("agent_plan"):
+                    response: ChatResponse = self.llm.chat(
+                        self._fit_messages(messages, usage)
+                    )
 
-        tools_str: str = "\n\n".join(tools)
+                messages.append(response.message)
 
-        messages: list[ChatMessage] = [
-            ChatMessage(
-                role=MessageRole.SYSTEM,
-                content=self.SYSTEM_PROMPT.format(tools_str=tools_str),
-            ),
-            ChatMessage(role=MessageRole.USER, content=query_str),
-        ]
-        current_call: int = 0
+                calls: list[tuple[str, QueryEngineTool, str]] = self._get_new_calls(
+                    self._parse_plan(str(response.message.content)), tool_history
+                )
 
-        while current_call < self.MAX_CALLS:
-            logger.debug("custom_query, current_call=%s", current_call)
-            response: ChatResponse = self.llm.chat(messages)
-            messages.append(response.message)
+                if not calls:
+                    break
+
+                with metrics.stage("agent_tools"):
+                    # threads don't inherit context variables, like the current trace
+                    futures: list[Future] = [
+                        executor.submit(
+                            copy_context().run, self._call_tool, tool_obj, tool_params
+                        )
+                        for _, tool_obj, tool_params in calls
+                    ]
+                    responses: list[str] = [future.result() for future in futures]
+
+                self._add_tool_responses(
+                    messages,
+                    tool_history,
+                    {call[0]: r for call, r in zip(calls, responses)},
+                )
+
+        if len(tool_history) > 0:
+            with metrics.stage("agent_summarize"):
+                current_response = self.summarize(query_str, tool_history, usage)
+
+        self._report_usage(usage)
+
+        if not current_response:
+            current_response = "Извините, я не могу найти ответ на ваш запрос."
+
+        return current_response
+
+    async def acustom_query(self, query_str: str) -> str:
+        """Custom query handler, async version"""
+        logger.debug("acustom_query, query_str=%s", query_str)
 
-            selected_tool: str = str(response.message.content).strip()
-            logger.debug("custom_query, selected_tool=%s", selected_tool)
+        if await ais_prompt_injection(self.llm, query_str):
+            logger.warning("acustom_query, possible prompt injection detected")
+            return "Извините, я не могу найти ответ на ваш запрос."
 
-            tool_name: str = selected_tool.split("(", maxsplit=1)[0].strip()
-            tool_params: str = selected_tool[
-                selected_tool.find("(") + 1 : selected_tool.find(")")
-            ].strip()
+        current_response: str = ""
+        tool_history = {}
+        messages: list[ChatMessage] = self._get_messages(query_str)
+        usage: TokenUsage = TokenUsage()
 
-            if tool_params.startswith('"') and tool_params.endswith('"'):
-                tool_params = tool_params[1:-1]
+        while len(tool_history) < self.MAX_CALLS:
+            logger.debug("acustom_query, calls=%s", len(tool_history))
 
-            if f'{tool_name}("{tool_params}")' in tool_history:
-                logger.warning(
-                    "custom_query, tool=%s, params=%s already called",
-                    tool_name,
-                    tool_params,
+            with metrics.stage("agent_plan"):
+                response: ChatResponse = await self.llm.achat(
+                    self._fit_messages(messages, usage)
                 )
 
-                break
+            messages.append(response.message)
 
-            logger.debug(
-                "custom_query, tool_name=%s, tool_params=%s", tool_name, tool_params
+            calls: list[tuple[str, QueryEngineTool, str]] = self._get_new_calls(
+                self._parse_plan(str(response.message.content)), tool_history
             )
 
-            if tool_name == "stop":
+            if not calls:
                 break
 
-            else:
-                tool_obj: Optional[QueryEngineTool] = None
-
-                for tool in self.tools:
-                    if tool_name == tool.metadata.name:
-                        tool_obj = tool
-                        break
+            with metrics.stage("agent_tools"):
+                results: list[ToolOutput | BaseException] = await gather(
+                    *[
+                        self._acall_tool(tool_obj, tool_params)
+                        for _, tool_obj, tool_params in calls
+                    ],
+                    return_exceptions=True,
+                )
 
-                if tool_obj is None:
-                    logger.error("custom_query, unknown tool=%s", tool_name)
-                    break
+            responses: dict[str, str] = {}
 
-                current_response = tool_obj.call(tool_params).content
+            for (key, _, tool_params), result in zip(calls, results):
+                if isinstance(result, Exception):
+                    responses[key] = self._get_error_response(tool_params, result)
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    responses[key] = result.content
 
-            tool_history[f'{tool_name}("{tool_params}")'] = current_response
-            messages.append(
-                ChatMessage(role=MessageRole.ASSISTANT, content=current_response)
-            )
-            messages.append(
-                ChatMessage(role=MessageRole.USER, content="Следующий инструмент")
-            )
-            current_call += 1
+            self._add_tool_responses(messages, tool_history, responses)
 
         if len(tool_history) > 0:
-            current_response = self.summarize(query_str, tool_history)
+            with metrics.stage("agent_summarize"):
+                current_response = await self.asummarize(query_str, tool_history, usage)
+
+        self._report_usage(usage)
 
         if not current_response:
             current_response = "Извините, я не могу найти ответ на ваш запрос."
@@ -167,14 +402,21 @@ stop: Ответ был найден ранее и присутствует в 
         return current_response
 
 
-def run(query: str) -> str:
-    """Run the router."""
+def run(query: str, agent: Optional[AgentQueryEngine] = None) -> str:
+    """
+    Run the agent.
+
+    Args:
+        query (str): user query
+        agent (AgentQueryEngine): prebuilt agent, a new one is built if not passed
+    """
     logger.debug("run, query=%s", query)
 
-    agent: AgentQueryEngine = AgentQueryEngine(
-        llm=get_llm(),
-        tools=[search.get_tool(), internet.get_tool()],
-    )
+    if agent is None:
+        agent = AgentQueryEngine(
+            llm=get_llm(),
+            tools=[search.get_tool(), internet.get_tool()],
+        )
 
     response: Response = agent.query(query)
     response_text: str = response.response
@@ -185,3 +427,24 @@ def run(query: str) -> str:
     logger.debug("run, querying router, got response=%s", response.response)
 
     return response_text
+
+
+async def arun(query: str, agent: AgentQueryEngine) -> str:
+    """
+    Run the agent asynchronously.
+
+    Args:
+        query (str): user query
+        agent (AgentQueryEngine): prebuilt agent
+    """
+    logger.debug("arun, query=%s", query)
+
+    response: Response = await agent.aquery(query)
+    response_text: str = response.response
+
+    if response_text == "Empty Response":
+        response_text = "Извините, я не могу найти ответ на ваш запрос."
+
+    logger.debug("arun, querying agent, got response=%s", response.response)
+
+    return response_text
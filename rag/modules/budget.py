@@ -0,0 +1,131 @@
+"""
+Token budget - keeps agent prompts within the LLM context window by shortening older
+tool outputs, and counts tokens sent to the LLM per stage.
+"""
+
+from logging import getLogger
+from typing import Callable, Optional
+
+from llama_index.core.llms import ChatMessage
+from llama_index.core.utils import get_tokenizer
+
+from rag.config import AGENT_CONTEXT_BUDGET, AGENT_TOOL_OUTPUT_TOKENS
+
+logger = getLogger(__name__)
+
+TRIMMED = "\n[...]"
+DROPPED = "[результаты сокращены]"
+
+
+class TokenBudget:
+    """Fits agent prompts into a token budget"""
+
+    def __init__(
+        self,
+        max_tokens: int = AGENT_CONTEXT_BUDGET,
+        tool_output_tokens: int = AGENT_TOOL_OUTPUT_TOKENS,
+    ):
+        self.max_tokens: int = max_tokens
+        self.tool_output_tokens: int = tool_output_tokens
+        self._tokenizer: Callable[[str], list] = get_tokenizer()
+
+    def count(self, text: str) -> int:
+        """Count tokens in text"""
+        return len(self._tokenizer(text))
+
+    def count_messages(self, messages: list[ChatMessage]) -> int:
+        """Count tokens in chat messages"""
+        return sum(self.count(str(m.content or "")) for m in messages)
+
+    def trim(self, text: str, max_tokens: int) -> str:
+        """Cut text to at most max_tokens tokens"""
+        tokens: int = self.count(text)
+
+        while tokens > max_tokens and text:
+            # cut proportionally, token length varies, so check again
+            text = text[: int(len(text) * max_tokens / tokens * 0.95)]
+            tokens = self.count(text + TRIMMED)
+
+            if tokens <= max_tokens:
+                return text + TRIMMED
+
+        return text
+
+    def fit_messages(
+        self, messages: list[ChatMessage], protected: int = 2
+    ) -> list[ChatMessage]:
+        """
+        Fit chat history into the budget. The first `protected` messages (system
+        prompt and the query) and the last two (the latest plan and its results) are
+        kept, older messages are trimmed to tool_output_tokens, then replaced with a
+        stub, oldest first.
+        """
+        messages = list(messages)
+        total: int = self.count_messages(messages)
+        older: range = range(protected, max(protected, len(messages) - 2))
+
+        for stage in ("trim", "drop"):
+            for index in older:
+                if total <= self.max_tokens:
+                    return messages
+
+                content: str = str(messages[index].content or "")
+                new_content: str = (
+                    self.trim(content, self.tool_output_tokens)
+                    if stage == "trim"
+                    else DROPPED
+                )
+
+                if new_content != content:
+                    total += self.count(new_content) - self.count(content)
+                    messages[index] = ChatMessage(
+                        role=messages[index].role, content=new_content
+                    )
+
+        if total > self.max_tokens:
+            logger.warning(
+                "fit_messages, history doesn't fit, tokens=%s, budget=%s",
+                total,
+                self.max_tokens,
+            )
+
+        return messages
+
+    def fit_outputs(self, outputs: dict[str, str], reserved: int) -> dict[str, str]:
+        """
+        Fit tool outputs into the budget left after `reserved` tokens, every output
+        gets an equal share, unused share of short outputs goes to longer ones.
+        """
+        available: int = max(self.max_tokens - reserved, 0)
+        sizes: dict[str, int] = {k: self.count(f"{k}\n{v}") for k, v in outputs.items()}
+        result: dict[str, str] = {}
+
+        for key in sorted(outputs, key=lambda k: sizes[k]):
+            share: int = available // (len(outputs) - len(result))
+
+            if sizes[key] <= share:
+                result[key] = outputs[key]
+                available -= sizes[key]
+            else:
+                result[key] = self.trim(outputs[key], max(share - self.count(key), 0))
+                available -= share
+
+        return {key: result[key] for key in outputs}
+
+
+class TokenUsage:
+    """Tokens sent to the LLM by stage"""
+
+    def __init__(self):
+        self.stages: dict[str, int] = {}
+
+    def add(self, stage: str, tokens: int):
+        self.stages[stage] = self.stages.get(stage, 0) + tokens
+
+    def total(self) -> int:
+        return sum(self.stages.values())
+
+    def merge(self, other: Optional["TokenUsage"]):
+        if other is not None:
+            for stage, tokens in other.stages.items():
+                self.add(stage, tokens)
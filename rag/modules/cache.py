@@ -0,0 +1,206 @@
+"""
+Semantic answer cache - returns a previous answer for the same or a paraphrased
+question without calling the router. Exact matches are found by normalized text,
+paraphrases - by cosine similarity of query embeddings.
+"""
+
+import re
+from collections import OrderedDict
+from logging import getLogger
+from os import makedirs, path, stat
+from time import monotonic, time
+from typing import NamedTuple, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from rag.config import (
+    ANSWER_CACHE_SIMILARITY,
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_TTL,
+    INDEX_VERSION_PATH,
+)
+from rag.db.vector import get_embedding_model
+
+logger = getLogger(__name__)
+
+_cache: Optional["AnswerCache"] = None
+
+
+class CacheEntry(NamedTuple):
+    """Cached answer"""
+
+    answer: str
+    embedding: np.ndarray
+    created_at: float
+
+
+class AnswerCache:
+    """Size-bounded LRU answer cache with TTL"""
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        max_size: int = ANSWER_CACHE_SIZE,
+        ttl: float = ANSWER_CACHE_TTL,
+        similarity: float = ANSWER_CACHE_SIMILARITY,
+        version_path: str = INDEX_VERSION_PATH,
+    ):
+        self.embed_model: BaseEmbedding = embed_model
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self.similarity: float = similarity
+        self.version_path: str = version_path
+
+        self.hits: int = 0
+        self.semantic_hits: int = 0
+        self.misses: int = 0
+
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        # query embeddings computed on lookup, reused when the answer is stored
+        self._embeddings: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._keys: list[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._version: float = self._get_version()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalize query text for exact matching"""
+        text = re.sub(r"[^\w\s]", " ", text.lower())
+
+        return re.sub(r"\s+", " ", text).strip()
+
+    def _get_version(self) -> float:
+        """Get index version, it changes when the index is rebuilt"""
+        try:
+            return stat(self.version_path).st_mtime
+        except OSError:
+            return 0
+
+    def _check_version(self):
+        """Drop all answers if the index was rebuilt"""
+        version: float = self._get_version()
+
+        if version != self._version:
+            logger.info("_check_version, index was rebuilt, clearing cache")
+            self.clear()
+            self._version = version
+
+    def _is_expired(self, entry: CacheEntry) -> bool:
+        """Check if the entry is older than TTL"""
+        return monotonic() - entry.created_at > self.ttl
+
+    def _get_matrix(self) -> np.ndarray:
+        """Get a matrix of normalized embeddings of all cached queries"""
+        if self._matrix is None:
+            self._keys = list(self._entries.keys())
+            self._matrix = np.stack([e.embedding for e in self._entries.values()])
+
+        return self._matrix
+
+    async def _aembed(self, key: str, query: str) -> np.ndarray:
+        """Get normalized query embedding"""
+        embedding: Optional[np.ndarray] = self._embeddings.get(key)
+
+        if embedding is None:
+            embedding = np.asarray(
+                await self.embed_model.aget_query_embedding(query), dtype=np.float32
+            )
+            embedding /= np.linalg.norm(embedding) or 1
+            self._embeddings[key] = embedding
+
+            while len(self._embeddings) > self.max_size:
+                self._embeddings.popitem(last=False)
+
+        return embedding
+
+    async def aget(self, query: str) -> Optional[str]:
+        """Get cached answer for the query or its paraphrase"""
+        self._check_version()
+        key: str = self.normalize(query)
+        entry: Optional[CacheEntry] = self._entries.get(key)
+
+        if entry is not None and not self._is_expired(entry):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            logger.debug("aget, exact hit, query=%s", query)
+
+            return entry.answer
+
+        if len(self._entries) > 0 and self.similarity < 1:
+            embedding: np.ndarray = await self._aembed(key, query)
+            scores: np.ndarray = self._get_matrix() @ embedding
+
+            for index in np.argsort(scores)[::-1]:
+                if scores[index] < self.similarity:
+                    break
+
+                entry = self._entries.get(self._keys[index])
+
+                if entry is not None and not self._is_expired(entry):
+                    self._entries.move_to_end(self._keys[index])
+                    self.semantic_hits += 1
+                    logger.debug(
+                        "aget, semantic hit, query=%s, cached query=%s, score=%s",
+                        query,
+                        self._keys[index],
+                        scores[index],
+                    )
+
+                    return entry.answer
+
+        self.misses += 1
+
+        return None
+
+    async def aput(self, query: str, answer: str):
+        """Cache the answer"""
+        key: str = self.normalize(query)
+        embedding: np.ndarray = await self._aembed(key, query)
+
+        self._entries[key] = CacheEntry(answer, embedding, monotonic())
+        self._entries.move_to_end(key)
+        self._embeddings.pop(key, None)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        self._matrix = None
+
+    def clear(self):
+        """Drop all cached answers"""
+        self._entries.clear()
+        self._embeddings.clear()
+        self._matrix = None
+
+    def stats(self) -> dict:
+        """Get cache counters"""
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+        }
+
+
+def get_answer_cache() -> AnswerCache:
+    """Get worker's answer cache"""
+    global _cache
+
+    if _cache is None:
+        _cache = AnswerCache(get_embedding_model())
+
+    return _cache
+
+
+def invalidate(version_path: str = INDEX_VERSION_PATH):
+    """Mark index as rebuilt, answer caches of all workers are dropped on next lookup"""
+    logger.debug("invalidate, version_path=%s", version_path)
+
+    if _cache is not None:
+        _cache.clear()
+
+    makedirs(path.dirname(version_path) or ".", exist_ok=True)
+
+    with open(version_path, "w", encoding="utf-8") as f:
+        f.write(str(time()))
@@ -0,0 +1,239 @@
+"""
+Batch embedder - indexer stage that embeds chunks in batches, several batches at a
+time. Backs off when the embedding API rate-limits requests, retries failed batches
+and hands every embedded batch over to the writer right away.
+
+Yandex embedding API takes one text per request and LangChain's YandexGPTEmbeddings
+sends the texts of a batch one by one, so a batch is not one request - batches only
+bound how many requests are in flight and group retries and writes.
+"""
+
+from asyncio import Semaphore, Task, create_task, gather, sleep
+from logging import getLogger
+from time import perf_counter
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable
+
+from grpc import RpcError, StatusCode
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.utils import get_tokenizer
+from pydantic import BaseModel, computed_field
+
+from rag.config import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CONCURRENCY,
+    EMBEDDING_MAX_BACKOFF,
+    EMBEDDING_RETRIES,
+)
+
+logger = getLogger(__name__)
+
+# delay after the first failure, seconds
+MIN_BACKOFF = 0.5
+
+
+class EmbeddingStats(BaseModel):
+    """Embedding throughput counters"""
+
+    chunks: int = 0
+    tokens: int = 0
+    batches: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    failed_chunks: int = 0
+    elapsed: float = 0
+
+    @computed_field
+    @property
+    def chunks_per_second(self) -> float:
+        return self.chunks / self.elapsed if self.elapsed else 0
+
+    @computed_field
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.elapsed if self.elapsed else 0
+
+
+async def _abatched(
+    nodes: AsyncIterable[BaseNode], size: int
+) -> AsyncIterator[list[BaseNode]]:
+    """Split nodes into batches"""
+    batch: list[BaseNode] = []
+
+    async for node in nodes:
+        batch.append(node)
+
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+async def _aiter(items: Iterable) -> AsyncIterator:
+    """Iterate over items asynchronously"""
+    for item in items:
+        yield item
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    """Check if the request was rejected because of rate limits"""
+    return isinstance(error, RpcError) and error.code() == StatusCode.RESOURCE_EXHAUSTED
+
+
+class BatchEmbedder:
+    """
+    Embeds nodes with bounded concurrency. The delay between requests is shared by all
+    batches - it's doubled on failures and halved on successes.
+    """
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        retries: int = EMBEDDING_RETRIES,
+        max_backoff: float = EMBEDDING_MAX_BACKOFF,
+    ):
+        self.embed_model: BaseEmbedding = embed_model
+        self.batch_size: int = batch_size
+        self.concurrency: int = concurrency
+        self.retries: int = retries
+        self.max_backoff: float = max_backoff
+        self.stats: EmbeddingStats = EmbeddingStats()
+
+        self._delay: float = 0
+        self._tokenizer: Callable[[str], list] = get_tokenizer()
+
+    def _backoff(self, rate_limited: bool):
+        """Increase delay between requests"""
+        self._delay = min(self.max_backoff, max(self._delay * 2, MIN_BACKOFF))
+
+        if rate_limited:
+            self.stats.rate_limited += 1
+            # rate limit window is usually about a second, so wait at least that
+            self._delay = max(self._delay, 1.0)
+
+    def _recover(self):
+        """Decrease delay between requests"""
+        self._delay = self._delay / 2 if self._delay > MIN_BACKOFF / 4 else 0
+
+    async def _aembed_batch(self, batch: list[BaseNode]) -> bool:
+        """
+        Embed batch, retrying on errors. The model makes a request per text, a failed
+        request fails the whole batch.
+
+        Returns:
+            bool: True if the batch was embedded
+        """
+        texts: list[str] = [
+            node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch
+        ]
+
+        for attempt in range(self.retries + 1):
+            if self._delay:
+                await sleep(self._delay)
+
+            try:
+                embeddings: list[Embedding] = (
+                    await self.embed_model.aget_text_embedding_batch(texts)
+                )
+            except Exception as e:
+                rate_limited: bool = _is_rate_limited(e)
+                self._backoff(rate_limited)
+                self.stats.retries += 1
+                logger.warning(
+                    "_aembed_batch, attempt=%s, rate_limited=%s, delay=%s, error=%s",
+                    attempt,
+                    rate_limited,
+                    self._delay,
+                    e,
+                )
+                continue
+
+            self._recover()
+
+            for node, embedding in zip(batch, embeddings):
+                node.embedding = embedding
+
+            self.stats.batches += 1
+            self.stats.chunks += len(batch)
+            self.stats.tokens += sum(len(self._tokenizer(text)) for text in texts)
+
+            return True
+
+        return False
+
+    async def _arun_batches(
+        self,
+        batches: AsyncIterable[list[BaseNode]],
+        write: Callable[[list[BaseNode]], Awaitable[None]],
+    ) -> list[list[BaseNode]]:
+        """
+        Embed and write batches, at most `concurrency` batches are in flight.
+
+        Returns:
+            list[list[BaseNode]]: batches that failed
+        """
+        semaphore: Semaphore = Semaphore(self.concurrency)
+        tasks: set[Task] = set()
+        failed: list[list[BaseNode]] = []
+
+        async def process(batch: list[BaseNode]):
+            try:
+                if await self._aembed_batch(batch):
+                    await write(batch)
+                else:
+                    failed.append(batch)
+            finally:
+                semaphore.release()
+
+        async for batch in batches:
+            # waiting here keeps the number of batches in memory bounded
+            await semaphore.acquire()
+            task: Task = create_task(process(batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        await gather(*tasks)
+
+        return failed
+
+    async def arun(
+        self,
+        nodes: AsyncIterable[BaseNode],
+        write: Callable[[list[BaseNode]], Awaitable[None]],
+    ) -> list[BaseNode]:
+        """
+        Embed nodes as they arrive and pass every embedded batch to write. Batches
+        which failed after all retries are retried once more after all other batches.
+
+        Returns:
+            list[BaseNode]: nodes which could not be embedded
+        """
+        logger.debug(
+            "arun, batch_size=%s, concurrency=%s", self.batch_size, self.concurrency
+        )
+        started: float = perf_counter()
+
+        failed: list[list[BaseNode]] = await self._arun_batches(
+            _abatched(nodes, self.batch_size), write
+        )
+
+        if failed:
+            logger.warning("arun, retrying failed batches=%s", len(failed))
+            failed = await self._arun_batches(_aiter(failed), write)
+
+        self.stats.failed_chunks = sum(len(batch) for batch in failed)
+        self.stats.elapsed = perf_counter() - started
+        logger.info(
+            "arun, chunks=%s, tokens=%s, chunks/s=%.2f, tokens/s=%.2f, failed=%s",
+            self.stats.chunks,
+            self.stats.tokens,
+            self.stats.chunks_per_second,
+            self.stats.tokens_per_second,
+            self.stats.failed_chunks,
+        )
+
+        return [node for batch in failed for node in batch]
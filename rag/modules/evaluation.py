@@ -0,0 +1,257 @@
+"""
+Evaluation - answers labelled questions with the query pipeline concurrently and scores
+the answers with an LLM judge. Answers are cached by question and pipeline
+configuration, scores by question, reference and answer, so re-runs only process what
+has changed and an interrupted run resumes where it stopped.
+"""
+
+from asyncio import Semaphore, gather, to_thread
+from hashlib import sha256
+from json import dumps, loads
+from logging import getLogger
+from os import stat
+from time import perf_counter
+from typing import Optional
+
+from llama_index.core.evaluation import CorrectnessEvaluator, EvaluationResult
+from pydantic import BaseModel
+
+from rag import tracing
+from rag.config import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    EVALUATION_CACHE_PATH,
+    EVALUATION_CONCURRENCY,
+    INDEX_NAME,
+    INDEX_VERSION_PATH,
+    ROUTER_MODE,
+)
+from rag.db.cache import DiskCache
+from rag.modules import router
+from rag.modules.pipeline import Pipeline
+
+logger = getLogger(__name__)
+
+
+class EvaluationItem(BaseModel):
+    """Result of one question"""
+
+    question: str
+    reference: str
+    answer: Optional[str] = None
+    score: Optional[float] = None
+    passing: Optional[bool] = None
+    feedback: Optional[str] = None
+    # answer generation time in seconds, measured when the answer was generated
+    latency: Optional[float] = None
+    input_tokens: int = 0
+    completion_tokens: int = 0
+    judge_tokens: int = 0
+    tools: list[str] = []
+    answer_cached: bool = False
+    score_cached: bool = False
+    error: Optional[str] = None
+
+
+class EvaluationReport(BaseModel):
+    """Evaluation results"""
+
+    config_hash: str
+    questions: int = 0
+    answered: int = 0
+    scored: int = 0
+    failed: int = 0
+    avg_score: float = 0
+    passing_rate: float = 0
+    elapsed: float = 0
+    items: list[EvaluationItem] = []
+
+
+def _hash(data: dict) -> str:
+    return sha256(dumps(data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def config_hash(pipeline: Pipeline, version_path: str = INDEX_VERSION_PATH) -> str:
+    """Hash of the settings answers depend on"""
+    try:
+        index_version: float = stat(version_path).st_mtime
+    except OSError:
+        index_version = 0
+
+    return _hash(
+        {
+            "hybrid_alpha": pipeline.config.hybrid_alpha,
+            "search_top_k": pipeline.config.search_top_k,
+            "index_name": INDEX_NAME,
+            "index_version": index_version,
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP,
+            "router_mode": ROUTER_MODE,
+            "model": pipeline.llm.metadata.model_name,
+            "temperature": pipeline.llm.yandex_gpt.temperature,
+        }
+    )
+
+
+def _update(item: EvaluationItem, data: dict):
+    for key, value in data.items():
+        setattr(item, key, value)
+
+
+class Evaluator:
+    """Answers and scores questions with bounded concurrency"""
+
+    def __init__(
+        self,
+        pipeline: Pipeline,
+        concurrency: int = EVALUATION_CONCURRENCY,
+        cache_path: str = EVALUATION_CACHE_PATH,
+    ):
+        self.pipeline: Pipeline = pipeline
+        self.concurrency: int = concurrency
+        self.config_hash: str = config_hash(pipeline)
+
+        self._judge: CorrectnessEvaluator = CorrectnessEvaluator(llm=pipeline.llm)
+        self._answers: DiskCache = DiskCache(cache_path, "evaluation_answer")
+        self._scores: DiskCache = DiskCache(cache_path, "evaluation_score")
+
+    async def _aanswer(self, item: EvaluationItem):
+        """Generate the answer, or take it from the cache"""
+        key: str = _hash({"question": item.question, "config": self.config_hash})
+        cached: Optional[bytes] = await to_thread(self._answers.get, key)
+
+        if cached is not None:
+            item.answer_cached = True
+            _update(item, loads(cached))
+            return
+
+        trace: tracing.Trace = tracing.Trace("evaluate_answer")
+        started: float = perf_counter()
+
+        with tracing.use(trace):
+            answer: str = await router.arun(item.question, self.pipeline.router)
+
+        item.answer = answer
+        item.latency = perf_counter() - started
+        _update(item, trace.tokens())
+        item.tools = [
+            span.name
+            for span in trace.spans
+            if span.kind == "tool" and not span.attributes.get("speculative")
+        ]
+
+        await to_thread(
+            self._answers.set,
+            key,
+            item.model_dump_json(
+                include={
+                    "answer",
+                    "latency",
+                    "input_tokens",
+                    "completion_tokens",
+                    "tools",
+                }
+            ).encode(),
+        )
+
+    async def _ascore(self, item: EvaluationItem):
+        """Score the answer with the judge, or take the score from the cache"""
+        key: str = _hash(
+            {
+                "question": item.question,
+                "reference": item.reference,
+                "answer": item.answer,
+                "model": self.pipeline.llm.metadata.model_name,
+            }
+        )
+        cached: Optional[bytes] = await to_thread(self._scores.get, key)
+
+        if cached is not None:
+            item.score_cached = True
+            _update(item, loads(cached))
+            return
+
+        trace: tracing.Trace = tracing.Trace("evaluate_score")
+
+        with tracing.use(trace):
+            result: EvaluationResult = await self._judge.aevaluate(
+                query=item.question, response=item.answer, reference=item.reference
+            )
+
+        item.score = result.score
+        item.passing = result.passing
+        item.feedback = result.feedback
+        item.judge_tokens = sum(trace.tokens().values())
+
+        await to_thread(
+            self._scores.set,
+            key,
+            item.model_dump_json(
+                include={"score", "passing", "feedback", "judge_tokens"}
+            ).encode(),
+        )
+
+    async def aevaluate_item(self, item: EvaluationItem, semaphore: Semaphore):
+        """Answer and score one question, errors are recorded in the item"""
+        async with semaphore:
+            try:
+                await self._aanswer(item)
+                await self._ascore(item)
+            except Exception as e:
+                logger.exception("aevaluate_item, question=%s", item.question)
+                item.error = f"{type(e).__name__}: {e}"
+
+        logger.info(
+            "aevaluate_item, score=%s, latency=%s, cached=%s/%s, question=%s",
+            item.score,
+            item.latency,
+            item.answer_cached,
+            item.score_cached,
+            item.question,
+        )
+
+    async def arun(self, dataset: list[dict]) -> EvaluationReport:
+        """
+        Evaluate questions with "question" and "answer" (reference) fields
+
+        Returns:
+            EvaluationReport: results in dataset order
+        """
+        logger.debug(
+            "arun, questions=%s, concurrency=%s, config_hash=%s",
+            len(dataset),
+            self.concurrency,
+            self.config_hash,
+        )
+        started: float = perf_counter()
+        semaphore: Semaphore = Semaphore(self.concurrency)
+        items: list[EvaluationItem] = [
+            EvaluationItem(question=data["question"], reference=data["answer"])
+            for data in dataset
+        ]
+
+        await gather(*[self.aevaluate_item(item, semaphore) for item in items])
+
+        scores: list[float] = [i.score for i in items if i.score is not None]
+        report: EvaluationReport = EvaluationReport(
+            config_hash=self.config_hash,
+            questions=len(items),
+            answered=sum(i.answer is not None for i in items),
+            scored=len(scores),
+            failed=sum(i.error is not None for i in items),
+            avg_score=sum(scores) / len(scores) if scores else 0,
+            passing_rate=(
+                sum(bool(i.passing) for i in items) / len(scores) if scores else 0
+            ),
+            elapsed=perf_counter() - started,
+            items=items,
+        )
+        logger.info(
+            "arun, avg_score=%.3f, passing_rate=%.3f, failed=%s, elapsed=%.1f",
+            report.avg_score,
+            report.passing_rate,
+            report.failed,
+            report.elapsed,
+        )
+
+        return report
@@ -0,0 +1,187 @@
+"""
+Page fetcher - downloads web pages over a shared keep-alive HTTP client, limiting
+connections per host and the number of bytes read from every page.
+"""
+
+from asyncio import AbstractEventLoop, Semaphore, get_running_loop
+from contextlib import asynccontextmanager
+from logging import getLogger
+from typing import AsyncIterator, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+from httpx import AsyncClient, HTTPError, Limits, Timeout
+
+from rag import cassette, tracing
+from rag.config import (
+    INTERNET_MAX_CONNECTIONS,
+    INTERNET_MAX_CONNECTIONS_PER_HOST,
+    INTERNET_PAGE_MAX_BYTES,
+    INTERNET_PAGE_TIMEOUT,
+)
+
+logger = getLogger(__name__)
+
+_fetcher: Optional["PageFetcher"] = None
+_fetcher_loop: Optional[AbstractEventLoop] = None
+
+HEADERS: dict[str, str] = {
+    "User-Agent": "Mozilla/5.0 (compatible; shl24/0.1)",
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.5",
+}
+
+
+class Page(NamedTuple):
+    """Fetched page"""
+
+    text: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # the page didn't change since the version given in conditional request headers
+    not_modified: bool = False
+
+
+class PageFetcher:
+    """Fetches pages with bounded per-host concurrency and body size"""
+
+    def __init__(
+        self,
+        max_connections: int = INTERNET_MAX_CONNECTIONS,
+        max_connections_per_host: int = INTERNET_MAX_CONNECTIONS_PER_HOST,
+        max_bytes: int = INTERNET_PAGE_MAX_BYTES,
+        timeout: float = INTERNET_PAGE_TIMEOUT,
+    ):
+        self.max_connections_per_host: int = max_connections_per_host
+        self.max_bytes: int = max_bytes
+        self.client: AsyncClient = AsyncClient(
+            headers=HEADERS,
+            follow_redirects=True,
+            timeout=Timeout(timeout),
+            limits=Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+        # semaphores of hosts being fetched and the number of requests using them
+        self._hosts: dict[str, tuple[Semaphore, int]] = {}
+
+    @asynccontextmanager
+    async def _ahost_slot(self, url: str) -> AsyncIterator[None]:
+        """
+        Hold a connection slot of the URL's host. The host's semaphore is dropped when
+        no request uses it, so hosts of past searches don't pile up.
+        """
+        host: str = urlsplit(url).netloc
+        semaphore, users = self._hosts.get(
+            host, (Semaphore(self.max_connections_per_host), 0)
+        )
+        self._hosts[host] = (semaphore, users + 1)
+
+        try:
+            async with semaphore:
+                yield
+        finally:
+            semaphore, users = self._hosts[host]
+
+            if users == 1:
+                del self._hosts[host]
+            else:
+                self._hosts[host] = (semaphore, users - 1)
+
+    async def afetch(
+        self,
+        url: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> Optional[Page]:
+        """
+        Fetch page, reading at most max_bytes of its body. If etag or last_modified of
+        a cached version is given, the request is conditional.
+
+        Returns:
+            Optional[Page]: page or None if the page could not be fetched
+        """
+        logger.debug("afetch, url=%s", url)
+
+        async with self._ahost_slot(url):
+            return await cassette.acall(
+                "page",
+                {"url": url, "etag": etag, "last_modified": last_modified},
+                lambda: self._aget(url, etag, last_modified),
+                lambda page: None if page is None else page._asdict(),
+                lambda data: None if data is None else Page(**data),
+            )
+
+    async def _aget(
+        self, url: str, etag: Optional[str], last_modified: Optional[str]
+    ) -> Optional[Page]:
+        """Download the page"""
+        headers: dict[str, str] = {}
+        body: bytearray = bytearray()
+
+        if etag:
+            headers["If-None-Match"] = etag
+
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        try:
+            with tracing.span("GET", "http", url=url) as span:
+                async with self.client.stream("GET", url, headers=headers) as response:
+                    if span is not None:
+                        span.attributes["status"] = response.status_code
+
+                    if response.status_code == 304:
+                        return Page("", etag, last_modified, not_modified=True)
+
+                    response.raise_for_status()
+
+                    async for chunk in response.aiter_bytes():
+                        body.extend(chunk)
+
+                        if len(body) >= self.max_bytes:
+                            logger.debug("_aget, truncated, url=%s", url)
+                            break
+
+                    encoding: str = response.encoding or "utf-8"
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+        except HTTPError as e:
+            logger.warning("_aget, url=%s, error=%s", url, e)
+            return None
+
+        try:
+            text: str = body[: self.max_bytes].decode(encoding, errors="replace")
+        except LookupError:
+            text = body[: self.max_bytes].decode("utf-8", errors="replace")
+
+        return Page(text, etag, last_modified)
+
+    async def aclose(self):
+        """Close connections"""
+        await self.client.aclose()
+
+
+def get_fetcher() -> PageFetcher:
+    """Get page fetcher, shared by all requests of the current event loop"""
+    global _fetcher
+    global _fetcher_loop
+
+    loop: AbstractEventLoop = get_running_loop()
+
+    if _fetcher is None or _fetcher_loop is not loop:
+        _fetcher = PageFetcher()
+        _fetcher_loop = loop
+
+    return _fetcher
+
+
+async def aclose():
+    """Close the shared page fetcher"""
+    global _fetcher
+    global _fetcher_loop
+
+    if _fetcher is not None:
+        await _fetcher.aclose()
+        _fetcher = None
+        _fetcher_loop = None
@@ -1,53 +1,237 @@
 """
 Indexer - ingests data from DATA_PATH directory and adds it to Weaviate database.
+Only added and changed files are parsed and embedded, chunks of changed and removed
+files are deleted from the database. Indexed files are tracked in the index manifest.
+Files are parsed and chunked in worker processes, chunks are embedded concurrently in
+batches and written to the database batch by batch.
 """
 
+from asyncio import AbstractEventLoop, Future, Lock, get_running_loop, to_thread
+from asyncio import run as run_async
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import islice
 from logging import getLogger
+from time import perf_counter
+from typing import AsyncIterator, Iterator, Optional
 
-from llama_index.core import (
-    Document,
-    SimpleDirectoryReader,
-    StorageContext,
-    VectorStoreIndex,
-)
+from llama_index.core import Document, SimpleDirectoryReader
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode
 from llama_index.vector_stores.weaviate import WeaviateVectorStore
+from llama_index.vector_stores.weaviate.utils import create_default_schema
+from pydantic import BaseModel
 
-from rag.config import CHUNK_OVERLAP, CHUNK_SIZE, DATA_PATH
+from rag.config import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    DATA_PATH,
+    INDEX_MANIFEST_PATH,
+    INDEX_NAME,
+    INDEXER_QUEUE_SIZE,
+    INDEXER_WORKERS,
+)
 from rag.db.vector import get_embedding_model, get_vector_store
+from rag.modules import cache
+from rag.modules.embedder import BatchEmbedder, EmbeddingStats
+from rag.modules.manifest import Manifest, ManifestDiff, ManifestEntry, file_hash
 
 logger = getLogger(__name__)
 
 
-def run():
-    """Run the indexer."""
-    logger.debug("run")
+class IndexReport(BaseModel):
+    """Indexing results"""
 
-    vector_store: WeaviateVectorStore = get_vector_store()
-    documents: list[Document]
+    full: bool = False
+    added: int = 0
+    changed: int = 0
+    removed: int = 0
+    unchanged: int = 0
+    chunks_added: int = 0
+    chunks_deleted: int = 0
+    failed_files: list[str] = []
+    embedding: EmbeddingStats = EmbeddingStats()
+    elapsed: float = 0
 
+
+def _discover_files() -> list[str]:
+    """Get paths of all source files"""
     try:
-        documents: list[Document] = SimpleDirectoryReader(
+        reader: SimpleDirectoryReader = SimpleDirectoryReader(
             DATA_PATH, recursive=True, exclude=["weaviate"]
-        ).load_data()
+        )
     except ValueError:
-        logger.error("run, no documents found in %s", DATA_PATH)
-        return
+        logger.warning("_discover_files, no documents found in %s", DATA_PATH)
+        return []
+
+    return [str(p) for p in reader.input_files]
 
-    logger.debug("run, loaded documents=%s", documents)
-    storage_context: StorageContext = StorageContext.from_defaults(
-        vector_store=vector_store
+
+def _reset_index(vector_store: WeaviateVectorStore):
+    """Drop all objects from the index"""
+    logger.debug("_reset_index")
+    vector_store.clear()
+    # sync add doesn't create the collection, so it's recreated right away
+    create_default_schema(vector_store.client, INDEX_NAME)
+
+
+def _parse_file(file_path: str) -> list[BaseNode]:
+    """Parse and chunk file, runs in a worker process"""
+    documents: list[Document] = SimpleDirectoryReader(
+        input_files=[file_path], filename_as_id=True
+    ).load_data()
+
+    return SentenceSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)(
+        documents
     )
 
-    logger.debug("run, creating vector store index")
-    index: VectorStoreIndex = VectorStoreIndex.from_documents(
-        documents,
-        embed_model=get_embedding_model(),
-        storage_context=storage_context,
-        transformations=[
-            SentenceSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-        ],
-        show_progress=True,
+
+async def _aparse_files(
+    file_paths: list[str], executor: Executor, failed_files: set[str]
+) -> AsyncIterator[BaseNode]:
+    """
+    Parse and chunk files in worker processes, yields chunks in file order.
+    At most INDEXER_QUEUE_SIZE files are parsed ahead of the embedding stage.
+    """
+    loop: AbstractEventLoop = get_running_loop()
+    paths: Iterator[str] = iter(file_paths)
+    pending: deque[tuple[str, Future]] = deque()
+
+    def submit(count: int):
+        for file_path in islice(paths, count):
+            pending.append(
+                (file_path, loop.run_in_executor(executor, _parse_file, file_path))
+            )
+
+    submit(INDEXER_QUEUE_SIZE)
+
+    while pending:
+        file_path, future = pending.popleft()
+        submit(1)
+
+        try:
+            nodes: list[BaseNode] = await future
+        except Exception as e:
+            logger.error("_aparse_files, file_path=%s, error=%s", file_path, e)
+            failed_files.add(file_path)
+            continue
+
+        for node in nodes:
+            yield node
+
+
+async def _aindex_files(
+    vector_store: WeaviateVectorStore,
+    file_paths: list[str],
+    manifest: Manifest,
+    report: IndexReport,
+):
+    """
+    Parse, chunk, embed and save files. Stages are streamed, so only a bounded number
+    of files and chunks is kept in memory at any time.
+
+    Ids of saved objects are added to the manifest batch by batch, files get an empty
+    hash until they are complete, so objects of an interrupted run are deleted and
+    their files re-indexed on the next run.
+    """
+    logger.debug("_aindex_files, files=%s", len(file_paths))
+
+    for file_path in file_paths:
+        manifest.files[file_path] = ManifestEntry(hash="")
+
+    if not file_paths:
+        return
+
+    write_lock: Lock = Lock()
+    failed_files: set[str] = set()
+
+    async def write(batch: list[BaseNode]):
+        async with write_lock:
+            ids: list[str] = await to_thread(vector_store.add, batch)
+
+        for node_id, node in zip(ids, batch):
+            manifest.files[node.metadata["file_path"]].ids.append(node_id)
+
+        report.chunks_added += len(ids)
+
+    embedder: BatchEmbedder = BatchEmbedder(get_embedding_model())
+
+    with ProcessPoolExecutor(max_workers=INDEXER_WORKERS or None) as executor:
+        failed: list[BaseNode] = await embedder.arun(
+            _aparse_files(file_paths, executor, failed_files), write
+        )
+
+    failed_files.update(node.metadata["file_path"] for node in failed)
+    report.embedding = embedder.stats
+    report.failed_files = sorted(failed_files)
+
+
+def run(full: bool = False) -> IndexReport:
+    """
+    Run the indexer.
+
+    Args:
+        full (bool): re-index all files, also done when there's no manifest yet
+    """
+    logger.debug("run, full=%s", full)
+    started: float = perf_counter()
+
+    vector_store: WeaviateVectorStore = get_vector_store()
+    hashes: dict[str, str] = {p: file_hash(p) for p in _discover_files()}
+    manifest: Optional[Manifest] = None if full else Manifest.load(INDEX_MANIFEST_PATH)
+    report: IndexReport = IndexReport(full=manifest is None)
+
+    if manifest is None:
+        _reset_index(vector_store)
+        manifest = Manifest()
+
+    diff: ManifestDiff = manifest.diff(hashes)
+    logger.debug(
+        "run, added=%s, changed=%s, removed=%s",
+        diff.added,
+        diff.changed,
+        diff.removed,
     )
 
-    logger.debug("run, vector store index created, %s", index)
+    stale_ids: list[str] = [
+        node_id
+        for file_path in diff.changed + diff.removed
+        for node_id in manifest.files[file_path].ids
+    ]
+
+    if stale_ids:
+        vector_store.delete_nodes(stale_ids)
+
+    for file_path in diff.changed + diff.removed:
+        del manifest.files[file_path]
+
+    # deleted objects must not be referenced even if indexing fails below
+    manifest.save(INDEX_MANIFEST_PATH)
+
+    try:
+        run_async(
+            _aindex_files(vector_store, diff.added + diff.changed, manifest, report)
+        )
+
+        for file_path in diff.added + diff.changed:
+            # files with failed chunks are re-indexed on the next run
+            if file_path not in report.failed_files:
+                manifest.files[file_path].hash = hashes[file_path]
+    finally:
+        # ids of objects saved before a failure are kept, so they can be deleted
+        manifest.save(INDEX_MANIFEST_PATH)
+
+    report.added = len(diff.added)
+    report.changed = len(diff.changed)
+    report.removed = len(diff.removed)
+    report.unchanged = len(diff.unchanged)
+    report.chunks_deleted = len(stale_ids)
+    report.elapsed = perf_counter() - started
+
+    if report.full or report.chunks_added or report.chunks_deleted:
+        # cached answers may be outdated now
+        cache.invalidate()
+
+    logger.info("run, %s", report)
+
+    return report
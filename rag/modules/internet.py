@@ -1,27 +1,181 @@
 """
 Internet fetcher - creates a QueryEngineTool, that sends query to Brave Search API,
-gets first 2 results, fetches their content and asks LLM to answer the query using data
-from those 2 websites.
+fetches top results concurrently and asks LLM to answer the query using data from the
+first 2 websites that respond. Search results and page texts are cached on disk.
 """
 
 import re
+from asyncio import (
+    FIRST_COMPLETED,
+    AbstractEventLoop,
+    Task,
+    create_task,
+    get_running_loop,
+    to_thread,
+    wait,
+)
+from asyncio import run as run_async
 from json import loads
 from logging import getLogger
+from time import time
+from typing import AsyncGenerator, Optional
 
+import requests
 from inscriptis import get_text
 from llama_index.core import Document, PromptTemplate
+from llama_index.core.llms import CompletionResponse
 from llama_index.core.query_engine import CustomQueryEngine
 from llama_index.core.tools import QueryEngineTool
 from llama_index.tools.brave_search import BraveSearchToolSpec
-from requests import Response
-from requests import get as http_get
+from pydantic import BaseModel
 
-from rag.config import BRAVE_SEARCH_API_KEY
+from rag import cassette, metrics, tracing
+from rag.config import (
+    BRAVE_SEARCH_API_KEY,
+    BRAVE_SEARCH_TIMEOUT,
+    BRAVE_SEARCH_URL,
+    INTERNET_CACHE_PATH,
+    INTERNET_CACHE_SIZE,
+    INTERNET_FETCH_PAGES,
+    INTERNET_FETCH_TIMEOUT,
+    INTERNET_PAGE_CACHE_TTL,
+    INTERNET_SEARCH_CACHE_TTL,
+    INTERNET_USE_PAGES,
+)
+from rag.db.cache import DiskCache
 from rag.llm import get_llm
 from rag.llm.yandex import YandexLLM
+from rag.modules.fetcher import Page, PageFetcher, get_fetcher
 
 logger = getLogger(__name__)
 
+_cache: Optional["InternetCache"] = None
+
+
+class BraveSearch(BraveSearchToolSpec):
+    """Brave Search tool with configurable API URL"""
+
+    def __init__(
+        self,
+        api_key: str,
+        url: str = BRAVE_SEARCH_URL,
+        timeout: float = BRAVE_SEARCH_TIMEOUT,
+    ):
+        super().__init__(api_key=api_key)
+        self.url: str = url
+        self.timeout: float = timeout
+
+    def _make_request(self, params: dict) -> requests.Response:
+        response: requests.Response = requests.get(
+            self.url,
+            params=params,
+            headers={
+                "Accept": "application/json",
+                "Accept-Encoding": "gzip",
+                "X-Subscription-Token": self.api_key,
+            },
+            # connect and read timeouts
+            timeout=(self.timeout, self.timeout),
+        )
+        response.raise_for_status()
+
+        return response
+
+    def brave_search(
+        self, query: str, search_lang: str = "en", num_results: int = 5
+    ) -> list[Document]:
+        params: dict = {"q": query, "search_lang": search_lang, "count": num_results}
+        text: str = cassette.call(
+            "brave", params, lambda: self._make_request(params).text
+        )
+
+        return [Document(text=text)]
+
+
+class CachedPage(BaseModel):
+    """Cached page text with validators for conditional requests"""
+
+    text: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    fetched_at: float
+
+
+class InternetCache:
+    """
+    On-disk cache of Brave search results and extracted page texts. Pages older than
+    TTL are revalidated with ETag / Last-Modified instead of being downloaded again.
+    """
+
+    def __init__(
+        self,
+        db_path: str = INTERNET_CACHE_PATH,
+        search_ttl: float = INTERNET_SEARCH_CACHE_TTL,
+        page_ttl: float = INTERNET_PAGE_CACHE_TTL,
+        max_size: int = INTERNET_CACHE_SIZE,
+    ):
+        self.search_ttl: float = search_ttl
+        self.page_ttl: float = page_ttl
+        self.max_size: int = max_size
+
+        self.searches: DiskCache = DiskCache(db_path, "search")
+        self.pages: DiskCache = DiskCache(db_path, "page")
+
+        self.search_hits: int = 0
+        self.search_misses: int = 0
+        self.page_hits: int = 0
+        self.page_revalidations: int = 0
+        self.page_misses: int = 0
+
+    def _search_key(self, query: str, lang: str) -> str:
+        return f"{lang}\n{' '.join(query.lower().split())}"
+
+    def get_search(self, query: str, lang: str) -> Optional[str]:
+        """Get Brave API response for the query"""
+        value: Optional[bytes] = self.searches.get(
+            self._search_key(query, lang), self.search_ttl
+        )
+
+        if value is None:
+            self.search_misses += 1
+            return None
+
+        self.search_hits += 1
+
+        return value.decode("utf-8")
+
+    def put_search(self, query: str, lang: str, response: str):
+        """Save Brave API response for the query"""
+        self.searches.set(self._search_key(query, lang), response.encode("utf-8"))
+        self.searches.evict(self.max_size)
+
+    def get_page(self, url: str) -> Optional[CachedPage]:
+        """Get cached page, it may be stale"""
+        value: Optional[bytes] = self.pages.get(url)
+
+        return CachedPage.model_validate_json(value) if value is not None else None
+
+    def is_fresh(self, page: CachedPage) -> bool:
+        """Check if the page can be used without revalidation"""
+        return time() - page.fetched_at < self.page_ttl
+
+    def put_page(self, url: str, page: CachedPage):
+        """Save page"""
+        self.pages.set(url, page.model_dump_json().encode("utf-8"))
+        self.pages.evict(self.max_size)
+
+    def stats(self) -> dict:
+        """Get cache counters"""
+        return {
+            "search_size": self.searches.count(),
+            "search_hits": self.search_hits,
+            "search_misses": self.search_misses,
+            "page_size": self.pages.count(),
+            "page_hits": self.page_hits,
+            "page_revalidations": self.page_revalidations,
+            "page_misses": self.page_misses,
+        }
+
 
 class InternetSearchQueryEngine(CustomQueryEngine):
     """Own RAG query engine with web search support"""
@@ -38,6 +192,7 @@ class InternetSearchQueryEngine(CustomQueryEngine):
 
     llm: YandexLLM
     search_tool: BraveSearchToolSpec
+    cache: Optional[InternetCache] = None
 
     def _clear_text(self, text: str) -> str:
         """Clear text"""
@@ -47,51 +202,235 @@ class InternetSearchQueryEngine(CustomQueryEngine):
 
         return text.strip()
 
+    def _get_search_results(self, query: str) -> list[dict]:
+        """Get top results from Brave API or cache"""
+        response: Optional[str] = (
+            self.cache.get_search(query, "ru") if self.cache is not None else None
+        )
+
+        if response is None:
+            with metrics.stage("brave_search"):
+                with tracing.span("brave_search", "http", query=query):
+                    search_results: list[Document] = self.search_tool.brave_search(
+                        query, "ru", 5
+                    )
+            response = search_results[0].text
+
+            if self.cache is not None:
+                self.cache.put_search(query, "ru", response)
+
+        return loads(response)["web"]["results"][:INTERNET_FETCH_PAGES]
+
+    def _get_content(self, html: str) -> str:
+        """Extract text from a fetched page"""
+        content: str = get_text(html).strip()
+        content = self._clear_text(content)
+
+        # avoid too long content
+        if len(content) > 1024:
+            content = content[:1024]
+
+        return content
+
+    async def _afetch_content(self, fetcher: PageFetcher, url: str) -> Optional[str]:
+        """Fetch page and extract its text, fresh cached text is used without fetching"""
+        cached: Optional[CachedPage] = None
+
+        if self.cache is not None:
+            cached = await to_thread(self.cache.get_page, url)
+
+            if cached is not None and self.cache.is_fresh(cached):
+                self.cache.page_hits += 1
+                return cached.text
+
+        with metrics.stage("page_fetch"):
+            page: Optional[Page] = await (
+                fetcher.afetch(url, cached.etag, cached.last_modified)
+                if cached is not None
+                else fetcher.afetch(url)
+            )
+
+        if page is None:
+            return None
+
+        if page.not_modified and cached is not None:
+            self.cache.page_revalidations += 1
+            cached.fetched_at = time()
+            await to_thread(self.cache.put_page, url, cached)
+
+            return cached.text
+
+        content: str = await to_thread(self._get_content, page.text)
+
+        if self.cache is not None:
+            self.cache.page_misses += 1
+
+            if content:
+                await to_thread(
+                    self.cache.put_page,
+                    url,
+                    CachedPage(
+                        text=content,
+                        etag=page.etag,
+                        last_modified=page.last_modified,
+                        fetched_at=time(),
+                    ),
+                )
+
+        return content or None
+
+    async def _afetch_contents(
+        self, fetcher: PageFetcher, urls: list[str]
+    ) -> list[str]:
+        """
+        Fetch pages concurrently and return texts of the first INTERNET_USE_PAGES pages
+        that arrived before the deadline, other requests are cancelled.
+        """
+        loop: AbstractEventLoop = get_running_loop()
+        deadline: float = loop.time() + INTERNET_FETCH_TIMEOUT
+        pending: set[Task] = {
+            create_task(self._afetch_content(fetcher, url)) for url in urls
+        }
+        contents: list[str] = []
+
+        try:
+            while pending and len(contents) < INTERNET_USE_PAGES:
+                timeout: float = deadline - loop.time()
+
+                if timeout <= 0:
+                    logger.warning("_afetch_contents, deadline exceeded")
+                    break
+
+                done, pending = await wait(
+                    pending, timeout=timeout, return_when=FIRST_COMPLETED
+                )
+
+                for task in done:
+                    if not task.cancelled() and task.exception() is None:
+                        if task.result():
+                            contents.append(task.result())
+        finally:
+            for task in pending:
+                task.cancel()
+
+        return contents[:INTERNET_USE_PAGES]
+
     def _search(self, query: str) -> list[str]:
         """Search internet and get content list"""
         # get a result list from Brave API
-        search_results: list[Document] = self.search_tool.brave_search(query, "ru", 5)
-        search_result_list: list[dict] = loads(search_results[0].text)["web"]["results"]
-        contents: list[str] = []
+        urls: list[str] = [r["url"] for r in self._get_search_results(query)]
+        logger.debug("_search, fetching urls=%s", urls)
 
-        for search_result in search_result_list[:2]:
-            logger.debug("_search, fetching url=%s", search_result["url"])
-            response: Response = http_get(search_result["url"], timeout=10)
-            content: str = get_text(response.text).strip()
-            content = self._clear_text(content)
+        async def fetch() -> list[str]:
+            # the shared client belongs to the API's event loop, so use a new one here
+            fetcher: PageFetcher = PageFetcher()
 
-            # avoid too long content
-            if len(content) > 1024:
-                content = content[:1024]
+            try:
+                return await self._afetch_contents(fetcher, urls)
+            finally:
+                await fetcher.aclose()
 
-            contents.append(content)
+        return run_async(fetch())
 
-        return contents
+    async def _asearch(self, query: str) -> list[str]:
+        """Search internet and get content list without blocking the event loop"""
+        urls: list[str] = [
+            r["url"] for r in await to_thread(self._get_search_results, query)
+        ]
+        logger.debug("_asearch, fetching urls=%s", urls)
 
-    def custom_query(self, query_str: str) -> str:
-        """Custom query handler"""
-        logger.debug("custom_query, query_str=%s", query_str)
+        return await self._afetch_contents(get_fetcher(), urls)
 
-        search_results: list[str] = self._search(query_str)
+    def _get_prompt(self, query_str: str, search_results: list[str]) -> str:
+        """Get an answer prompt"""
         context_str: str = "\n---\n".join(search_results)
         prompt: str = self.ANSWER_PROMPT.format(
             context_str=context_str, query_str=query_str
         )
-        logger.debug("custom_query, prompt=%s", prompt)
+        logger.debug("_get_prompt, prompt=%s", prompt)
+
+        return prompt
+
+    def custom_query(self, query_str: str) -> str:
+        """Custom query handler"""
+        logger.debug("custom_query, query_str=%s", query_str)
+
+        search_results: list[str] = self._search(query_str)
+        prompt: str = self._get_prompt(query_str, search_results)
+
+        with metrics.stage("internet_generate"):
+            result: str = str(self.llm.complete(prompt)).strip()
 
-        result: str = str(self.llm.complete(prompt)).strip()
         logger.debug("custom_query, result=%s", result)
 
         return result
 
+    async def aprepare(self, query_str: str) -> list[str]:
+        """Search internet and fetch pages, the first step of a query"""
+        return await self._asearch(query_str)
+
+    async def aanswer(self, query_str: str, search_results: list[str]) -> str:
+        """Generate an answer from fetched pages"""
+        prompt: str = self._get_prompt(query_str, search_results)
+
+        with metrics.stage("internet_generate"):
+            result: str = str(await self.llm.acomplete(prompt)).strip()
+
+        logger.debug("aanswer, result=%s", result)
+
+        return result
+
+    async def astream_answer(
+        self, query_str: str, search_results: list[str]
+    ) -> AsyncGenerator[tuple[str, str], None]:
+        """Generate an answer from fetched pages, yields stage name and tokens"""
+        prompt: str = self._get_prompt(query_str, search_results)
+
+        yield "stage", "generate"
+        response: CompletionResponse
+
+        with metrics.stage("internet_generate"):
+            async for response in await self.llm.astream_complete(prompt):
+                yield "token", response.delta
+
+    async def acustom_query(self, query_str: str) -> str:
+        """Custom query handler, async version"""
+        logger.debug("acustom_query, query_str=%s", query_str)
+
+        return await self.aanswer(query_str, await self.aprepare(query_str))
+
+    async def astream_custom_query(
+        self, query_str: str
+    ) -> AsyncGenerator[tuple[str, str], None]:
+        """Custom query handler, yields stage names and answer tokens"""
+        logger.debug("astream_custom_query, query_str=%s", query_str)
+
+        yield "stage", "search"
+        search_results: list[str] = await self.aprepare(query_str)
+
+        async for event in self.astream_answer(query_str, search_results):
+            yield event
+
+
+def get_internet_cache() -> InternetCache:
+    """Get worker's search and page cache"""
+    global _cache
+
+    if _cache is None:
+        _cache = InternetCache()
+
+    return _cache
+
 
-def get_tool() -> QueryEngineTool:
+def get_tool(api_key: str = BRAVE_SEARCH_API_KEY) -> QueryEngineTool:
     """Get internet search query engine."""
     logger.debug("get_tool")
 
-    tool: BraveSearchToolSpec = BraveSearchToolSpec(api_key=BRAVE_SEARCH_API_KEY)
+    tool: BraveSearchToolSpec = BraveSearch(api_key=api_key)
     search_query_engine: InternetSearchQueryEngine = InternetSearchQueryEngine(
-        llm=get_llm(), search_tool=tool
+        llm=get_llm(),
+        search_tool=tool,
+        cache=get_internet_cache() if INTERNET_CACHE_PATH else None,
     )
 
     query_engine_tool: QueryEngineTool = QueryEngineTool.from_defaults(
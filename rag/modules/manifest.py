@@ -0,0 +1,91 @@
+"""
+Index manifest - keeps track of indexed files, their content hashes and ids of their
+chunks in Weaviate, so only changed files are re-indexed.
+"""
+
+from hashlib import sha256
+from logging import getLogger
+from os import makedirs, path, replace
+from typing import Optional
+
+from pydantic import BaseModel
+
+logger = getLogger(__name__)
+
+
+class ManifestEntry(BaseModel):
+    """Indexed file"""
+
+    hash: str
+    ids: list[str] = []
+
+
+class ManifestDiff(BaseModel):
+    """Difference between indexed files and files on disk"""
+
+    added: list[str] = []
+    changed: list[str] = []
+    removed: list[str] = []
+    unchanged: list[str] = []
+
+
+class Manifest(BaseModel):
+    """Indexed files by path"""
+
+    files: dict[str, ManifestEntry] = {}
+
+    @classmethod
+    def load(cls, manifest_path: str) -> Optional["Manifest"]:
+        """Load manifest, returns None if there's no manifest yet"""
+        logger.debug("load, manifest_path=%s", manifest_path)
+
+        if not path.exists(manifest_path):
+            return None
+
+        with open(manifest_path, encoding="utf-8") as f:
+            return cls.model_validate_json(f.read())
+
+    def save(self, manifest_path: str):
+        """Save manifest atomically"""
+        logger.debug("save, manifest_path=%s", manifest_path)
+        makedirs(path.dirname(manifest_path) or ".", exist_ok=True)
+        tmp_path: str = manifest_path + ".tmp"
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.model_dump_json())
+
+        replace(tmp_path, manifest_path)
+
+    def diff(self, hashes: dict[str, str]) -> ManifestDiff:
+        """
+        Compare manifest with files on disk.
+
+        Args:
+            hashes (dict[str, str]): content hashes of files on disk by path
+        """
+        result: ManifestDiff = ManifestDiff()
+
+        for file_path, file_hash in hashes.items():
+            entry: Optional[ManifestEntry] = self.files.get(file_path)
+
+            if entry is None:
+                result.added.append(file_path)
+            elif entry.hash != file_hash:
+                result.changed.append(file_path)
+            else:
+                result.unchanged.append(file_path)
+
+        result.removed = [p for p in self.files if p not in hashes]
+
+        return result
+
+
+def file_hash(file_path: str) -> str:
+    """Get file content hash"""
+    digest = sha256()
+
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
@@ -0,0 +1,184 @@
+"""
+Query pipeline registry - builds tools, query engines and prompts once per worker, so
+messages don't pay for object graph construction, and rebuilds them when
+configuration changes.
+"""
+
+from asyncio import sleep, to_thread
+from logging import getLogger
+from typing import Optional
+
+from fastapi import Request
+from llama_index.core.tools import QueryEngineTool
+from llama_index.vector_stores.weaviate import WeaviateVectorStore
+
+from rag.config import ANSWER_CACHE_ENABLED, PipelineConfig
+from rag.db.vector import get_async_vector_store, get_embedding_model, is_ready
+from rag.llm import get_llm
+from rag.llm.yandex import YandexLLM
+from rag.modules import guard, internet, search
+from rag.modules.agent import AgentQueryEngine
+from rag.modules.cache import AnswerCache, get_answer_cache
+from rag.modules.router import RAGQueryEngine, get_embedding_router
+
+logger = getLogger(__name__)
+
+
+class Pipeline:
+    """
+    Prebuilt query pipeline: LLM, tools and query engines. Search tool uses an async
+    Weaviate client, so the pipeline must be queried with async methods only.
+    """
+
+    def __init__(self, config: PipelineConfig, vector_store: WeaviateVectorStore):
+        logger.debug("__init__, config=%s", config)
+
+        self.config: PipelineConfig = config
+        self.llm: YandexLLM = get_llm()
+        self.search_tool: QueryEngineTool = search.get_tool(
+            top_k=config.search_top_k,
+            alpha=config.hybrid_alpha,
+            vector_store=vector_store,
+        )
+        self.internet_tool: QueryEngineTool = internet.get_tool(
+            api_key=config.brave_search_api_key
+        )
+
+        tools: list[QueryEngineTool] = [self.search_tool, self.internet_tool]
+        self.router: RAGQueryEngine = RAGQueryEngine(
+            llm=self.llm, tools=tools, embedding_router=get_embedding_router(tools)
+        )
+        self.agent: AgentQueryEngine = AgentQueryEngine(llm=self.llm, tools=tools)
+        self.cache: Optional[AnswerCache] = (
+            get_answer_cache() if ANSWER_CACHE_ENABLED else None
+        )
+
+    async def warm_up(self):
+        """Open Weaviate, embedding and LLM connections before accepting traffic"""
+        logger.info("warm_up, weaviate ready=%s", await is_ready())
+
+        await get_embedding_model().aget_query_embedding("warm up")
+        logger.info("warm_up, embedding model ready")
+
+        await self.llm.aconnect()
+        logger.info("warm_up, llm ready")
+
+        if self.router.embedding_router is not None:
+            await self.router.embedding_router.abuild()
+            logger.info("warm_up, embedding router ready")
+
+        await to_thread(guard.get_classifier)
+        logger.info("warm_up, prompt injection classifier ready")
+
+    def collect_metrics(self) -> list[tuple[str, dict, float]]:
+        """Get cache, guard and speculative routing counters as metric samples"""
+        caches: dict[str, tuple[float, float, float]] = {}
+        embedding: dict = get_embedding_model().stats()
+        caches["embedding"] = (
+            embedding["hits"],
+            embedding["misses"],
+            embedding["memory_size"],
+        )
+
+        if self.cache is not None:
+            answer: dict = self.cache.stats()
+            caches["answer"] = (
+                answer["hits"] + answer["semantic_hits"],
+                answer["misses"],
+                answer["size"],
+            )
+
+        internet_cache: Optional[internet.InternetCache] = (
+            self.internet_tool.query_engine.cache
+        )
+
+        if internet_cache is not None:
+            web: dict = internet_cache.stats()
+            caches["search"] = (
+                web["search_hits"],
+                web["search_misses"],
+                web["search_size"],
+            )
+            caches["page"] = (
+                web["page_hits"] + web["page_revalidations"],
+                web["page_misses"],
+                web["page_size"],
+            )
+
+        samples: list[tuple[str, dict, float]] = []
+
+        for name, (hits, misses, size) in caches.items():
+            samples.append(("rag_cache_hits_total", {"cache": name}, hits))
+            samples.append(("rag_cache_misses_total", {"cache": name}, misses))
+            samples.append(("rag_cache_entries", {"cache": name}, size))
+
+        verdicts: dict = guard.stats()
+        samples.append(
+            ("rag_cache_entries", {"cache": "guard"}, verdicts.pop("cache_size"))
+        )
+
+        for source, count in verdicts.items():
+            samples.append(("rag_guard_verdicts_total", {"source": source}, count))
+
+        for outcome, count in self.router.speculation_stats().items():
+            samples.append(
+                ("rag_router_speculations_total", {"outcome": outcome}, count)
+            )
+
+        return samples
+
+
+class PipelineRegistry:
+    """Holds the current pipeline of a worker and swaps it on configuration change"""
+
+    def __init__(self):
+        self._pipeline: Optional[Pipeline] = None
+
+    async def start(self) -> Pipeline:
+        """Build the first pipeline of a worker"""
+        await self.reload(force=True)
+
+        return self._pipeline
+
+    def get(self) -> Pipeline:
+        """Get current pipeline"""
+        if self._pipeline is None:
+            raise RuntimeError("Pipeline registry is not started")
+
+        return self._pipeline
+
+    async def reload(self, force: bool = False) -> bool:
+        """
+        Re-read configuration and rebuild the pipeline if it has changed.
+        Requests in flight keep using the pipeline they have started with.
+
+        Returns:
+            bool: True if the pipeline was rebuilt
+        """
+        config: PipelineConfig = await to_thread(PipelineConfig.from_env)
+
+        if not force and self._pipeline and self._pipeline.config == config:
+            return False
+
+        logger.info("reload, building pipeline, config=%s", config)
+        vector_store: WeaviateVectorStore = await get_async_vector_store()
+        self._pipeline = await to_thread(Pipeline, config, vector_store)
+
+        return True
+
+    async def watch(self, interval: float):
+        """Periodically check configuration and hot-reload the pipeline"""
+        logger.debug("watch, interval=%s", interval)
+
+        while True:
+            await sleep(interval)
+
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("watch, failed to reload pipeline")
+
+
+def get_pipeline(request: Request) -> Pipeline:
+    """Get worker's pipeline, for FastAPI dependencies"""
+    return request.app.state.pipelines.get()
@@ -1,18 +1,27 @@
 """
 Query router - determines user's intent and either sends request to Weaviate, or to
-internet search module.
+internet search module. The intent is determined by embedding similarity, LLM is asked
+only if the query is ambiguous. In speculative mode the first step of the tools
+(retrieval, web search) runs concurrently with routing.
 """
 
+from asyncio import CancelledError, Semaphore, Task, create_task
+from contextlib import suppress
 from logging import getLogger
-from typing import Optional
+from typing import Any, AsyncGenerator, Iterable, Optional
 
 from llama_index.core import PromptTemplate, Response
+from llama_index.core.bridge.pydantic import PrivateAttr
 from llama_index.core.query_engine import CustomQueryEngine
 from llama_index.core.tools import QueryEngineTool
 
+from rag import metrics, tracing
+from rag.config import ROUTER_MODE, ROUTER_SPECULATION_LIMITS, ROUTER_SPECULATIVE
+from rag.db.vector import get_embedding_model
 from rag.llm import get_llm
 from rag.llm.yandex import YandexLLM
 from rag.modules import internet, search
+from rag.modules.routing import EmbeddingRouter, RoutingDecision
 
 logger = getLogger(__name__)
 
@@ -33,46 +42,310 @@ class RAGQueryEngine(CustomQueryEngine):
 
     llm: YandexLLM
     tools: list[QueryEngineTool]
+    embedding_router: Optional[EmbeddingRouter] = None
+    speculative: bool = ROUTER_SPECULATIVE
+    # max number of concurrent speculative runs by tool name, missing tools
+    # are not speculated
+    speculation_limits: dict[str, int] = ROUTER_SPECULATION_LIMITS
 
-    def custom_query(self, query_str: str) -> str:
-        """Custom query handler"""
-        logger.debug("custom_query, query_str=%s", query_str)
+    _tools_str: str = PrivateAttr(default="")
+    _speculation_slots: dict[str, Semaphore] = PrivateAttr(default_factory=dict)
+    _speculation_stats: dict[str, int] = PrivateAttr(
+        default_factory=lambda: {"started": 0, "used": 0, "cancelled": 0}
+    )
 
-        # buiding a tool list for an LLM
-        tools_str: str = "\n\n".join(
+    def model_post_init(self, __context: Any) -> None:
+        """Build a tool list for an LLM once per engine"""
+        self._tools_str = "\n\n".join(
             [f"{t.metadata.name}: {t.metadata.description}" for t in self.tools]
         )
-        prompt: str = self.TOOLS_PROMPT.format(tools_str=tools_str, query_str=query_str)
-        logger.debug("custom_query, prompt=%s", prompt)
-        selected_tool: str = str(self.llm.complete(prompt)).strip()
+        self._speculation_slots = {
+            name: Semaphore(limit)
+            for name, limit in self.speculation_limits.items()
+            if limit > 0
+        }
+
+    def _get_prompt(self, query_str: str) -> str:
+        """Get a tool selection prompt"""
+        prompt: str = self.TOOLS_PROMPT.format(
+            tools_str=self._tools_str, query_str=query_str
+        )
+        logger.debug("_get_prompt, prompt=%s", prompt)
+
+        return prompt
+
+    def _select_tool(self, selected_tool: str) -> Optional[QueryEngineTool]:
+        """Find a tool by LLM's reply"""
+        selected_tool = selected_tool.strip()
 
         # some modules continue generation after tool selection
         if "\n" in selected_tool:
             selected_tool = selected_tool[: selected_tool.find("\n")].strip()
 
-        logger.debug("custom_query, selected_tool=%s", selected_tool)
-
-        tool_obj: Optional[QueryEngineTool] = None
+        logger.debug("_select_tool, selected_tool=%s", selected_tool)
 
         for tool in self.tools:
             if selected_tool == tool.metadata.name:
-                tool_obj = tool
-                break
+                return tool
+
+        return None
+
+    def _finish_decision(
+        self, decision: RoutingDecision, tool_obj: Optional[QueryEngineTool]
+    ) -> RoutingDecision:
+        """Record LLM's choice for an ambiguous query"""
+        decision.method = "llm"
+        decision.tool = tool_obj.metadata.name if tool_obj is not None else None
+
+        return decision
+
+    def _route(self, query_str: str) -> tuple[Optional[QueryEngineTool], str]:
+        """
+        Select a tool for the query.
+
+        Returns:
+            tuple[Optional[QueryEngineTool], str]: selected tool and its name
+        """
+        decision: Optional[RoutingDecision] = None
+
+        if self.embedding_router is not None:
+            try:
+                decision = self.embedding_router.route(query_str)
+            except Exception:
+                logger.exception("_route, embedding routing failed")
+
+            if decision is not None and decision.tool is not None:
+                self.embedding_router.export(decision)
+                return self._select_tool(decision.tool), decision.tool
+
+        selected_tool: str = str(self.llm.complete(self._get_prompt(query_str)))
+        tool_obj: Optional[QueryEngineTool] = self._select_tool(selected_tool)
+
+        if decision is not None:
+            self.embedding_router.export(self._finish_decision(decision, tool_obj))
+
+        return tool_obj, selected_tool
+
+    async def _aroute(self, query_str: str) -> tuple[Optional[QueryEngineTool], str]:
+        """Select a tool for the query, async version"""
+        decision: Optional[RoutingDecision] = None
+
+        if self.embedding_router is not None:
+            try:
+                decision = await self.embedding_router.aroute(query_str)
+            except Exception:
+                logger.exception("_aroute, embedding routing failed")
+
+            if decision is not None and decision.tool is not None:
+                await self.embedding_router.aexport(decision)
+                return self._select_tool(decision.tool), decision.tool
+
+        selected_tool: str = str(await self.llm.acomplete(self._get_prompt(query_str)))
+        tool_obj: Optional[QueryEngineTool] = self._select_tool(selected_tool)
+
+        if decision is not None:
+            await self.embedding_router.aexport(
+                self._finish_decision(decision, tool_obj)
+            )
+
+        return tool_obj, selected_tool
+
+    @staticmethod
+    async def _aprepare_speculatively(
+        query_engine: Any, query_str: str
+    ) -> tuple[bool, Any]:
+        """
+        Run the first step of a tool.
+
+        Returns:
+            tuple[bool, Any]: whether the step succeeded and its result
+        """
+        try:
+            with tracing.span(
+                "prepare",
+                "tool",
+                speculative=True,
+                engine=type(query_engine).__name__,
+            ):
+                return True, await query_engine.aprepare(query_str)
+        except Exception:
+            logger.exception("_aprepare_speculatively, query_str=%s", query_str)
+            return False, None
+
+    async def _aspeculate(self, query_str: str) -> dict[str, Task]:
+        """Start the first step of every tool allowed to run speculatively"""
+        tasks: dict[str, Task] = {}
+
+        if not self.speculative:
+            return tasks
+
+        for tool in self.tools:
+            slot: Optional[Semaphore] = self._speculation_slots.get(tool.metadata.name)
+
+            if (
+                slot is None
+                or slot.locked()
+                or not hasattr(tool.query_engine, "aprepare")
+            ):
+                continue
+
+            await slot.acquire()
+            task: Task = create_task(
+                self._aprepare_speculatively(tool.query_engine, query_str)
+            )
+            # a task cancelled before it starts never runs its finally blocks
+            task.add_done_callback(lambda _, slot=slot: slot.release())
+            tasks[tool.metadata.name] = task
+
+        self._speculation_stats["started"] += len(tasks)
+
+        return tasks
+
+    async def _aclaim(
+        self, tasks: dict[str, Task], tool_obj: Optional[QueryEngineTool]
+    ) -> tuple[bool, Any]:
+        """
+        Keep the speculative result of the selected tool and cancel the rest.
+
+        Returns:
+            tuple[bool, Any]: whether the result is available and the result
+        """
+        name: Optional[str] = tool_obj.metadata.name if tool_obj is not None else None
+        self._speculation_stats["cancelled"] += await self._acancel(
+            [task for task_name, task in tasks.items() if task_name != name]
+        )
+
+        if name not in tasks:
+            return False, None
+
+        prepared, result = await tasks[name]
+
+        if prepared:
+            self._speculation_stats["used"] += 1
+
+        return prepared, result
+
+    @staticmethod
+    async def _acancel(tasks: Iterable[Task]) -> int:
+        """
+        Cancel speculative runs and wait until they stop
+
+        Returns:
+            int: number of runs cancelled before they finished
+        """
+        cancelled: list[Task] = [task for task in tasks if task.cancel()]
+
+        for task in cancelled:
+            with suppress(CancelledError):
+                await task
+
+        return len(cancelled)
+
+    def speculation_stats(self) -> dict[str, int]:
+        """Get speculative execution counters"""
+        return dict(self._speculation_stats)
+
+    def custom_query(self, query_str: str) -> str:
+        """Custom query handler"""
+        logger.debug("custom_query, query_str=%s", query_str)
+
+        with metrics.stage("route"):
+            tool_obj, selected_tool = self._route(query_str)
+
+        if tool_obj is None:
+            return "Unknown tool: " + selected_tool.strip()
+
+        with tracing.span(tool_obj.metadata.name, "tool"):
+            return tool_obj.call(query_str).content
+
+    async def acustom_query(self, query_str: str) -> str:
+        """Custom query handler, async version"""
+        logger.debug("acustom_query, query_str=%s", query_str)
+        tasks: dict[str, Task] = await self._aspeculate(query_str)
+
+        try:
+            with metrics.stage("route"):
+                tool_obj, selected_tool = await self._aroute(query_str)
+        except BaseException:
+            await self._acancel(tasks.values())
+            raise
+
+        prepared, result = await self._aclaim(tasks, tool_obj)
 
         if tool_obj is None:
-            return "Unknown tool: " + selected_tool
+            return "Unknown tool: " + selected_tool.strip()
+
+        with tracing.span(tool_obj.metadata.name, "tool", prepared=prepared):
+            if prepared:
+                return str(await tool_obj.query_engine.aanswer(query_str, result))
+
+            return (await tool_obj.acall(query_str)).content
 
-        return tool_obj.call(query_str).content
+    async def astream_query(
+        self, query_str: str
+    ) -> AsyncGenerator[tuple[str, str], None]:
+        """
+        Query handler, yields ("stage", name) events while processing the query and
+        ("token", text) events with parts of the answer.
+        """
+        logger.debug("astream_query, query_str=%s", query_str)
+
+        yield "stage", "route"
+        tasks: dict[str, Task] = await self._aspeculate(query_str)
+
+        try:
+            with metrics.stage("route"):
+                tool_obj, selected_tool = await self._aroute(query_str)
+        except BaseException:
+            await self._acancel(tasks.values())
+            raise
+
+        prepared, result = await self._aclaim(tasks, tool_obj)
+
+        if tool_obj is None:
+            yield "token", "Unknown tool: " + selected_tool.strip()
+            return
 
+        yield "stage", tool_obj.metadata.name
+        query_engine: Any = tool_obj.query_engine
 
-def run(query: str) -> str:
-    """Run the router."""
+        with tracing.span(tool_obj.metadata.name, "tool", prepared=prepared):
+            if prepared:
+                async for event in query_engine.astream_answer(query_str, result):
+                    yield event
+                return
+
+            if not hasattr(query_engine, "astream_custom_query"):
+                yield "token", (await tool_obj.acall(query_str)).content
+                return
+
+            async for event in query_engine.astream_custom_query(query_str):
+                yield event
+
+
+def get_embedding_router(tools: list[QueryEngineTool]) -> Optional[EmbeddingRouter]:
+    """Get embedding router for the tools, None if routing is done by LLM only"""
+    if ROUTER_MODE != "embedding":
+        return None
+
+    return EmbeddingRouter(get_embedding_model(), tools)
+
+
+def run(query: str, router: Optional[RAGQueryEngine] = None) -> str:
+    """
+    Run the router.
+
+    Args:
+        query (str): user query
+        router (RAGQueryEngine): prebuilt router, a new one is built if not passed
+    """
     logger.debug("run, query=%s", query)
 
-    router: RAGQueryEngine = RAGQueryEngine(
-        llm=get_llm(),
-        tools=[search.get_tool(), internet.get_tool()],
-    )
+    if router is None:
+        tools: list[QueryEngineTool] = [search.get_tool(), internet.get_tool()]
+        router = RAGQueryEngine(
+            llm=get_llm(), tools=tools, embedding_router=get_embedding_router(tools)
+        )
 
     response: Response = router.query(query)
     response_text: str = response.response
@@ -83,3 +356,24 @@ def run(query: str) -> str:
     logger.debug("run, querying router, got response=%s", response.response)
 
     return response_text
+
+
+async def arun(query: str, router: RAGQueryEngine) -> str:
+    """
+    Run the router asynchronously.
+
+    Args:
+        query (str): user query
+        router (RAGQueryEngine): prebuilt router
+    """
+    logger.debug("arun, query=%s", query)
+
+    response: Response = await router.aquery(query)
+    response_text: str = response.response
+
+    if response_text == "Empty Response":
+        response_text = "Извините, я не могу найти ответ на ваш запрос."
+
+    logger.debug("arun, querying router, got response=%s", response.response)
+
+    return response_text
@@ -0,0 +1,176 @@
+"""
+Embedding router - picks a tool by cosine similarity of the query embedding to
+embeddings of tool descriptions and labelled example queries. Ambiguous queries are
+left to the LLM router.
+"""
+
+from asyncio import Lock, gather, to_thread
+from json import dumps, loads
+from logging import getLogger
+from os import makedirs, path
+from time import time
+from typing import Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.tools import QueryEngineTool
+from pydantic import BaseModel
+
+from rag.config import (
+    ROUTER_DECISIONS_PATH,
+    ROUTER_EXAMPLES_PATH,
+    ROUTER_MARGIN,
+    ROUTER_MIN_SCORE,
+)
+
+logger = getLogger(__name__)
+
+
+class RoutingDecision(BaseModel):
+    """Routing result"""
+
+    query: str
+    # selected tool, None if the query is ambiguous
+    tool: Optional[str] = None
+    score: float = 0
+    margin: float = 0
+    method: str = "embedding"
+
+
+def load_examples(examples_path: str = ROUTER_EXAMPLES_PATH) -> dict[str, list[str]]:
+    """Load example queries by tool name from JSONL file with "query" and "tool" fields"""
+    examples: dict[str, list[str]] = {}
+
+    if not path.exists(examples_path):
+        logger.warning("load_examples, no examples in %s", examples_path)
+        return examples
+
+    with open(examples_path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                example: dict = loads(line)
+                examples.setdefault(example["tool"], []).append(example["query"])
+
+    return examples
+
+
+class EmbeddingRouter:
+    """Routes queries to tools by nearest labelled texts"""
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        tools: list[QueryEngineTool],
+        examples: Optional[dict[str, list[str]]] = None,
+        margin: float = ROUTER_MARGIN,
+        min_score: float = ROUTER_MIN_SCORE,
+        decisions_path: str = ROUTER_DECISIONS_PATH,
+    ):
+        self.embed_model: BaseEmbedding = embed_model
+        self.margin: float = margin
+        self.min_score: float = min_score
+        self.decisions_path: str = decisions_path
+
+        if examples is None:
+            examples = load_examples()
+
+        # labelled texts - tool descriptions and example queries
+        self._texts: list[str] = []
+        self._tool_names: list[str] = [t.metadata.name for t in tools]
+        labels: list[int] = []
+
+        for index, tool in enumerate(tools):
+            for text in [
+                tool.metadata.description,
+                *examples.get(tool.metadata.name, []),
+            ]:
+                self._texts.append(text)
+                labels.append(index)
+
+        self._labels: np.ndarray = np.asarray(labels)
+        self._matrix: Optional[np.ndarray] = None
+        self._lock: Lock = Lock()
+
+    @staticmethod
+    def _normalize(embeddings: list[Embedding]) -> np.ndarray:
+        matrix: np.ndarray = np.asarray(embeddings, dtype=np.float32)
+        norms: np.ndarray = np.linalg.norm(matrix, axis=-1, keepdims=True)
+
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def build(self):
+        """Embed labelled texts"""
+        if self._matrix is None:
+            logger.debug("build, texts=%s", len(self._texts))
+            self._matrix = self._normalize(
+                [self.embed_model.get_query_embedding(t) for t in self._texts]
+            )
+
+    async def abuild(self):
+        """Embed labelled texts, async version"""
+        async with self._lock:
+            if self._matrix is None:
+                logger.debug("abuild, texts=%s", len(self._texts))
+                self._matrix = self._normalize(
+                    await gather(
+                        *[self.embed_model.aget_query_embedding(t) for t in self._texts]
+                    )
+                )
+
+    def _decide(self, query: str, embedding: Embedding) -> RoutingDecision:
+        """Score query embedding against every tool"""
+        scores: np.ndarray = self._matrix @ self._normalize([embedding])[0]
+        # best score of every tool
+        tool_scores: np.ndarray = np.full(len(self._tool_names), -1.0)
+        np.maximum.at(tool_scores, self._labels, scores)
+
+        order: np.ndarray = np.argsort(tool_scores)[::-1]
+        best: float = float(tool_scores[order[0]])
+        margin: float = best - float(tool_scores[order[1]]) if len(order) > 1 else best
+        decision: RoutingDecision = RoutingDecision(
+            query=query, score=best, margin=margin
+        )
+
+        if best >= self.min_score and margin >= self.margin:
+            decision.tool = self._tool_names[order[0]]
+
+        logger.debug("_decide, decision=%s", decision)
+
+        return decision
+
+    def route(self, query: str) -> RoutingDecision:
+        """Route the query"""
+        self.build()
+
+        return self._decide(query, self.embed_model.get_query_embedding(query))
+
+    async def aroute(self, query: str) -> RoutingDecision:
+        """Route the query, async version"""
+        await self.abuild()
+
+        return self._decide(query, await self.embed_model.aget_query_embedding(query))
+
+    def export(self, decision: RoutingDecision):
+        """Append the decision to the decisions file for threshold tuning"""
+        logger.info(
+            "export, tool=%s, method=%s, score=%.4f, margin=%.4f",
+            decision.tool,
+            decision.method,
+            decision.score,
+            decision.margin,
+        )
+
+        if not self.decisions_path:
+            return
+
+        makedirs(path.dirname(self.decisions_path) or ".", exist_ok=True)
+
+        with open(self.decisions_path, "a", encoding="utf-8") as f:
+            f.write(
+                dumps({"time": time(), **decision.model_dump()}, ensure_ascii=False)
+                + "\n"
+            )
+
+    async def aexport(self, decision: RoutingDecision):
+        """Export the decision without blocking the event loop"""
+        await to_thread(self.export, decision)
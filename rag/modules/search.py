@@ -1,14 +1,26 @@
 """
-Weaviate search module. 
+Weaviate search module.
 Uses 50/50 hybrid search - vector and BM25.
 """
 
 from logging import getLogger
+from typing import AsyncGenerator, Optional
 
-from llama_index.core import VectorStoreIndex, query_engine
+from llama_index.core import (
+    QueryBundle,
+    Settings,
+    VectorStoreIndex,
+    get_response_synthesizer,
+)
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.response.schema import RESPONSE_TYPE, AsyncStreamingResponse
+from llama_index.core.query_engine import CustomQueryEngine
+from llama_index.core.response_synthesizers import BaseSynthesizer
+from llama_index.core.schema import NodeWithScore
 from llama_index.core.tools import QueryEngineTool
 from llama_index.vector_stores.weaviate import WeaviateVectorStore
 
+from rag import metrics, tracing
 from rag.config import HYBRID_ALPHA, WEAVIATE_SEARCH_TOP_K
 from rag.db.vector import get_embedding_model, get_vector_store
 from rag.llm import get_llm
@@ -16,21 +28,118 @@ from rag.llm import get_llm
 logger = getLogger(__name__)
 
 
-def get_tool() -> QueryEngineTool:
-    """Get vector search query engine."""
-    logger.debug("get_tool")
+class DatabaseSearchQueryEngine(CustomQueryEngine):
+    """
+    Weaviate search query engine, retrieval and answer generation are separate steps,
+    so the answer can be streamed.
+    """
+
+    retriever: BaseRetriever
+    synthesizer: BaseSynthesizer
+    streaming_synthesizer: BaseSynthesizer
+
+    def retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        """Retrieve chunks"""
+        with metrics.stage("retrieve"):
+            return self.retriever.retrieve(query_bundle)
+
+    async def aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        """Retrieve chunks, async version"""
+        with metrics.stage("retrieve"):
+            return await self.retriever.aretrieve(query_bundle)
+
+    def custom_query(self, query_str: str) -> RESPONSE_TYPE:
+        """Custom query handler"""
+        logger.debug("custom_query, query_str=%s", query_str)
+        query_bundle: QueryBundle = QueryBundle(query_str)
+        nodes: list[NodeWithScore] = self.retrieve(query_bundle)
+
+        with metrics.stage("search_generate"):
+            return self.synthesizer.synthesize(query_bundle, nodes)
+
+    async def aprepare(self, query_str: str) -> list[NodeWithScore]:
+        """Retrieve chunks, the first step of a query"""
+        return await self.aretrieve(QueryBundle(query_str))
+
+    async def aanswer(
+        self, query_str: str, nodes: list[NodeWithScore]
+    ) -> RESPONSE_TYPE:
+        """Generate an answer from retrieved chunks"""
+        with metrics.stage("search_generate"):
+            return await self.synthesizer.asynthesize(QueryBundle(query_str), nodes)
+
+    async def astream_answer(
+        self, query_str: str, nodes: list[NodeWithScore]
+    ) -> AsyncGenerator[tuple[str, str], None]:
+        """Generate an answer from retrieved chunks, yields stage name and tokens"""
+        yield "stage", "generate"
+
+        with metrics.stage("search_generate"):
+            response: RESPONSE_TYPE = await self.streaming_synthesizer.asynthesize(
+                QueryBundle(query_str), nodes
+            )
+
+            if not isinstance(response, AsyncStreamingResponse):
+                # nothing was found, synthesizer doesn't call LLM in this case
+                yield "token", str(response)
+                return
+
+            async for token in response.async_response_gen():
+                yield "token", token
+
+    async def acustom_query(self, query_str: str) -> RESPONSE_TYPE:
+        """Custom query handler, async version"""
+        logger.debug("acustom_query, query_str=%s", query_str)
+
+        return await self.aanswer(query_str, await self.aprepare(query_str))
+
+    async def astream_custom_query(
+        self, query_str: str
+    ) -> AsyncGenerator[tuple[str, str], None]:
+        """Custom query handler, yields stage names and answer tokens"""
+        logger.debug("astream_custom_query, query_str=%s", query_str)
+
+        yield "stage", "retrieve"
+        nodes: list[NodeWithScore] = await self.aprepare(query_str)
+
+        async for event in self.astream_answer(query_str, nodes):
+            yield event
+
+
+def get_tool(
+    top_k: int = WEAVIATE_SEARCH_TOP_K,
+    alpha: float = HYBRID_ALPHA,
+    vector_store: Optional[WeaviateVectorStore] = None,
+) -> QueryEngineTool:
+    """
+    Get vector search query engine.
+
+    Args:
+        top_k (int): number of chunks to retrieve
+        alpha (float): hybrid search vector weight
+        vector_store (WeaviateVectorStore): store to search in, sync one by default
+    """
+    logger.debug("get_tool, top_k=%s, alpha=%s", top_k, alpha)
+
+    if vector_store is None:
+        vector_store = get_vector_store()
+
+    # retriever and synthesizers report their events to the global callback manager
+    tracing.instrument(Settings.callback_manager)
 
-    vector_store: WeaviateVectorStore = get_vector_store()
     index: VectorStoreIndex = VectorStoreIndex.from_vector_store(
         vector_store=vector_store,
         embed_model=get_embedding_model(),
     )
 
-    vector_query_engine: query_engine.BaseQueryEngine = index.as_query_engine(
-        vector_store_query_mode="hybrid",
-        similarity_top_k=WEAVIATE_SEARCH_TOP_K,
-        llm=get_llm(),
-        alpha=HYBRID_ALPHA,
+    vector_query_engine: DatabaseSearchQueryEngine = DatabaseSearchQueryEngine(
+        retriever=index.as_retriever(
+            vector_store_query_mode="hybrid",
+            similarity_top_k=top_k,
+            alpha=alpha,
+        ),
+        synthesizer=get_response_synthesizer(llm=get_llm()),
+        streaming_synthesizer=get_response_synthesizer(llm=get_llm(), streaming=True),
     )
 
     tool: QueryEngineTool = QueryEngineTool.from_defaults(
@@ -2,17 +2,94 @@
 Chat methods
 """
 
+from datetime import datetime
 from logging import getLogger
+from typing import AsyncIterator, NamedTuple, Optional
 from uuid import UUID, uuid4
 
-from sqlalchemy import Result, Sequence, select
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import (
+    Result,
+    Select,
+    Sequence,
+    exists,
+    insert,
+    select,
+    tuple_,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncScalarResult, AsyncSession
 
+from rag import metrics
+from rag.config import API_PAGE_SIZE, EXPORT_FETCH_SIZE
 from rag.db.sql.models import Chat, Message
 
 logger = getLogger(__name__)
 
+# position in a list ordered by (created_at, id)
+Cursor = tuple[datetime, UUID]
 
+
+class Page(NamedTuple):
+    """Page of chats or messages, newest first"""
+
+    items: Sequence
+    # position of the last item if there are older items
+    next_cursor: Optional[Cursor] = None
+    # position of the first item if there are newer items
+    prev_cursor: Optional[Cursor] = None
+
+
+def _cursor(item: Chat | Message) -> Cursor:
+    return item.created_at, item.id
+
+
+async def _get_page(
+    db: AsyncSession,
+    query: Select,
+    model: type[Chat] | type[Message],
+    limit: int,
+    before: Optional[Cursor],
+    after: Optional[Cursor],
+) -> Page:
+    """
+    Get a page of items by keyset pagination on (created_at, id): items older than
+    `before` or newer than `after`, newest first. One extra row is fetched to find out
+    if there are more items.
+    """
+    key = tuple_(model.created_at, model.id)
+
+    if after is not None:
+        query = query.filter(key > after).order_by(
+            model.created_at.asc(), model.id.asc()
+        )
+    else:
+        if before is not None:
+            query = query.filter(key < before)
+
+        query = query.order_by(model.created_at.desc(), model.id.desc())
+
+    result: Result = await db.execute(query.limit(limit + 1))
+    items: list = list(result.scalars().all())
+    has_more: bool = len(items) > limit
+    items = items[:limit]
+
+    if after is not None:
+        items.reverse()
+
+        return Page(
+            items,
+            next_cursor=_cursor(items[-1]) if items else None,
+            prev_cursor=_cursor(items[0]) if has_more else None,
+        )
+
+    return Page(
+        items,
+        next_cursor=_cursor(items[-1]) if has_more else None,
+        prev_cursor=_cursor(items[0]) if before is not None and items else None,
+    )
+
+
+@metrics.timed("rag_db_seconds", operation="create_chat")
 async def create_chat(db: AsyncSession) -> Chat:
     """
     Create a new chat
@@ -27,17 +104,22 @@ async def create_chat(db: AsyncSession) -> Chat:
     return chat
 
 
-async def get_chats(db: AsyncSession) -> Sequence[Chat]:
+@metrics.timed("rag_db_seconds", operation="get_chats")
+async def get_chats(
+    db: AsyncSession,
+    limit: int = API_PAGE_SIZE,
+    before: Optional[Cursor] = None,
+    after: Optional[Cursor] = None,
+) -> Page:
     """
-    Get all chats
+    Get a page of chats
     """
-    logger.debug("get_chats")
+    logger.debug("get_chats, limit=%s, before=%s, after=%s", limit, before, after)
 
-    result: Result = await db.execute(select(Chat).order_by(Chat.created_at.desc()))
-
-    return result.scalars().all()
+    return await _get_page(db, select(Chat), Chat, limit, before, after)
 
 
+@metrics.timed("rag_db_seconds", operation="get_chat")
 async def get_chat(db: AsyncSession, chat_id: UUID) -> Chat:
     """
     Get chat by id
@@ -49,21 +131,108 @@ async def get_chat(db: AsyncSession, chat_id: UUID) -> Chat:
     return result.scalar()
 
 
-async def get_messages(db: AsyncSession, chat_id: UUID) -> Sequence[Message]:
+@metrics.timed("rag_db_seconds", operation="chat_exists")
+async def chat_exists(db: AsyncSession, chat_id: UUID) -> bool:
+    """
+    Check if chat exists
+    """
+    logger.debug("chat_exists, chat_id=%s", chat_id)
+
+    return bool(await db.scalar(select(exists().where(Chat.id == chat_id))))
+
+
+@metrics.timed("rag_db_seconds", operation="get_message")
+async def get_message(
+    db: AsyncSession, chat_id: UUID, message_id: UUID
+) -> Optional[Message]:
     """
-    Get chat messages
+    Get chat message by id
     """
-    logger.debug("get_messages, chat_id=%s", chat_id)
+    logger.debug("get_message, chat_id=%s, message_id=%s", chat_id, message_id)
 
     result: Result = await db.execute(
-        select(Message)
-        .filter(Message.chat_id == chat_id)
-        .order_by(Message.created_at.desc())
+        select(Message).filter(Message.chat_id == chat_id, Message.id == message_id)
     )
 
-    return result.scalars().all()
+    return result.scalar()
+
 
+@metrics.timed("rag_db_seconds", operation="update_message")
+async def update_message(
+    db: AsyncSession,
+    message_id: UUID,
+    message: str,
+    status: Optional[str] = None,
+    trace: Optional[str] = None,
+):
+    """
+    Set text, status and trace of a message
+    """
+    logger.debug("update_message, message_id=%s, status=%s", message_id, status)
+
+    await db.execute(
+        update(Message)
+        .where(Message.id == message_id)
+        .values(message=message, status=status, trace=trace)
+    )
+    await db.commit()
 
+
+@metrics.timed("rag_db_seconds", operation="get_messages")
+async def get_messages(
+    db: AsyncSession,
+    chat_id: UUID,
+    limit: int = API_PAGE_SIZE,
+    before: Optional[Cursor] = None,
+    after: Optional[Cursor] = None,
+) -> Page:
+    """
+    Get a page of chat messages
+    """
+    logger.debug(
+        "get_messages, chat_id=%s, limit=%s, before=%s, after=%s",
+        chat_id,
+        limit,
+        before,
+        after,
+    )
+
+    return await _get_page(
+        db,
+        select(Message).filter(Message.chat_id == chat_id),
+        Message,
+        limit,
+        before,
+        after,
+    )
+
+
+async def stream_messages(
+    db: AsyncSession,
+    chat_id: Optional[UUID] = None,
+    fetch_size: int = EXPORT_FETCH_SIZE,
+) -> AsyncIterator[Message]:
+    """
+    Stream messages of the chat, or of all chats if chat_id is not set, oldest first.
+    Rows are read from a server-side cursor `fetch_size` rows at a time.
+    """
+    logger.debug("stream_messages, chat_id=%s, fetch_size=%s", chat_id, fetch_size)
+    query: Select = select(Message)
+
+    if chat_id is not None:
+        query = query.filter(Message.chat_id == chat_id)
+
+    result: AsyncScalarResult = await db.stream_scalars(
+        query.order_by(
+            Message.chat_id, Message.created_at, Message.id
+        ).execution_options(yield_per=fetch_size)
+    )
+
+    async for message in result:
+        yield message
+
+
+@metrics.timed("rag_db_seconds", operation="create_message")
 async def create_message(
     db: AsyncSession, chat_id: UUID, message: str, is_system: bool
 ) -> Message:
@@ -80,3 +249,40 @@ async def create_message(
     await db.refresh(message)
 
     return message
+
+
+def new_message(
+    chat_id: UUID, message: str, is_system: bool, status: Optional[str] = None
+) -> dict:
+    """
+    Make a message row to be saved with insert_messages
+    """
+    return {
+        "id": uuid4(),
+        "chat_id": chat_id,
+        "message": message,
+        "is_system": is_system,
+        "trace": None,
+        "status": status,
+        "created_at": datetime.utcnow(),
+    }
+
+
+@metrics.timed("rag_db_seconds", operation="insert_messages")
+async def insert_messages(db: AsyncSession, rows: list[dict]) -> list[Message]:
+    """
+    Save messages with one INSERT ... RETURNING statement and one commit
+    """
+    logger.debug("insert_messages, count=%s", len(rows))
+
+    result: Result = await db.execute(
+        insert(Message.__table__).returning(
+            *Message.__table__.columns, sort_by_parameter_order=True
+        ),
+        rows,
+    )
+    # rows are turned into detached objects, so commit doesn't expire them
+    messages: list[Message] = [Message(**row._mapping) for row in result]
+    await db.commit()
+
+    return messages
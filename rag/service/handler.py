@@ -2,31 +2,231 @@
 Message handler
 """
 
+from json import dumps
 from logging import getLogger
+from typing import Any, AsyncGenerator, Optional
 from uuid import UUID
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from rag.db.sql.models import Chat, Message
-from rag.modules import agent, router
-from rag.service import chat
+from rag import tracing
+from rag.config import MESSAGE_WRITE_DELAY, TRACE_PERSIST
+from rag.db.sql.connection import async_session
+from rag.db.sql.models import Message
+from rag.modules import router
+from rag.modules.pipeline import Pipeline
+from rag.service import chat, writer
 
 logger = getLogger(__name__)
 
+NOT_FOUND = "Извините, я не могу найти ответ на ваш запрос."
+PENDING = "pending"
+FAILED = "failed"
+
 
 async def process_user_message(
-    db: AsyncSession, chat_id: UUID, message: str
+    db: AsyncSession, chat_id: UUID, message: str, pipeline: Pipeline
 ) -> Message:
     """
-    Process user message
+    Process user message. The chat must exist. User message and the answer are saved
+    together once the answer is ready, the database connection isn't held meanwhile.
+
+    Args:
+        db (AsyncSession): database session
+        chat_id (UUID): chat id
+        message (str): user message
+        pipeline (Pipeline): worker's prebuilt query pipeline
     """
     logger.debug("process_user_message, chat_id=%s, message=%s", chat_id, message)
-    existing_chat: Chat = await chat.get_chat(db, chat_id)
+    user_message: dict = chat.new_message(chat_id, message, False)
+    # return the connection to the pool while the answer is generated
+    await db.close()
+
+    try:
+        response: str = await _answer(message, pipeline)
+    except Exception:
+        await _save_messages(db, [user_message])
+        raise
+
+    messages: list[Message] = await _save_messages(
+        db, [user_message, _new_answer(chat_id, response)]
+    )
+
+    return messages[-1]
+
+
+async def create_pending_answer(
+    db: AsyncSession, chat_id: UUID, message: str
+) -> Message:
+    """
+    Save user message with an empty "pending" answer, for the answer to be generated
+    in the background with complete_pending_answer. The chat must exist.
+
+    Returns:
+        Message: the pending answer
+    """
+    logger.debug("create_pending_answer, chat_id=%s, message=%s", chat_id, message)
+    messages: list[Message] = await _save_messages(
+        db,
+        [
+            chat.new_message(chat_id, message, False),
+            chat.new_message(chat_id, "", True, PENDING),
+        ],
+    )
+
+    return messages[-1]
+
+
+async def complete_pending_answer(answer_id: UUID, message: str, pipeline: Pipeline):
+    """Generate the answer and save it in place of the pending one"""
+    logger.debug("complete_pending_answer, answer_id=%s", answer_id)
+
+    try:
+        response: str = await _answer(message, pipeline)
+    except BaseException:
+        # cancelled on shutdown or failed, either way the answer won't come
+        async with async_session() as db:
+            await chat.update_message(db, answer_id, "", FAILED)
+
+        raise
+
+    async with async_session() as db:
+        await chat.update_message(db, answer_id, response, trace=_persisted_trace())
+
+
+async def _answer(message: str, pipeline: Pipeline) -> str:
+    """Get the answer from the cache or generate and cache it"""
+    response: Optional[str] = await _get_cached_answer(message, pipeline)
+
+    if response is None:
+        response = await router.arun(message, pipeline.router)
+        await _cache_answer(message, response, pipeline)
+
+    return response
+
+
+def _new_answer(chat_id: UUID, response: str) -> dict:
+    """Make the answer row, with the request trace if traces are persisted"""
+    row: dict = chat.new_message(chat_id, response, True)
+    row["trace"] = _persisted_trace()
+
+    return row
+
+
+def _persisted_trace() -> Optional[str]:
+    """Get the request trace as JSON, if traces are persisted"""
+    trace: Optional[tracing.Trace] = tracing.current()
+
+    if TRACE_PERSIST and trace is not None:
+        return dumps(trace.to_dict(), ensure_ascii=False, default=str)
+
+    return None
+
+
+async def _save_messages(db: AsyncSession, rows: list[dict]) -> list[Message]:
+    """Save message rows, batched with other requests if write-behind is enabled"""
+    if MESSAGE_WRITE_DELAY > 0:
+        return await writer.get_writer().asave(rows)
+
+    return await chat.insert_messages(db, rows)
+
+
+async def _get_cached_answer(message: str, pipeline: Pipeline) -> Optional[str]:
+    """Get an answer to the same or a similar question from the cache"""
+    if pipeline.cache is None:
+        return None
+
+    return await pipeline.cache.aget(message)
+
+
+async def _cache_answer(message: str, response: str, pipeline: Pipeline):
+    """Cache the answer, unless it's an error or nothing was found"""
+    if pipeline.cache is None:
+        return
+
+    if response.startswith("Unknown tool: ") or response == NOT_FOUND:
+        return
+
+    await pipeline.cache.aput(message, response)
+
+
+async def stream_user_message(
+    db: AsyncSession, chat_id: UUID, message: str, pipeline: Pipeline
+) -> AsyncGenerator[tuple[str, Any], None]:
+    """
+    Process user message in streaming mode. The chat must exist. User message and the
+    answer are saved together when the stream is complete.
+
+    Args:
+        db (AsyncSession): database session
+        chat_id (UUID): chat id
+        message (str): user message
+        pipeline (Pipeline): worker's prebuilt query pipeline
+
+    Returns:
+        AsyncGenerator: ("stage", name), ("token", text) and finally
+            ("message", Message) events
+    """
+    logger.debug("stream_user_message, chat_id=%s, message=%s", chat_id, message)
+    user_message: dict = chat.new_message(chat_id, message, False)
+    await db.close()
+
+    return _stream_answer(chat_id, user_message, pipeline)
+
+
+async def _stream_answer(
+    chat_id: UUID, user_message: dict, pipeline: Pipeline
+) -> AsyncGenerator[tuple[str, Any], None]:
+    """Stream the answer and save it with the user message"""
+    saved: bool = False
+
+    try:
+        async for event in _stream_response(user_message["message"], pipeline):
+            if event[0] == "response":
+                response: str = event[1]
+            else:
+                yield event
+
+        # request's session is closed once streaming starts, so a new one is used
+        async with async_session() as db:
+            messages: list[Message] = await _save_messages(
+                db, [user_message, _new_answer(chat_id, response)]
+            )
+
+        saved = True
+    finally:
+        # failed, cancelled or closed by a disconnected client, the message is kept
+        if not saved:
+            async with async_session() as db:
+                await _save_messages(db, [user_message])
+
+    yield "message", messages[-1]
+
+
+async def _stream_response(
+    message: str, pipeline: Pipeline
+) -> AsyncGenerator[tuple[str, Any], None]:
+    """Stream the answer, the last event is ("response", full answer)"""
+    response: Optional[str] = await _get_cached_answer(message, pipeline)
+
+    if response is not None:
+        yield "stage", "cache"
+        yield "token", response
+
+    else:
+        tokens: list[str] = []
+
+        async for event, data in pipeline.router.astream_query(message):
+            if event == "token":
+                tokens.append(data)
+
+            yield event, data
+
+        response = "".join(tokens).strip()
 
-    if not existing_chat:
-        raise ValueError("Chat not found")
+        if not response or response == "Empty Response":
+            response = NOT_FOUND
 
-    await chat.create_message(db, chat_id, message, False)
-    response: str = router.run(message)
+        await _cache_answer(message, response, pipeline)
 
-    return await chat.create_message(db, chat_id, response, True)
+    yield "response", response
@@ -0,0 +1,197 @@
+"""
+Job queue - answers messages in the background with a bounded pool of workers, so API
+requests don't hold connections while the answer is generated. The request saves the
+user message with a pending answer and returns, clients poll for the answer. New jobs
+are rejected when the queue is full, on shutdown queued jobs are processed before exit.
+"""
+
+from asyncio import Event, Queue, QueueEmpty, Task, create_task, gather, wait_for
+from logging import getLogger
+from typing import Awaitable, Callable, NamedTuple, Optional
+from uuid import UUID
+
+from fastapi import Request
+
+from rag import metrics, tracing
+from rag.config import JOB_DRAIN_TIMEOUT, JOB_QUEUE_SIZE, JOB_WORKERS
+from rag.db.sql.connection import async_session
+from rag.modules.pipeline import Pipeline
+from rag.service import chat
+from rag.service.handler import FAILED, complete_pending_answer
+
+logger = getLogger(__name__)
+
+
+class Job(NamedTuple):
+    """Message to answer"""
+
+    answer_id: UUID
+    message: str
+    pipeline: Pipeline
+    trace: Optional[tracing.Trace] = None
+
+
+class QueueFull(Exception):
+    """The queue is full or closed"""
+
+
+class JobQueue:
+    """Queue of jobs processed by a fixed number of worker tasks"""
+
+    def __init__(self, workers: int = JOB_WORKERS, size: int = JOB_QUEUE_SIZE):
+        self.workers: int = workers
+        self.size: int = size
+
+        self._queue: Queue = Queue()
+        # jobs accepted but not started, including ones being saved
+        self._waiting: int = 0
+        self._running: int = 0
+        self._closed: bool = False
+        # workers are cancelled, jobs can't be queued anymore
+        self._stopped: bool = False
+        self._tasks: list[Task] = []
+        self._done: dict[UUID, Event] = {}
+
+    def start(self):
+        """Start worker tasks"""
+        logger.info("start, workers=%s, size=%s", self.workers, self.size)
+        self._tasks = [create_task(self._awork()) for _ in range(self.workers)]
+
+    async def asubmit(self, make_job: Callable[[], Awaitable[Job]]) -> Job:
+        """
+        Reserve a place in the queue, make the job and queue it. The place is reserved
+        first, so a rejected request doesn't save anything. A job made after the queue
+        was closed and drained is marked as failed.
+
+        Raises:
+            QueueFull: if the queue is full or closed
+        """
+        if self._closed or self._waiting >= self.size:
+            metrics.inc("rag_jobs_total", status="rejected")
+            raise QueueFull()
+
+        self._waiting += 1
+
+        try:
+            job: Job = await make_job()
+        except BaseException:
+            self._waiting -= 1
+            raise
+
+        # the queue was closed and drained while the job was made
+        if self._stopped:
+            self._waiting -= 1
+            await self._afail([job])
+
+            return job
+
+        self._done[job.answer_id] = Event()
+        self._queue.put_nowait(job)
+
+        return job
+
+    async def await_done(self, answer_id: UUID, timeout: float) -> bool:
+        """
+        Wait until the job of the answer is done, if it's processed by this queue
+
+        Returns:
+            bool: False if the job isn't known to this queue
+        """
+        done: Optional[Event] = self._done.get(answer_id)
+
+        if done is None:
+            return False
+
+        try:
+            await wait_for(done.wait(), timeout)
+        except TimeoutError:
+            pass
+
+        return True
+
+    async def _awork(self):
+        """Process jobs until cancelled"""
+        while True:
+            job: Job = await self._queue.get()
+            self._waiting -= 1
+            self._running += 1
+
+            try:
+                await self._aprocess(job)
+            finally:
+                self._running -= 1
+                self._done.pop(job.answer_id).set()
+                self._queue.task_done()
+
+    async def _aprocess(self, job: Job):
+        """Answer the message, errors are saved as the "failed" status"""
+        status: str = "error"
+
+        try:
+            with tracing.use(job.trace), metrics.timer("rag_job_seconds"):
+                await complete_pending_answer(job.answer_id, job.message, job.pipeline)
+
+            status = "ok"
+        except Exception:
+            logger.exception("_aprocess, answer_id=%s", job.answer_id)
+        finally:
+            metrics.inc("rag_jobs_total", status=status)
+            await tracing.afinish(job.trace)
+
+    async def aclose(self, timeout: float = JOB_DRAIN_TIMEOUT):
+        """
+        Stop accepting jobs and wait until queued jobs are processed. Jobs left after
+        the timeout are cancelled and their answers are marked as failed.
+        """
+        self._closed = True
+        logger.info("aclose, waiting=%s, running=%s", self._waiting, self._running)
+
+        try:
+            await wait_for(self._queue.join(), timeout)
+        except TimeoutError:
+            logger.warning("aclose, jobs not finished in %s seconds", timeout)
+
+        for task in self._tasks:
+            task.cancel()
+
+        self._stopped = True
+        await gather(*self._tasks, return_exceptions=True)
+        await self._afail_queued()
+
+    async def _afail_queued(self):
+        """Mark answers of jobs that never started as failed"""
+        failed: list[Job] = []
+
+        while True:
+            try:
+                failed.append(self._queue.get_nowait())
+            except QueueEmpty:
+                break
+
+        if not failed:
+            return
+
+        logger.warning("_afail_queued, jobs=%s", len(failed))
+        await self._afail(failed)
+
+        for job in failed:
+            self._done.pop(job.answer_id).set()
+
+    @staticmethod
+    async def _afail(failed: list[Job]):
+        """Mark answers of the jobs as failed"""
+        async with async_session() as db:
+            for job in failed:
+                await chat.update_message(db, job.answer_id, "", FAILED)
+
+    def collect_metrics(self) -> list[tuple[str, dict, float]]:
+        """Get queue usage as metric samples"""
+        return [
+            ("rag_job_queue", {"state": "waiting"}, self._waiting),
+            ("rag_job_queue", {"state": "running"}, self._running),
+        ]
+
+
+def get_jobs(request: Request) -> Optional[JobQueue]:
+    """Get worker's job queue, None if job mode is off, for FastAPI dependencies"""
+    return getattr(request.app.state, "jobs", None)
@@ -0,0 +1,141 @@
+"""
+Message writer - collects messages of concurrent requests and saves them with one
+insert and one commit per batch. Every request waits until its batch is committed.
+"""
+
+from asyncio import (
+    AbstractEventLoop,
+    Future,
+    Task,
+    create_task,
+    gather,
+    get_running_loop,
+    sleep,
+)
+from logging import getLogger
+from typing import Coroutine, Optional
+
+from rag.config import MESSAGE_WRITE_BATCH_SIZE, MESSAGE_WRITE_DELAY
+from rag.db.sql.connection import async_session
+from rag.db.sql.models import Message
+from rag.service import chat
+
+logger = getLogger(__name__)
+
+_writer: Optional["MessageWriter"] = None
+_writer_loop: Optional[AbstractEventLoop] = None
+
+
+class MessageWriter:
+    """Saves messages in batches"""
+
+    def __init__(
+        self,
+        delay: float = MESSAGE_WRITE_DELAY,
+        batch_size: int = MESSAGE_WRITE_BATCH_SIZE,
+    ):
+        self.delay: float = delay
+        self.batch_size: int = batch_size
+
+        self._pending: list[tuple[list[dict], Future]] = []
+        self._size: int = 0
+        self._timer: Optional[Task] = None
+        self._tasks: set[Task] = set()
+
+    def _spawn(self, coroutine: Coroutine) -> Task:
+        task: Task = create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return task
+
+    async def asave(self, rows: list[dict]) -> list[Message]:
+        """
+        Save message rows made by chat.new_message
+
+        Returns:
+            list[Message]: saved messages in the order of rows
+        """
+        future: Future = get_running_loop().create_future()
+        self._pending.append((rows, future))
+        self._size += len(rows)
+
+        if self._size >= self.batch_size:
+            self._spawn(self._aflush())
+        elif self._timer is None:
+            self._timer = self._spawn(self._aflush_later())
+
+        return await future
+
+    async def _aflush_later(self):
+        """Save the batch once the delay is over"""
+        await sleep(self.delay)
+        self._timer = None
+        await self._aflush()
+
+    async def _aflush(self):
+        """Save all pending messages"""
+        pending: list[tuple[list[dict], Future]] = self._pending
+        self._pending = []
+        self._size = 0
+
+        if not pending:
+            return
+
+        logger.debug("_aflush, requests=%s", len(pending))
+
+        try:
+            async with async_session() as db:
+                messages: list[Message] = await chat.insert_messages(
+                    db, [row for rows, _ in pending for row in rows]
+                )
+        except Exception as e:
+            logger.error("_aflush, requests=%s, error=%s", len(pending), e)
+
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        offset: int = 0
+
+        for rows, future in pending:
+            if not future.done():
+                future.set_result(messages[offset : offset + len(rows)])
+
+            offset += len(rows)
+
+    async def aclose(self):
+        """Save pending messages"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        await gather(*self._tasks, return_exceptions=True)
+        await self._aflush()
+
+
+def get_writer() -> MessageWriter:
+    """Get message writer, shared by all requests of the current event loop"""
+    global _writer
+    global _writer_loop
+
+    loop: AbstractEventLoop = get_running_loop()
+
+    if _writer is None or _writer_loop is not loop:
+        _writer = MessageWriter()
+        _writer_loop = loop
+
+    return _writer
+
+
+async def aclose():
+    """Save messages pending in the shared writer"""
+    global _writer
+    global _writer_loop
+
+    if _writer is not None:
+        await _writer.aclose()
+        _writer = None
+        _writer_loop = None
@@ -0,0 +1,376 @@
+"""
+Tracing - records a timeline of a single request: LLM and embedding calls (from
+LlamaIndex callbacks), processing stages, tool calls, DB statements and HTTP requests.
+Requests opt in with the X-Debug-Trace header or are sampled, spans are only recorded
+while a trace is active, so untraced requests pay almost nothing.
+"""
+
+from asyncio import to_thread
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar, Token
+from itertools import count
+from json import dump
+from logging import getLogger
+from os import makedirs, path
+from random import random
+from time import perf_counter, time
+from typing import Any, Iterator, Optional
+from uuid import uuid4
+
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from pydantic import BaseModel
+from sqlalchemy import Engine, event
+
+from rag.config import TRACE_DIR, TRACE_ENABLED, TRACE_SAMPLE_RATE
+
+logger = getLogger(__name__)
+
+# request header to opt in
+HEADER = "X-Debug-Trace"
+
+# span kinds of LlamaIndex callback events
+EVENT_KINDS: dict[CBEventType, str] = {
+    CBEventType.LLM: "llm",
+    CBEventType.EMBEDDING: "embedding",
+    CBEventType.RETRIEVE: "retrieve",
+    CBEventType.SYNTHESIZE: "synthesize",
+    CBEventType.FUNCTION_CALL: "tool",
+}
+
+_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_span: ContextVar[Optional[int]] = ContextVar("span", default=None)
+
+
+class Span(BaseModel):
+    """Timed operation, start and duration are in milliseconds from trace start"""
+
+    id: int
+    parent_id: Optional[int] = None
+    name: str
+    kind: str
+    start: float
+    duration: Optional[float] = None
+    attributes: dict[str, Any] = {}
+
+
+class Trace:
+    """Spans of one request"""
+
+    def __init__(self, name: str, debug: bool = False):
+        self.id: str = uuid4().hex
+        self.name: str = name
+        # return the trace to the client
+        self.debug: bool = debug
+        self.started_at: float = time()
+        self.duration: Optional[float] = None
+        self.spans: list[Span] = []
+
+        self._started: float = perf_counter()
+        self._ids: Iterator[int] = count(1)
+        # spans of LlamaIndex events by event id
+        self._events: dict[str, Span] = {}
+
+    def _now(self) -> float:
+        return (perf_counter() - self._started) * 1000
+
+    def start_span(
+        self, name: str, kind: str, parent_id: Optional[int] = None, **attributes: Any
+    ) -> Span:
+        """Start a span"""
+        span: Span = Span(
+            id=next(self._ids),
+            parent_id=parent_id,
+            name=name,
+            kind=kind,
+            start=self._now(),
+            attributes=attributes,
+        )
+        self.spans.append(span)
+
+        return span
+
+    def end_span(self, span: Span):
+        """End a span"""
+        span.duration = self._now() - span.start
+
+    def finish(self):
+        """End the trace"""
+        self.duration = self._now()
+
+    def tokens(self) -> dict[str, int]:
+        """Get total tokens reported by LLM calls of the trace"""
+        totals: dict[str, int] = {"input_tokens": 0, "completion_tokens": 0}
+
+        for span in self.spans:
+            for key in totals:
+                totals[key] += span.attributes.get(key, 0)
+
+        return totals
+
+    def to_dict(self) -> dict:
+        """Get the trace for a debug field or the database"""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration if self.duration is not None else self._now(),
+            "spans": [span.model_dump() for span in self.spans],
+        }
+
+    def server_timing(self) -> str:
+        """Get total duration by span kind as a Server-Timing header value"""
+        totals: dict[str, float] = {}
+
+        for span in self.spans:
+            if span.duration is not None and span.kind != "stage":
+                totals[span.kind] = totals.get(span.kind, 0) + span.duration
+
+        return ", ".join(
+            [f"{kind};dur={duration:.1f}" for kind, duration in totals.items()]
+            + [f"total;dur={self.duration or self._now():.1f}"]
+        )
+
+    def to_chrome(self) -> dict:
+        """
+        Get the trace in Chrome Trace Event format, it can be opened in Perfetto or
+        chrome://tracing. Spans are async events, so concurrent spans are shown too.
+        """
+        events: list[dict] = []
+
+        for span in self.spans:
+            common: dict = {
+                "name": span.name,
+                "cat": span.kind,
+                "id": span.id,
+                "pid": 1,
+                "tid": 1,
+            }
+            events.append(
+                {
+                    **common,
+                    "ph": "b",
+                    "ts": span.start * 1000,
+                    "args": {**span.attributes, "parent_id": span.parent_id},
+                }
+            )
+            events.append(
+                {
+                    **common,
+                    "ph": "e",
+                    "ts": (span.start + (span.duration or 0)) * 1000,
+                }
+            )
+
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "trace_id": self.id,
+                "name": self.name,
+                "started_at": self.started_at,
+            },
+        }
+
+    def export(self, trace_dir: str = TRACE_DIR):
+        """Save the trace in Chrome Trace Event format to trace_dir"""
+        if not trace_dir:
+            return
+
+        makedirs(trace_dir, exist_ok=True)
+
+        with open(path.join(trace_dir, f"{self.id}.json"), "w", encoding="utf-8") as f:
+            dump(self.to_chrome(), f, ensure_ascii=False, default=str)
+
+
+def start(name: str, headers: dict) -> Optional[Trace]:
+    """Start a trace if the request opted in or was sampled"""
+    if not TRACE_ENABLED:
+        return None
+
+    debug: bool = headers.get(HEADER, "").lower() in ("1", "true")
+
+    if debug or (TRACE_SAMPLE_RATE > 0 and random() < TRACE_SAMPLE_RATE):
+        return Trace(name, debug=debug)
+
+    return None
+
+
+async def afinish(trace: Optional[Trace]):
+    """End the trace and export it to TRACE_DIR"""
+    if trace is None:
+        return
+
+    trace.finish()
+
+    if TRACE_DIR:
+        try:
+            await to_thread(trace.export)
+        except OSError:
+            logger.exception("afinish, failed to export trace %s", trace.id)
+
+
+def current() -> Optional[Trace]:
+    """Get the trace of the current request"""
+    return _trace.get()
+
+
+@contextmanager
+def use(trace: Optional[Trace]) -> Iterator[Optional[Trace]]:
+    """Record spans of the block to the trace"""
+    trace_token: Token = _trace.set(trace)
+    span_token: Token = _span.set(None)
+
+    try:
+        yield trace
+    finally:
+        # async generators may be closed in another context
+        with suppress(ValueError):
+            _span.reset(span_token)
+
+        with suppress(ValueError):
+            _trace.reset(trace_token)
+
+
+@contextmanager
+def span(
+    name: str, kind: str = "internal", **attributes: Any
+) -> Iterator[Optional[Span]]:
+    """Record the block as a span of the current trace"""
+    trace: Optional[Trace] = _trace.get()
+
+    if trace is None:
+        yield None
+        return
+
+    current_span: Span = trace.start_span(name, kind, _span.get(), **attributes)
+    token: Token = _span.set(current_span.id)
+
+    try:
+        yield current_span
+    except BaseException as e:
+        current_span.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        trace.end_span(current_span)
+
+        with suppress(ValueError):
+            _span.reset(token)
+
+
+def _get_usage(payload: Optional[dict[str, Any]]) -> dict[str, int]:
+    """Get token usage reported by Yandex GPT from LLM event payload"""
+    payload = payload or {}
+    response: Any = payload.get(EventPayload.RESPONSE) or payload.get(
+        EventPayload.COMPLETION
+    )
+    usage: Any = getattr(getattr(response, "raw", None), "usage", None)
+
+    if usage is None or not hasattr(usage, "input_text_tokens"):
+        return {}
+
+    return {
+        "input_tokens": usage.input_text_tokens,
+        "completion_tokens": usage.completion_tokens,
+    }
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """Records LlamaIndex events as spans of the current trace"""
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        trace: Optional[Trace] = _trace.get()
+
+        if trace is not None and event_type in EVENT_KINDS:
+            parent: Optional[Span] = trace._events.get(parent_id)
+            trace._events[event_id] = trace.start_span(
+                event_type.value,
+                EVENT_KINDS[event_type],
+                parent.id if parent is not None else _span.get(),
+            )
+
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        trace: Optional[Trace] = _trace.get()
+
+        if trace is not None and event_id in trace._events:
+            event_span: Span = trace._events.pop(event_id)
+
+            if event_type == CBEventType.LLM:
+                event_span.attributes.update(_get_usage(payload))
+
+            trace.end_span(event_span)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[dict[str, list[str]]] = None,
+    ) -> None:
+        pass
+
+
+handler: TraceCallbackHandler = TraceCallbackHandler()
+
+
+def instrument(callback_manager: CallbackManager):
+    """Add the trace handler to LlamaIndex callback manager"""
+    if TRACE_ENABLED and handler not in callback_manager.handlers:
+        callback_manager.add_handler(handler)
+
+
+def instrument_engine(engine: Engine):
+    """Record SQL statements of the engine as spans"""
+    if not TRACE_ENABLED:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        trace: Optional[Trace] = _trace.get()
+
+        if trace is not None:
+            context._trace_span = trace.start_span(
+                statement.split(None, 1)[0].lower(),
+                "db",
+                _span.get(),
+                statement=statement[:200],
+            )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        trace: Optional[Trace] = _trace.get()
+        db_span: Optional[Span] = getattr(context, "_trace_span", None)
+
+        if trace is not None and db_span is not None:
+            trace.end_span(db_span)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        trace: Optional[Trace] = _trace.get()
+        context: Any = exception_context.execution_context
+        db_span: Optional[Span] = getattr(context, "_trace_span", None)
+
+        if trace is not None and db_span is not None:
+            db_span.attributes["error"] = type(
+                exception_context.original_exception
+            ).__name__
+            trace.end_span(db_span)
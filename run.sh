@@ -1,4 +1,5 @@
 #!/bin/bash
 
 python indexer.py
+python migrate.py
 python main.py
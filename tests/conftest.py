@@ -0,0 +1,37 @@
+"""
+Test setup - the database is a temporary SQLite file, so tests run without Postgres
+"""
+
+from asyncio import run
+from os import path
+from tempfile import mkdtemp
+from typing import Any, Awaitable, Callable
+
+import pytest
+
+from rag import config
+
+# must be set before rag.db.sql.connection creates the engine
+config.DATABASE_URL = f"sqlite+aiosqlite:///{path.join(mkdtemp(), 'test.db')}"
+
+
+@pytest.fixture
+def run_db() -> Callable[[Callable[[], Awaitable[Any]]], Any]:
+    """Run a test coroutine with empty tables, which are dropped after it"""
+    from rag.db.sql import models  # noqa: F401
+    from rag.db.sql.connection import Base, engine
+
+    async def arun(test: Callable[[], Awaitable[Any]]) -> Any:
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
+        try:
+            return await test()
+        finally:
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.drop_all)
+
+            # connections are bound to the event loop of the test
+            await engine.dispose()
+
+    return lambda test: run(arun(test))
@@ -0,0 +1,81 @@
+from asyncio import run
+from os import path, utime
+
+import pytest
+
+from rag.modules import cache
+from rag.modules.cache import AnswerCache
+
+
+class FakeEmbedding:
+    """Embeds known queries with fixed vectors"""
+
+    VECTORS: dict[str, list[float]] = {
+        "what is rag": [1.0, 0.0],
+        "what is rag exactly": [0.99, 0.14],
+        "who are you": [0.0, 1.0],
+    }
+
+    async def aget_query_embedding(self, query: str) -> list[float]:
+        return self.VECTORS[AnswerCache.normalize(query)]
+
+
+@pytest.fixture
+def version_path(tmp_path) -> str:
+    return path.join(tmp_path, "index", "version")
+
+
+def _set_version(version_path: str, version: float):
+    """Mark the index as rebuilt, with an explicit mtime, as file time may be coarse"""
+    cache.invalidate(version_path)
+    utime(version_path, (version, version))
+
+
+def _new_cache(version_path: str) -> AnswerCache:
+    return AnswerCache(FakeEmbedding(), similarity=0.95, version_path=version_path)
+
+
+def test_exact_and_paraphrased_hits(version_path):
+    async def test():
+        answer_cache: AnswerCache = _new_cache(version_path)
+        await answer_cache.aput("What is RAG?", "answer")
+
+        assert await answer_cache.aget("what is  RAG") == "answer"
+        assert await answer_cache.aget("What is RAG, exactly?") == "answer"
+        assert await answer_cache.aget("Who are you?") is None
+        assert answer_cache.stats() == {
+            "size": 1,
+            "hits": 1,
+            "semantic_hits": 1,
+            "misses": 1,
+        }
+
+    run(test())
+
+
+@pytest.mark.parametrize("built", [True, False])
+def test_rebuilt_index_clears_answers(version_path, built: bool):
+    async def test():
+        if built:
+            _set_version(version_path, 1000)
+
+        answer_cache: AnswerCache = _new_cache(version_path)
+        await answer_cache.aput("What is RAG?", "answer")
+        # another worker rebuilds the index
+        _set_version(version_path, 2000)
+
+        assert await answer_cache.aget("What is RAG?") is None
+        assert answer_cache.stats()["size"] == 0
+
+    run(test())
+
+
+def test_same_index_keeps_answers(version_path):
+    async def test():
+        _set_version(version_path, 1000)
+        answer_cache: AnswerCache = _new_cache(version_path)
+        await answer_cache.aput("What is RAG?", "answer")
+
+        assert await answer_cache.aget("What is RAG?") == "answer"
+
+    run(test())
@@ -0,0 +1,109 @@
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from rag.modules.budget import DROPPED, TRIMMED, TokenBudget
+
+
+def _budget(max_tokens: int, tool_output_tokens: int) -> TokenBudget:
+    """Budget counting words as tokens, to make sizes predictable"""
+    budget: TokenBudget = TokenBudget(max_tokens, tool_output_tokens)
+    budget._tokenizer = str.split
+
+    return budget
+
+
+def _words(count: int, word: str = "word") -> str:
+    return " ".join([word] * count)
+
+
+def _messages(*sizes: int) -> list[ChatMessage]:
+    return [
+        ChatMessage(role=MessageRole.USER, content=_words(size, f"m{i}"))
+        for i, size in enumerate(sizes)
+    ]
+
+
+def test_trim():
+    budget: TokenBudget = _budget(100, 10)
+
+    assert budget.trim(_words(5), 10) == _words(5)
+
+    trimmed: str = budget.trim(_words(50), 10)
+
+    assert trimmed.endswith(TRIMMED)
+    assert budget.count(trimmed) <= 10
+
+
+def test_messages_within_budget_unchanged():
+    budget: TokenBudget = _budget(100, 10)
+    messages: list[ChatMessage] = _messages(10, 10, 30, 30, 10, 10)
+
+    assert budget.fit_messages(messages) == messages
+
+
+def test_older_messages_trimmed():
+    budget: TokenBudget = _budget(100, 10)
+    messages: list[ChatMessage] = _messages(10, 10, 40, 40, 10, 10)
+
+    fitted: list[ChatMessage] = budget.fit_messages(messages)
+
+    # the first trimmed message is enough
+    assert budget.count_messages(fitted) <= 100
+    assert budget.count(fitted[2].content) <= 10
+    assert fitted[3].content == messages[3].content
+    # system prompt, query and the latest step are kept
+    assert [m.content for m in fitted[:2] + fitted[4:]] == [
+        m.content for m in messages[:2] + messages[4:]
+    ]
+
+
+def test_older_messages_dropped_oldest_first():
+    budget: TokenBudget = _budget(50, 20)
+    messages: list[ChatMessage] = _messages(5, 5, 40, 40, 40, 5, 5)
+
+    fitted: list[ChatMessage] = budget.fit_messages(messages)
+
+    assert budget.count_messages(fitted) <= 50
+    assert [m.content for m in fitted[2:4]] == [DROPPED, DROPPED]
+    assert fitted[4].content.endswith(TRIMMED)
+    assert fitted[5:] == messages[5:]
+
+
+def test_history_too_long_keeps_protected_messages():
+    budget: TokenBudget = _budget(20, 10)
+    messages: list[ChatMessage] = _messages(30, 30, 30, 30)
+
+    assert budget.fit_messages(messages) == messages
+
+
+def test_outputs_within_budget_unchanged():
+    budget: TokenBudget = _budget(100, 10)
+    outputs: dict[str, str] = {"a": _words(10), "b": _words(20)}
+
+    assert budget.fit_outputs(outputs, reserved=10) == outputs
+
+
+def test_long_outputs_share_budget():
+    budget: TokenBudget = _budget(100, 10)
+    outputs: dict[str, str] = {
+        "long": _words(200),
+        "short": _words(9),
+        "longer": _words(300),
+    }
+
+    fitted: dict[str, str] = budget.fit_outputs(outputs, reserved=40)
+
+    # order is kept, the short output is whole, its unused share goes to the others
+    assert list(fitted) == list(outputs)
+    assert fitted["short"] == outputs["short"]
+    assert fitted["long"].endswith(TRIMMED)
+    assert fitted["longer"].endswith(TRIMMED)
+    assert sum(budget.count(f"{k}\n{v}") for k, v in fitted.items()) <= 60
+    assert budget.count(fitted["long"]) > 60 // 3
+
+
+def test_no_budget_left():
+    budget: TokenBudget = _budget(100, 10)
+
+    fitted: dict[str, str] = budget.fit_outputs({"a": _words(10)}, reserved=200)
+
+    assert budget.count(fitted["a"]) <= 1
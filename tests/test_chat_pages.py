@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+from uuid import UUID
+
+import pytest
+from fastapi import HTTPException
+
+from rag.api.chat import _decode_cursor, _encode_cursor, _get_cursors
+from rag.db.sql.connection import async_session
+from rag.db.sql.models import Chat
+from rag.service import chat
+
+STARTED = datetime(2024, 1, 1)
+
+
+def test_cursor_round_trip():
+    cursor: chat.Cursor = (
+        datetime(2024, 5, 6, 7, 8, 9, 123456),
+        UUID("12345678-1234-5678-1234-567812345678"),
+    )
+
+    assert _encode_cursor(None) is None
+    assert _decode_cursor(None) is None
+    assert _decode_cursor(_encode_cursor(cursor)) == cursor
+
+
+@pytest.mark.parametrize("value", ["", "not base64!", "bm8gc2VwYXJhdG9y", "YXxi"])
+def test_invalid_cursor(value: str):
+    with pytest.raises(HTTPException) as error:
+        _decode_cursor(value)
+
+    assert error.value.status_code == 400
+
+
+def test_before_and_after_together():
+    cursor: str = _encode_cursor((STARTED, UUID(int=1)))
+
+    with pytest.raises(HTTPException) as error:
+        _get_cursors(cursor, cursor)
+
+    assert error.value.status_code == 400
+
+
+async def _asave_messages(count: int) -> tuple[UUID, list[UUID]]:
+    """Save messages of a new chat, two of them with the same time, oldest first"""
+    async with async_session() as db:
+        new_chat: Chat = await chat.create_chat(db)
+        chat_id: UUID = new_chat.id
+        rows: list[dict] = []
+
+        for i in range(count):
+            row: dict = chat.new_message(chat_id, f"message {i}", False)
+            row["created_at"] = STARTED + timedelta(seconds=min(i, count - 2))
+            rows.append(row)
+
+        await chat.insert_messages(db, rows)
+
+    # messages with the same time are ordered by id
+    rows.sort(key=lambda row: (row["created_at"], row["id"]))
+
+    return chat_id, [row["id"] for row in rows]
+
+
+def _ids(page: chat.Page) -> list[UUID]:
+    return [item.id for item in page.items]
+
+
+def test_message_pages(run_db):
+    async def test():
+        chat_id, ids = await _asave_messages(5)
+        newest_first: list[UUID] = ids[::-1]
+
+        async with async_session() as db:
+            first: chat.Page = await chat.get_messages(db, chat_id, 2)
+            second: chat.Page = await chat.get_messages(
+                db, chat_id, 2, before=first.next_cursor
+            )
+            last: chat.Page = await chat.get_messages(
+                db, chat_id, 2, before=second.next_cursor
+            )
+            back: chat.Page = await chat.get_messages(
+                db, chat_id, 2, after=last.prev_cursor
+            )
+            newest: chat.Page = await chat.get_messages(
+                db, chat_id, 2, after=back.prev_cursor
+            )
+
+        assert _ids(first) == newest_first[:2]
+        assert first.prev_cursor is None
+        assert _ids(second) == newest_first[2:4]
+        assert _ids(last) == newest_first[4:]
+        assert last.next_cursor is None
+        # going back from the last page gives the same pages
+        assert _ids(back) == _ids(second)
+        assert _ids(newest) == _ids(first)
+        assert newest.prev_cursor is None
+
+    run_db(test)
+
+
+def test_exact_page(run_db):
+    async def test():
+        chat_id, ids = await _asave_messages(2)
+
+        async with async_session() as db:
+            page: chat.Page = await chat.get_messages(db, chat_id, 2)
+
+        assert _ids(page) == ids[::-1]
+        assert page.next_cursor is None
+        assert page.prev_cursor is None
+
+    run_db(test)
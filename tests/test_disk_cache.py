@@ -0,0 +1,43 @@
+from os import path
+
+from rag.db.cache import DiskCache
+
+
+def _cache(tmp_path, count: int) -> DiskCache:
+    cache: DiskCache = DiskCache(path.join(tmp_path, "cache.sqlite3"), "test")
+    cache.set_many({str(i): b"value" for i in range(count)})
+
+    return cache
+
+
+def test_evict_within_slack(tmp_path):
+    cache: DiskCache = _cache(tmp_path, 105)
+
+    assert cache.evict(100, slack=0.1) == 0
+    assert cache.count() == 105
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache: DiskCache = _cache(tmp_path, 20)
+    cache.get_many(["0", "1"])
+
+    assert cache.evict(10, slack=0.1) == 10
+    assert cache.count() == 10
+    assert set(cache.get_many([str(i) for i in range(20)])) == {
+        "0",
+        "1",
+        *[str(i) for i in range(12, 20)],
+    }
+
+
+def test_evict_finds_entries_of_other_processes(tmp_path):
+    cache: DiskCache = _cache(tmp_path, 5)
+    other: DiskCache = DiskCache(path.join(tmp_path, "cache.sqlite3"), "test")
+    other.set_many({f"other {i}": b"value" for i in range(10)})
+
+    # replaced keys keep the estimate above the real count
+    cache.set_many({str(i): b"new value" for i in range(5)})
+
+    assert cache.evict(5, slack=0.1) == 10
+    assert other.count() == 5
+    assert set(other.get_many([str(i) for i in range(5)])) == {"0", "1", "2", "3", "4"}
@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+from json import loads
+from random import Random
+from uuid import UUID
+
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient, Response
+
+from rag.api.chat import router
+from rag.config import EXPORT_FETCH_SIZE
+from rag.db.sql.connection import async_session
+from rag.service import chat
+
+STARTED = datetime(2024, 1, 1)
+
+
+async def _anew_chat(count: int) -> tuple[UUID, list[dict]]:
+    """Save a chat with messages inserted out of order, some at the same time"""
+    async with async_session() as db:
+        chat_id: UUID = (await chat.create_chat(db)).id
+
+    rows: list[dict] = [
+        {
+            **chat.new_message(chat_id, f"message {i}", i % 2 == 1),
+            "created_at": STARTED + timedelta(seconds=i // 3),
+        }
+        for i in range(count)
+    ]
+    Random(count).shuffle(rows)
+
+    async with async_session() as db:
+        await chat.insert_messages(db, rows)
+
+    return chat_id, rows
+
+
+def _expected(rows: list[dict]) -> list[str]:
+    return [
+        str(row["id"]) for row in sorted(rows, key=lambda r: (r["created_at"], r["id"]))
+    ]
+
+
+async def _aget(path: str) -> Response:
+    app: FastAPI = FastAPI()
+    app.include_router(router, prefix="/chat")
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as client:
+        return await client.get(path)
+
+
+async def _aexport(path: str) -> list[dict]:
+    response: Response = await _aget(path)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.text.endswith("\n")
+
+    return [loads(line) for line in response.text.splitlines()]
+
+
+def test_chat_export(run_db):
+    async def test():
+        chat_id, rows = await _anew_chat(EXPORT_FETCH_SIZE + 50)
+        await _anew_chat(3)
+
+        messages: list[dict] = await _aexport(f"/chat/{chat_id}/messages/export")
+
+        assert [m["id"] for m in messages] == _expected(rows)
+        assert {m["chat_id"] for m in messages} == {str(chat_id)}
+
+    run_db(test)
+
+
+def test_all_chats_export(run_db):
+    async def test():
+        chats: list[tuple[UUID, list[dict]]] = [
+            await _anew_chat(EXPORT_FETCH_SIZE + 50),
+            await _anew_chat(7),
+        ]
+
+        messages: list[dict] = await _aexport("/chat/export")
+
+        # messages are grouped by chat, chats are ordered by id
+        assert [m["id"] for m in messages] == [
+            message_id
+            for _, rows in sorted(chats, key=lambda c: c[0])
+            for message_id in _expected(rows)
+        ]
+
+    run_db(test)
+
+
+def test_unknown_chat_export(run_db):
+    async def test():
+        response: Response = await _aget(
+            "/chat/00000000-0000-0000-0000-000000000000/messages/export"
+        )
+
+        assert response.status_code == 404
+
+    run_db(test)
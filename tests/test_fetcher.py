@@ -0,0 +1,28 @@
+from asyncio import gather, run, sleep
+
+from rag.modules.fetcher import PageFetcher
+
+
+def test_host_slots_bounded_and_dropped():
+    async def test():
+        fetcher: PageFetcher = PageFetcher(max_connections_per_host=2)
+        active: dict[str, int] = {}
+        peak: dict[str, int] = {}
+
+        async def aget(url: str, host: str):
+            async with fetcher._ahost_slot(url):
+                active[host] = active.get(host, 0) + 1
+                peak[host] = max(peak.get(host, 0), active[host])
+                await sleep(0.01)
+                active[host] -= 1
+
+        await gather(
+            *[aget(f"https://h{i % 3}.test/page/{i}", f"h{i % 3}") for i in range(30)]
+        )
+
+        assert peak == {"h0": 2, "h1": 2, "h2": 2}
+        # semaphores of hosts no request uses are dropped
+        assert fetcher._hosts == {}
+        await fetcher.client.aclose()
+
+    run(test())
@@ -0,0 +1,175 @@
+from asyncio import Event, Task, create_task, sleep
+from uuid import UUID, uuid4
+
+import pytest
+
+from rag.db.sql.connection import async_session
+from rag.db.sql.models import Message
+from rag.service import chat, handler, jobs
+from rag.service.handler import FAILED, PENDING, create_pending_answer
+from rag.service.jobs import Job, JobQueue, QueueFull
+
+
+def _make_job(answer_id: UUID):
+    async def amake_job() -> Job:
+        return Job(answer_id, "question", None)
+
+    return amake_job
+
+
+@pytest.fixture
+def answered(monkeypatch) -> list[UUID]:
+    """Replace answering with recording ids of answered messages"""
+    answer_ids: list[UUID] = []
+
+    async def acomplete_pending_answer(answer_id: UUID, message: str, pipeline):
+        await sleep(0.01)
+        answer_ids.append(answer_id)
+
+    monkeypatch.setattr(jobs, "complete_pending_answer", acomplete_pending_answer)
+
+    return answer_ids
+
+
+def test_full_queue_rejects_jobs(run_db):
+    async def test():
+        queue: JobQueue = JobQueue(workers=1, size=1)
+        made: list[UUID] = []
+
+        async def amake_job() -> Job:
+            made.append(uuid4())
+            return Job(made[-1], "question", None)
+
+        await queue.asubmit(amake_job)
+
+        # the job isn't made, so nothing is saved for a rejected request
+        with pytest.raises(QueueFull):
+            await queue.asubmit(amake_job)
+
+        assert len(made) == 1
+
+    run_db(test)
+
+
+def test_failed_job_creation_frees_place(run_db):
+    async def test():
+        queue: JobQueue = JobQueue(workers=1, size=1)
+
+        async def amake_job() -> Job:
+            raise RuntimeError("not saved")
+
+        with pytest.raises(RuntimeError):
+            await queue.asubmit(amake_job)
+
+        await queue.asubmit(_make_job(uuid4()))
+
+    run_db(test)
+
+
+def test_queued_jobs_drained_on_close(run_db, answered):
+    async def test():
+        queue: JobQueue = JobQueue(workers=1, size=3)
+        answer_ids: list[UUID] = [uuid4() for _ in range(3)]
+        queue.start()
+
+        for answer_id in answer_ids:
+            await queue.asubmit(_make_job(answer_id))
+
+        await queue.aclose(timeout=5)
+
+        assert answered == answer_ids
+        assert not await queue.await_done(answer_ids[0], 0)
+
+        with pytest.raises(QueueFull):
+            await queue.asubmit(_make_job(uuid4()))
+
+    run_db(test)
+
+
+def test_await_done(run_db, answered):
+    async def test():
+        queue: JobQueue = JobQueue(workers=1, size=1)
+        answer_id: UUID = uuid4()
+        queue.start()
+        await queue.asubmit(_make_job(answer_id))
+
+        assert await queue.await_done(answer_id, 5)
+        assert answered == [answer_id]
+        assert not await queue.await_done(uuid4(), 5)
+        await queue.aclose()
+
+    run_db(test)
+
+
+def test_jobs_left_on_close_fail(run_db, monkeypatch):
+    started: Event = Event()
+
+    async def aanswer(message: str, pipeline) -> str:
+        started.set()
+        await sleep(60)
+
+    monkeypatch.setattr(handler, "_answer", aanswer)
+
+    async def test():
+        async with async_session() as db:
+            chat_id: UUID = (await chat.create_chat(db)).id
+            answers: list[Message] = [
+                await create_pending_answer(db, chat_id, f"question {i}")
+                for i in range(2)
+            ]
+
+        queue: JobQueue = JobQueue(workers=1, size=2)
+        queue.start()
+
+        for answer in answers:
+            await queue.asubmit(_make_job(answer.id))
+
+        await started.wait()
+        await queue.aclose(timeout=0.01)
+
+        # the running job is cancelled and the queued one never starts
+        async with async_session() as db:
+            statuses: list[str] = [
+                (await chat.get_message(db, chat_id, answer.id)).status
+                for answer in answers
+            ]
+
+        assert answers[0].status == PENDING
+        assert statuses == [FAILED, FAILED]
+
+    run_db(test)
+
+
+def test_job_made_during_close_fails(run_db):
+    async def test():
+        async with async_session() as db:
+            chat_id: UUID = (await chat.create_chat(db)).id
+
+        saving: Event = Event()
+        saved: Event = Event()
+
+        async def amake_job() -> Job:
+            saving.set()
+            await saved.wait()
+
+            async with async_session() as db:
+                answer: Message = await create_pending_answer(db, chat_id, "question")
+
+            return Job(answer.id, "question", None)
+
+        queue: JobQueue = JobQueue(workers=1, size=1)
+        queue.start()
+        submit: Task = create_task(queue.asubmit(amake_job))
+        await saving.wait()
+        # the queue is empty, so it's closed before the job is saved
+        await queue.aclose(timeout=5)
+        saved.set()
+        job: Job = await submit
+
+        async with async_session() as db:
+            answer: Message = await chat.get_message(db, chat_id, job.answer_id)
+
+        assert answer.status == FAILED
+        assert queue.collect_metrics()[0][2] == 0
+
+    run_db(test)
@@ -0,0 +1,63 @@
+from os import path
+
+from rag.modules.manifest import Manifest, ManifestDiff, ManifestEntry, file_hash
+
+
+def _manifest() -> Manifest:
+    return Manifest(
+        files={
+            "same.md": ManifestEntry(hash="1", ids=["a"]),
+            "edited.md": ManifestEntry(hash="2", ids=["b", "c"]),
+            "deleted.md": ManifestEntry(hash="3", ids=["d"]),
+        }
+    )
+
+
+def test_diff():
+    diff: ManifestDiff = _manifest().diff(
+        {"same.md": "1", "edited.md": "22", "new.md": "4"}
+    )
+
+    assert diff == ManifestDiff(
+        added=["new.md"],
+        changed=["edited.md"],
+        removed=["deleted.md"],
+        unchanged=["same.md"],
+    )
+
+
+def test_interrupted_file_is_changed():
+    # a file is saved with an empty hash until all its chunks are written
+    manifest: Manifest = Manifest(
+        files={"partial.md": ManifestEntry(hash="", ids=["a"])}
+    )
+
+    assert manifest.diff({"partial.md": "1"}).changed == ["partial.md"]
+
+
+def test_no_files():
+    assert Manifest().diff({}) == ManifestDiff()
+    assert _manifest().diff({}).removed == ["same.md", "edited.md", "deleted.md"]
+
+
+def test_save_and_load(tmp_path):
+    manifest_path: str = path.join(tmp_path, "index", "manifest.json")
+
+    assert Manifest.load(manifest_path) is None
+
+    _manifest().save(manifest_path)
+
+    assert Manifest.load(manifest_path) == _manifest()
+    assert not path.exists(manifest_path + ".tmp")
+
+
+def test_file_hash(tmp_path):
+    first: str = path.join(tmp_path, "first.md")
+    second: str = path.join(tmp_path, "second.md")
+
+    for file_path, text in ((first, "text"), (second, "other text")):
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    assert file_hash(first) == file_hash(first)
+    assert file_hash(first) != file_hash(second)
@@ -0,0 +1,115 @@
+from asyncio import gather, wait_for
+from uuid import UUID
+
+import pytest
+
+from rag.db.sql.connection import async_session
+from rag.db.sql.models import Message
+from rag.service import chat, writer
+from rag.service.writer import MessageWriter
+
+
+@pytest.fixture
+def inserts(monkeypatch) -> list[int]:
+    """Count rows of every insert made by the writer"""
+    counts: list[int] = []
+    insert_messages = chat.insert_messages
+
+    async def ainsert_messages(db, rows: list[dict]) -> list[Message]:
+        counts.append(len(rows))
+        return await insert_messages(db, rows)
+
+    monkeypatch.setattr(writer.chat, "insert_messages", ainsert_messages)
+
+    return counts
+
+
+async def _anew_chat() -> UUID:
+    async with async_session() as db:
+        return (await chat.create_chat(db)).id
+
+
+def _texts(messages: list[Message]) -> list[str]:
+    return [message.message for message in messages]
+
+
+def test_requests_batched(run_db, inserts):
+    async def test():
+        chat_id: UUID = await _anew_chat()
+        message_writer: MessageWriter = MessageWriter(delay=0.05, batch_size=100)
+        requests: list[list[dict]] = [
+            [chat.new_message(chat_id, f"{i}-{j}", j == 1) for j in range(size)]
+            for i, size in enumerate([1, 2, 3])
+        ]
+
+        results: list[list[Message]] = await gather(
+            *[message_writer.asave(rows) for rows in requests]
+        )
+
+        # every request gets its own messages back from the shared insert
+        assert [_texts(result) for result in results] == [
+            ["0-0"],
+            ["1-0", "1-1"],
+            ["2-0", "2-1", "2-2"],
+        ]
+        assert [message.is_system for message in results[1]] == [False, True]
+        assert inserts == [6]
+
+    run_db(test)
+
+
+def test_full_batch_saved_without_delay(run_db, inserts):
+    async def test():
+        chat_id: UUID = await _anew_chat()
+        message_writer: MessageWriter = MessageWriter(delay=60, batch_size=2)
+
+        results: list[list[Message]] = await wait_for(
+            gather(
+                message_writer.asave([chat.new_message(chat_id, "a", False)]),
+                message_writer.asave([chat.new_message(chat_id, "b", True)]),
+            ),
+            5,
+        )
+
+        assert [_texts(result) for result in results] == [["a"], ["b"]]
+        assert inserts == [2]
+        await message_writer.aclose()
+
+    run_db(test)
+
+
+def test_close_saves_pending(run_db, inserts):
+    async def test():
+        chat_id: UUID = await _anew_chat()
+        message_writer: MessageWriter = MessageWriter(delay=60, batch_size=100)
+        rows: list[dict] = [chat.new_message(chat_id, "pending", False)]
+
+        results: tuple = await gather(
+            message_writer.asave(rows), message_writer.aclose()
+        )
+
+        assert _texts(results[0]) == ["pending"]
+        assert inserts == [1]
+
+    run_db(test)
+
+
+def test_failed_insert_fails_every_request(run_db, monkeypatch):
+    async def ainsert_messages(db, rows: list[dict]) -> list[Message]:
+        raise RuntimeError("insert failed")
+
+    monkeypatch.setattr(writer.chat, "insert_messages", ainsert_messages)
+
+    async def test():
+        message_writer: MessageWriter = MessageWriter(delay=0.01, batch_size=100)
+        chat_id: UUID = await _anew_chat()
+
+        results: list = await gather(
+            message_writer.asave([chat.new_message(chat_id, "a", False)]),
+            message_writer.asave([chat.new_message(chat_id, "b", False)]),
+            return_exceptions=True,
+        )
+
+        assert [str(result) for result in results] == ["insert failed"] * 2
+
+    run_db(test)